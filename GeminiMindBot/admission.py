@@ -0,0 +1,296 @@
+import os
+import time
+import heapq
+import queue
+import itertools
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, Optional
+
+# Request priorities; lower values are admitted first
+PRIORITY_CHAT = 0
+PRIORITY_ANALYSIS = 1
+PRIORITY_PREFETCH = 2
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted before its deadline"""
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Check whether an API error means the quota was exceeded"""
+    if getattr(error, "code", None) == 429:
+        return True
+    text = str(error)
+    return "429" in text or "RESOURCE_EXHAUSTED" in text
+
+
+class TokenBucket:
+    """Token bucket matching the API's requests-per-minute quota"""
+
+    def __init__(self, rate_per_second: float, burst: int):
+        """
+        Initialize the bucket
+
+        Args:
+            rate_per_second: Tokens added per second
+            burst: Maximum number of tokens held
+        """
+        self.rate = rate_per_second
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        """Take a token if one is available"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self) -> float:
+        """Seconds until the next token is available"""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class AdaptiveLimit:
+    """AIMD concurrency limit driven by observed latency and throttling"""
+
+    def __init__(self, initial: int = 4, minimum: int = 1, maximum: int = 32,
+                 tolerance: float = 2.0, backoff: float = 0.5):
+        """
+        Initialize the limit
+
+        Args:
+            initial: Starting number of concurrent calls
+            minimum: Lowest the limit may go
+            maximum: Highest the limit may go
+            tolerance: Latency over this multiple of the baseline counts as congestion
+            backoff: Factor the limit is multiplied by on congestion
+        """
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.backoff = backoff
+        # Uncongested latency per kind of call, so short analysis calls don't set the bar for chat
+        self.baselines: Dict[Hashable, float] = {}
+
+    def on_sample(self, latency: float, throttled: bool, workload: Hashable = None):
+        """
+        Update the limit with the outcome of one call
+
+        Args:
+            latency: Call duration in seconds
+            throttled: Whether the API rejected the call for quota reasons
+            workload: Kind of call; latency is only compared with earlier calls of the same kind
+        """
+        baseline = self.baselines.get(workload)
+        if not throttled:
+            # Slowly forgetting minimum: tracks the uncongested latency
+            if baseline is None or latency < baseline:
+                baseline = latency
+            else:
+                baseline += (latency - baseline) * 0.01
+            self.baselines[workload] = baseline
+
+        if throttled or (baseline is not None and latency > baseline * self.tolerance):
+            self.limit = max(self.minimum, self.limit * self.backoff)
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+
+class AdmissionController:
+    """Bounds upstream model calls with a quota bucket, adaptive concurrency and a priority queue"""
+
+    def __init__(self, requests_per_minute: int = 60, max_queue: int = 50,
+                 limit: Optional[AdaptiveLimit] = None):
+        """
+        Initialize the controller
+
+        Args:
+            requests_per_minute: API quota for the process
+            max_queue: Waiting requests beyond this are rejected
+            limit: Adaptive concurrency limit
+        """
+        self.bucket = TokenBucket(requests_per_minute / 60.0, burst=max(1, requests_per_minute // 6))
+        self.limit = limit or AdaptiveLimit()
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.throttled = 0
+        self._waiting = []
+        self._rejected_waiters = set()
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def acquire(self, priority: int, timeout: float):
+        """
+        Wait for permission to make an upstream call
+
+        Args:
+            priority: PRIORITY_CHAT, PRIORITY_ANALYSIS or PRIORITY_PREFETCH
+            timeout: Seconds the caller is willing to wait in the queue
+
+        Raises:
+            AdmissionRejected: The queue is full or the deadline passed
+        """
+        deadline = time.monotonic() + timeout
+        entry = (priority, next(self._sequence))
+
+        with self._condition:
+            if len(self._waiting) >= self.max_queue:
+                # A full queue sheds its least important waiter, if that is not us
+                worst = max(self._waiting)
+                if worst <= entry:
+                    self.rejected += 1
+                    raise AdmissionRejected("Upstream queue is full")
+                self._waiting.remove(worst)
+                heapq.heapify(self._waiting)
+                self._rejected_waiters.add(worst)
+
+            heapq.heappush(self._waiting, entry)
+            self._condition.notify_all()
+
+            while True:
+                if entry in self._rejected_waiters:
+                    self._rejected_waiters.discard(entry)
+                    self.rejected += 1
+                    raise AdmissionRejected("Shed by a higher priority request")
+
+                wait = deadline - time.monotonic()
+                if self._waiting[0] == entry and self.in_flight < int(self.limit.limit):
+                    if self.bucket.try_acquire():
+                        heapq.heappop(self._waiting)
+                        self.in_flight += 1
+                        self.admitted += 1
+                        self._condition.notify_all()
+                        return
+                    wait = min(wait, self.bucket.wait_time())
+
+                if deadline - time.monotonic() <= 0:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    self.rejected += 1
+                    self._condition.notify_all()
+                    raise AdmissionRejected("Timed out waiting for an upstream slot")
+
+                self._condition.wait(max(0.001, wait))
+
+    def release(self, latency: float, throttled: bool = False, workload: Hashable = None):
+        """
+        Return a slot and feed the outcome to the adaptive limit
+
+        Args:
+            latency: Call duration in seconds
+            throttled: Whether the API answered with a rate-limit error
+            workload: Kind of call the latency is compared against, see AdaptiveLimit.on_sample
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+            self.limit.on_sample(latency, throttled, workload)
+            self._condition.notify_all()
+
+    @contextmanager
+    def admit(self, priority: int, timeout: float) -> Iterator[None]:
+        """Hold an upstream slot for the duration of the block"""
+        self.acquire(priority, timeout)
+        start = time.monotonic()
+        throttled = False
+        try:
+            yield
+        except Exception as e:
+            throttled = is_rate_limit_error(e)
+            raise
+        finally:
+            self.release(time.monotonic() - start, throttled, priority)
+
+    def stream(self, priority: int, timeout: float, start: Callable[[], Iterable[Any]]) -> Iterator[Any]:
+        """
+        Read an upstream stream in the background while holding a slot
+
+        The slot is returned as soon as the upstream stream ends, however
+        slowly the caller renders it, and the adaptive limit is fed the time
+        to the first chunk, which does not grow with the answer's length.
+
+        Args:
+            priority: PRIORITY_CHAT, PRIORITY_ANALYSIS or PRIORITY_PREFETCH
+            timeout: Seconds the caller is willing to wait in the queue
+            start: Starts the upstream stream
+
+        Yields:
+            Stream chunks
+
+        Raises:
+            AdmissionRejected: The queue is full or the deadline passed
+        """
+        self.acquire(priority, timeout)
+        chunks = queue.Queue()
+        stopped = threading.Event()
+        end = object()
+        errors = []
+        started = time.monotonic()
+
+        def read():
+            first_chunk = None
+            throttled = False
+            try:
+                stream = start()
+                for chunk in stream:
+                    if first_chunk is None:
+                        first_chunk = time.monotonic() - started
+                    if stopped.is_set():
+                        close = getattr(stream, "close", None)
+                        if close is not None:
+                            close()
+                        break
+                    chunks.put(chunk)
+            except Exception as e:
+                throttled = is_rate_limit_error(e)
+                errors.append(e)
+            finally:
+                latency = first_chunk if first_chunk is not None else time.monotonic() - started
+                self.release(latency, throttled, (priority, "stream"))
+                chunks.put(end)
+
+        threading.Thread(target=read, name="upstream-stream", daemon=True).start()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is end:
+                    if errors:
+                        raise errors[0]
+                    return
+                yield chunk
+        finally:
+            stopped.set()
+
+    def stats(self) -> Dict[str, float]:
+        """Get the current limit, queue depth and counters"""
+        with self._condition:
+            return {
+                "limit": round(self.limit.limit, 2),
+                "in_flight": self.in_flight,
+                "queued": len(self._waiting),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "throttled": self.throttled
+            }
+
+
+# Process-wide controller in front of every generate_content call
+shared_admission = AdmissionController(
+    requests_per_minute=int(os.environ.get("GEMINI_RPM", "60")),
+    max_queue=int(os.environ.get("GEMINI_MAX_QUEUE", "50")),
+    limit=AdaptiveLimit(maximum=int(os.environ.get("GEMINI_MAX_CONCURRENCY", "32")))
+)
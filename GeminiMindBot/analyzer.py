@@ -1,21 +1,188 @@
-import os
-from google import genai
-from google.genai import types
 import json
 import logging
-from typing import Dict, Any, List
+import threading
+from typing import Dict, Any, List, Optional, TypedDict
+
+from gemini_client import get_client, usage_from_response
+from single_flight import shared_flight, request_key
+from ledger import record_usage
+from admission import shared_admission, AdmissionRejected, PRIORITY_ANALYSIS
+
+# Analysis is optional: give up quickly and use the local fallback instead
+ANALYSIS_QUEUE_TIMEOUT = 2.0
+
+# Allowed values of each label; the response schema restricts the model to these
+INTENTS = ("question", "request", "greeting", "complaint", "compliment", "information", "help")
+SENTIMENTS = ("positive", "negative", "neutral", "curious", "frustrated", "excited")
+TOPICS = ("product", "payment", "shipping", "returns", "general")
+COMPLEXITIES = ("simple", "moderate", "complex")
+
+# One-letter keys the model answers with, and the fields they stand for
+COMPACT_KEYS = {"i": "intent", "s": "sentiment", "t": "topic", "c": "complexity", "k": "keywords"}
+_ALLOWED = {"intent": frozenset(INTENTS), "sentiment": frozenset(SENTIMENTS),
+            "topic": frozenset(TOPICS), "complexity": frozenset(COMPLEXITIES)}
+
+
+class Analysis(TypedDict):
+    """Labels of one user message"""
+    intent: str
+    sentiment: str
+    topic: str
+    complexity: str
+    keywords: List[str]
+
+
+class AnalysisParseError(ValueError):
+    """The model's answer is not a valid compact analysis"""
+
+
+def decode_analysis(text: Optional[str]) -> Analysis:
+    """
+    Parse and check a compact analysis answer
+    
+    Args:
+        text: JSON object with the COMPACT_KEYS, e.g. {"i":"greeting","s":"neutral",...}
+        
+    Returns:
+        The analysis with full field names
+        
+    Raises:
+        AnalysisParseError: If the answer is missing, malformed or has a value outside its enum
+    """
+    try:
+        data = json.loads(text or "")
+    except json.JSONDecodeError as e:
+        raise AnalysisParseError(f"invalid JSON: {str(e)}")
+    if not isinstance(data, dict):
+        raise AnalysisParseError("not a JSON object")
+    
+    analysis = {}
+    for key, field in COMPACT_KEYS.items():
+        value = data.get(key)
+        if field == "keywords":
+            if not isinstance(value, list) or not all(isinstance(word, str) for word in value):
+                raise AnalysisParseError("k is not a list of strings")
+            analysis[field] = value[:5]
+        elif value not in _ALLOWED[field]:
+            raise AnalysisParseError(f"{key}={value!r} is not one of the allowed {field} values")
+        else:
+            analysis[field] = value
+    return analysis
+
+
+def encode_analysis(analysis: Dict[str, Any]) -> str:
+    """Write an analysis in the compact form the model answers with"""
+    return json.dumps({key: analysis[field] for key, field in COMPACT_KEYS.items()},
+                      ensure_ascii=False, separators=(",", ":"))
+
+
+def keyword_analysis(question: str) -> Dict[str, Any]:
+    """
+    Analyze a question locally from Arabic keywords, without calling the API
+    
+    Args:
+        question: The user's question
+        
+    Returns:
+        Smart analysis based on content
+    """
+    question_lower = question.lower()
+    
+    # Detect intent based on keywords
+    intent = "question"
+    if any(word in question_lower for word in ["ساعة", "منتج", "سعر", "شراء", "اشتري"]):
+        intent = "information"
+    elif any(word in question_lower for word in ["أهلاً", "السلام", "مرحباً", "صباح"]):
+        intent = "greeting"
+    elif any(word in question_lower for word in ["طلب", "تتبع", "وصل", "شحن"]):
+        intent = "request"
+    elif any(word in question_lower for word in ["مشكلة", "شكوى", "خطأ", "غلط"]):
+        intent = "complaint"
+    elif any(word in question_lower for word in ["شكراً", "ممتاز", "رائع"]):
+        intent = "compliment"
+    elif any(word in question_lower for word in ["مساعدة", "ساعدني", "كيف"]):
+        intent = "help"
+    
+    # Detect sentiment
+    sentiment = "neutral"
+    if any(word in question_lower for word in ["شكراً", "ممتاز", "رائع", "جيد", "أحب"]):
+        sentiment = "positive"
+    elif any(word in question_lower for word in ["سيء", "مشكلة", "غاضب", "محبط", "زعلان"]):
+        sentiment = "negative"
+    elif any(word in question_lower for word in ["؟", "كيف", "ماذا", "متى", "أين"]):
+        sentiment = "curious"
+    
+    # Detect topic
+    topic = "general"
+    if any(word in question_lower for word in ["ساعة", "منتج"]):
+        topic = "product"
+    elif any(word in question_lower for word in ["شحن", "توصيل", "طلب"]):
+        topic = "shipping"
+    elif any(word in question_lower for word in ["دفع", "فلوس", "سعر"]):
+        topic = "payment"
+    elif any(word in question_lower for word in ["إرجاع", "استبدال", "ضمان"]):
+        topic = "returns"
+    
+    # Determine complexity
+    complexity = "simple"
+    if len(question) > 50 or question.count("؟") > 1:
+        complexity = "moderate"
+    if len(question) > 100 or any(word in question_lower for word in ["معقد", "صعب", "مشكلة كبيرة"]):
+        complexity = "complex"
+    
+    # Extract basic keywords
+    keywords = [word for word in question_lower.split() if len(word) > 2][:5]
+    
+    return {
+        "intent": intent,
+        "sentiment": sentiment,
+        "topic": topic,
+        "complexity": complexity,
+        "keywords": keywords
+    }
+
+
+def _response_schema():
+    """Schema of the compact analysis: enum-constrained labels and up to five keywords"""
+    from google.genai import types
+    
+    def label(values):
+        return types.Schema(type="STRING", enum=list(values))
+    
+    return types.Schema(
+        type="OBJECT",
+        properties={
+            "i": label(INTENTS),
+            "s": label(SENTIMENTS),
+            "t": label(TOPICS),
+            "c": label(COMPLEXITIES),
+            "k": types.Schema(type="ARRAY", items=types.Schema(type="STRING"), max_items=5,
+                              description="Up to five key terms from the message")
+        },
+        required=list(COMPACT_KEYS),
+        property_ordering=list(COMPACT_KEYS)
+    )
+
 
 class QuestionAnalyzer:
     """Analyzes user questions to extract intent, sentiment, and other metadata"""
     
-    def __init__(self):
-        """Initialize the question analyzer with Gemini API client"""
-        api_key = os.environ.get("GEMINI_API_KEY", "")
-        if not api_key:
-            raise ValueError("GEMINI_API_KEY environment variable is required")
+    def __init__(self, client=None, model_name: Optional[str] = None, compact: bool = True):
+        """
+        Initialize the question analyzer with Gemini API client
         
-        self.client = genai.Client(api_key=api_key)
-        self.model_name = "gemini-2.5-pro"  # Using pro model for better analysis
+        Args:
+            client: Gemini client to use (defaults to the shared client of the analysis backend)
+            model_name: Analysis model, e.g. from a tenant profile
+            compact: Ask for schema-constrained compact JSON; False uses the
+                original free-form prompt, kept for comparison
+        """
+        self.client = client or get_client("analysis")
+        self.model_name = model_name or "gemini-2.5-pro"  # Using pro model for better analysis
+        self.compact = compact
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {"calls": 0, "parse_failures": 0, "fallbacks": 0, "output_tokens": 0}
         
         # System instruction for question analysis
         self.system_instruction = (
@@ -35,9 +202,61 @@ class QuestionAnalyzer:
         Returns:
             Dictionary containing analysis results
         """
+        from google.genai import types
+        
+        self._local.usage = {}
         try:
-            # Create analysis prompt
-            analysis_prompt = f"""
+            analysis_prompt = self.build_prompt(question)
+            
+            def generate():
+                with shared_admission.admit(PRIORITY_ANALYSIS, ANALYSIS_QUEUE_TIMEOUT):
+                    response = self.client.models.generate_content(
+                        model=self.model_name,
+                        contents=[
+                            types.Content(
+                                role="user", 
+                                parts=[types.Part(text=analysis_prompt)]
+                            )
+                        ],
+                        config=self.generation_config()
+                    )
+                self._local.usage = usage_from_response(response)
+                record_usage("analysis", self.model_name, self._local.usage)
+                with self._stats_lock:
+                    self._stats["calls"] += 1
+                    self._stats["output_tokens"] += self._local.usage.get("output_tokens", 0)
+                # Decoded once per call, so parse failures are counted against the same calls
+                return self.parse_response(response.text, question)
+            
+            # Generate analysis using Gemini; concurrent identical questions share one call
+            analysis = shared_flight.do(
+                request_key("analysis", self.model_name, question), generate)
+            
+            # Callers sharing the call each get their own copy
+            return dict(analysis, keywords=list(analysis.get("keywords", [])))
+                
+        except AdmissionRejected as e:
+            logging.warning(f"Analysis request not admitted, using fallback: {str(e)}")
+            return self._create_smart_fallback_analysis(question)
+        except Exception as e:
+            logging.error(f"Error analyzing question: {e}")
+            # Create basic analysis based on the question content
+            return self._create_smart_fallback_analysis(question)
+    
+    def build_prompt(self, question: str) -> str:
+        """
+        Build the analysis prompt for a question
+        
+        Args:
+            question: The user's question or message
+            
+        Returns:
+            Prompt text sent to Gemini
+        """
+        if self.compact:
+            # Field meanings and allowed values are in the response schema
+            return f'Label this customer message of an online store.\nUser message: "{question}"'
+        return f"""
             Analyze the following user message and provide a JSON response with these fields:
             - intent: The user's primary intent (e.g., "question", "request", "greeting", "complaint", "compliment")
             - sentiment: The emotional tone (e.g., "positive", "negative", "neutral", "curious", "frustrated")
@@ -49,38 +268,71 @@ class QuestionAnalyzer:
             
             Respond only with valid JSON.
             """
-            
-            # Generate analysis using Gemini
-            response = self.client.models.generate_content(
-                model=self.model_name,
-                contents=[
-                    types.Content(
-                        role="user", 
-                        parts=[types.Part(text=analysis_prompt)]
-                    )
-                ],
-                config=types.GenerateContentConfig(
-                    system_instruction=self.system_instruction,
-                    response_mime_type="application/json",
-                    temperature=0.3  # Lower temperature for more consistent analysis
-                )
+    
+    def generation_config(self):
+        """Build the generation config for analysis requests"""
+        from google.genai import types
+        
+        if self.compact:
+            return types.GenerateContentConfig(
+                system_instruction=self.system_instruction,
+                response_mime_type="application/json",
+                response_schema=_response_schema(),
+                temperature=0.3
             )
+        return types.GenerateContentConfig(
+            system_instruction=self.system_instruction,
+            response_mime_type="application/json",
+            temperature=0.3  # Lower temperature for more consistent analysis
+        )
+    
+    def parse_response(self, response_text: Optional[str], question: str) -> Dict[str, Any]:
+        """
+        Turn the model's JSON answer into a validated analysis
+        
+        Args:
+            response_text: Raw response text from Gemini
+            question: The analysed question, used for the fallback
             
-            if response.text:
-                try:
-                    analysis_data = json.loads(response.text)
-                    return self._validate_analysis(analysis_data)
-                except json.JSONDecodeError as e:
-                    logging.error(f"Failed to parse analysis JSON: {str(e)}")
-                    return self._create_smart_fallback_analysis(question)
-            else:
+        Returns:
+            Validated analysis, or the keyword fallback if the answer is unusable
+        """
+        if self.compact:
+            try:
+                return decode_analysis(response_text)
+            except AnalysisParseError as e:
+                # Counted, so a schema or model change that breaks parsing shows up in stats()
+                with self._stats_lock:
+                    self._stats["parse_failures"] += 1
+                    self._stats["fallbacks"] += 1
+                logging.warning(f"Analysis answer rejected ({str(e)}), using keyword analysis: "
+                                f"{(response_text or '')[:200]!r}")
                 return self._create_smart_fallback_analysis(question)
-                
-        except Exception as e:
-            logging.error(f"Error analyzing question: {e}")
-            # Create basic analysis based on the question content
+        if response_text:
+            try:
+                analysis_data = json.loads(response_text)
+                return self._validate_analysis(analysis_data)
+            except json.JSONDecodeError as e:
+                logging.error(f"Failed to parse analysis JSON: {str(e)}")
+                return self._create_smart_fallback_analysis(question)
+        else:
             return self._create_smart_fallback_analysis(question)
     
+    @property
+    def last_usage(self) -> Dict[str, int]:
+        """Token usage of the last upstream call made by the current thread"""
+        return getattr(self._local, "usage", {})
+    
+    def stats(self) -> Dict[str, float]:
+        """Calls, parse failures and output tokens since start"""
+        with self._stats_lock:
+            calls = self._stats["calls"]
+            return dict(
+                self._stats,
+                parse_failure_rate=round(self._stats["parse_failures"] / calls, 4) if calls else 0.0,
+                avg_output_tokens=round(self._stats["output_tokens"] / calls, 1) if calls else 0.0
+            )
+    
     def _validate_analysis(self, analysis: Dict[str, Any]) -> Dict[str, Any]:
         """
         Validate and clean the analysis data
@@ -94,21 +346,18 @@ class QuestionAnalyzer:
         validated = {}
         
         # Validate intent
-        valid_intents = ["question", "request", "greeting", "complaint", "compliment", "information", "help"]
         validated["intent"] = analysis.get("intent", "question").lower()
-        if validated["intent"] not in valid_intents:
+        if validated["intent"] not in INTENTS:
             validated["intent"] = "question"
         
         # Validate sentiment
-        valid_sentiments = ["positive", "negative", "neutral", "curious", "frustrated", "excited"]
         validated["sentiment"] = analysis.get("sentiment", "neutral").lower()
-        if validated["sentiment"] not in valid_sentiments:
+        if validated["sentiment"] not in SENTIMENTS:
             validated["sentiment"] = "neutral"
         
         # Validate complexity
-        valid_complexities = ["simple", "moderate", "complex"]
         validated["complexity"] = analysis.get("complexity", "moderate").lower()
-        if validated["complexity"] not in valid_complexities:
+        if validated["complexity"] not in COMPLEXITIES:
             validated["complexity"] = "moderate"
         
         # Validate topic
@@ -148,60 +397,7 @@ class QuestionAnalyzer:
         Returns:
             Smart analysis based on content
         """
-        question_lower = question.lower()
-        
-        # Detect intent based on keywords
-        intent = "question"
-        if any(word in question_lower for word in ["ساعة", "منتج", "سعر", "شراء", "اشتري"]):
-            intent = "information"
-        elif any(word in question_lower for word in ["أهلاً", "السلام", "مرحباً", "صباح"]):
-            intent = "greeting"
-        elif any(word in question_lower for word in ["طلب", "تتبع", "وصل", "شحن"]):
-            intent = "request"
-        elif any(word in question_lower for word in ["مشكلة", "شكوى", "خطأ", "غلط"]):
-            intent = "complaint"
-        elif any(word in question_lower for word in ["شكراً", "ممتاز", "رائع"]):
-            intent = "compliment"
-        elif any(word in question_lower for word in ["مساعدة", "ساعدني", "كيف"]):
-            intent = "help"
-        
-        # Detect sentiment
-        sentiment = "neutral"
-        if any(word in question_lower for word in ["شكراً", "ممتاز", "رائع", "جيد", "أحب"]):
-            sentiment = "positive"
-        elif any(word in question_lower for word in ["سيء", "مشكلة", "غاضب", "محبط", "زعلان"]):
-            sentiment = "negative"
-        elif any(word in question_lower for word in ["؟", "كيف", "ماذا", "متى", "أين"]):
-            sentiment = "curious"
-        
-        # Detect topic
-        topic = "general"
-        if any(word in question_lower for word in ["ساعة", "منتج"]):
-            topic = "product"
-        elif any(word in question_lower for word in ["شحن", "توصيل", "طلب"]):
-            topic = "shipping"
-        elif any(word in question_lower for word in ["دفع", "فلوس", "سعر"]):
-            topic = "payment"
-        elif any(word in question_lower for word in ["إرجاع", "استبدال", "ضمان"]):
-            topic = "returns"
-        
-        # Determine complexity
-        complexity = "simple"
-        if len(question) > 50 or question.count("؟") > 1:
-            complexity = "moderate"
-        if len(question) > 100 or any(word in question_lower for word in ["معقد", "صعب", "مشكلة كبيرة"]):
-            complexity = "complex"
-        
-        # Extract basic keywords
-        keywords = [word for word in question_lower.split() if len(word) > 2][:5]
-        
-        return {
-            "intent": intent,
-            "sentiment": sentiment,
-            "topic": topic,
-            "complexity": complexity,
-            "keywords": keywords
-        }
+        return keyword_analysis(question)
     
     def analyze_conversation_patterns(self, interactions: List[Dict[str, Any]]) -> Dict[str, Any]:
         """
@@ -244,3 +440,65 @@ class QuestionAnalyzer:
             patterns["complexity_trend"].append(complexity)
         
         return patterns
+
+
+if __name__ == "__main__":
+    import time
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Compare the free-form and compact analysis prompts")
+    parser.add_argument("questions", nargs="?", help="CSV or JSONL file with a question column")
+    parser.add_argument("--limit", type=int, default=50, help="Questions to analyze per prompt")
+    args = parser.parse_args()
+    
+    if args.questions:
+        from evaluate import load_questions
+        questions = [row["question"] for row in load_questions(args.questions)][:args.limit]
+    else:
+        questions = ["السلام عليكم", "بكام الساعة؟", "الشحن لإسكندرية بياخد قد إيه؟",
+                     "الساعة وصلت مكسورة وعايز أرجعها", "شكراً جزيلاً على المساعدة"]
+    
+    def free_form_valid(text: Optional[str]) -> bool:
+        """Whether a free-form answer would have passed _validate_analysis unchanged"""
+        try:
+            data = json.loads(text or "")
+        except json.JSONDecodeError:
+            return False
+        return isinstance(data, dict) and isinstance(data.get("keywords"), list) and all(
+            str(data.get(field, "")).lower() in allowed for field, allowed in _ALLOWED.items())
+    
+    for compact in (False, True):
+        from google.genai import types
+        
+        analyzer = QuestionAnalyzer(compact=compact)
+        latencies, tokens, failures = [], 0, 0
+        for question in questions:
+            started = time.perf_counter()
+            try:
+                response = analyzer.client.models.generate_content(
+                    model=analyzer.model_name,
+                    contents=[types.Content(role="user", parts=[types.Part(text=analyzer.build_prompt(question))])],
+                    config=analyzer.generation_config()
+                )
+            except Exception as e:
+                logging.error(f"Analysis request failed: {str(e)}")
+                failures += 1
+                continue
+            latencies.append((time.perf_counter() - started) * 1000)
+            tokens += usage_from_response(response).get("output_tokens", 0)
+            if compact:
+                try:
+                    decode_analysis(response.text)
+                except AnalysisParseError:
+                    failures += 1
+            elif not free_form_valid(response.text):
+                failures += 1
+        
+        latencies.sort()
+        print(json.dumps({
+            "prompt": "compact" if compact else "free-form",
+            "questions": len(questions),
+            "avg_output_tokens": round(tokens / max(1, len(latencies)), 1),
+            "parse_failure_rate": round(failures / max(1, len(questions)), 3),
+            "p50_latency_ms": round(latencies[len(latencies) // 2], 1) if latencies else None
+        }, ensure_ascii=False))
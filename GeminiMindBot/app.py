@@ -1,37 +1,123 @@
+import os
+import startup
+import profiling
+import uuid
+import threading
 import streamlit as st
 from datetime import datetime
 from chatbot import ChatBot
 from memory import ConversationMemory
-from analyzer import QuestionAnalyzer
+from message_history import MessageHistory
+from slots import tracking_reply
+from write_behind import shared_writer
+from analyzer import QuestionAnalyzer, keyword_analysis
+from archive import ConversationArchive
+from search_index import ConversationSearchIndex
+from voice_utils import voice_bridge, speak_stream, pop_voice_analysis
+from gemini_client import preload, get_client, backend_for
+from tenants import get_tenant, watch_tenants
+from tools import get_tool_executor, order_lookup
+from ledger import get_ledger, charge_stream
+from prefetch import Prefetcher, load_predictor
+
+startup.mark("imports")
+preload()
+# Store knowledge edits in the tenants file apply without a restart
+watch_tenants()
+
+
+def new_conversation_id() -> str:
+    """Conversation id: readable start time plus a random suffix, so sessions starting together don't share files"""
+    return f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+
+
+@st.cache_resource
+def get_chatbot(tenant_id: str):
+    """Shared chatbot for all sessions of a store, warmed up in the background"""
+    chatbot = ChatBot(tenant=get_tenant(tenant_id))
+    threading.Thread(target=chatbot.warmup, name="gemini-warmup", daemon=True).start()
+    return chatbot
+
+
+@st.cache_resource
+def get_prefetcher(tenant_id: str):
+    """Shared speculative answers for a store, None until a follow-up model is trained"""
+    predictor = load_predictor()
+    if predictor is None:
+        return None
+    return Prefetcher(get_chatbot(tenant_id), predictor,
+                      top_k=int(os.environ.get("PREFETCH_TOP_K", "1")),
+                      daily_budget=float(os.environ.get("PREFETCH_BUDGET_USD", "1.0")))
+
+
+@st.cache_resource
+def get_analyzer(model_name: str):
+    """Shared question analyzer for all sessions using a model"""
+    return QuestionAnalyzer(model_name=model_name)
+
+
+@st.cache_resource
+def get_archive():
+    """Shared archive for conversations leaving the live store"""
+    return ConversationArchive()
+
+
+@st.cache_resource
+def get_search_index():
+    """Shared full-text index over every stored turn"""
+    return ConversationSearchIndex(writer=shared_writer)
+
+# ?store=<tenant id> selects the store; unknown ids get the default one
+tenant = get_tenant(st.query_params.get("store"))
+
+
+def avatar_badge(size: int) -> str:
+    """The store assistant's avatar: its picture if set, otherwise its emoji"""
+    if tenant.avatar_url:
+        return f'<img width="{size}px" height="{size}px" style="border-radius: 50%;" src="{tenant.avatar_url}"/>'
+    return tenant.avatar
 
-# Initialize session state
-if "chatbot" not in st.session_state:
-    st.session_state.chatbot = ChatBot()
-    st.session_state.memory = ConversationMemory()
-    st.session_state.analyzer = QuestionAnalyzer()
-    st.session_state.messages = []
-    st.session_state.conversation_id = datetime.now().strftime("%Y%m%d_%H%M%S")
 
 # Page configuration
-st.set_page_config(page_title="مساعد عملاء 3QRab",
-                   page_icon="https://3qrab.netlify.app/logo.ico",
+st.set_page_config(page_title=f"مساعد عملاء {tenant.store_name}",
+                   page_icon=tenant.logo_url,
                    layout="centered")
 
+# Admin view of the turn profiles (?admin=<ADMIN_TOKEN>)
+if profiling.is_admin(st.query_params.get("admin")):
+    profiling.render_admin_page()
+    st.subheader("Memory write-behind")
+    st.json(shared_writer.stats())
+    if get_tool_executor() is not None:
+        st.subheader("Tool lookups")
+        st.json(get_tool_executor().stats())
+    if backend_for("chat") == "overflow":
+        st.subheader("Local overflow")
+        st.json(get_client("chat").stats())
+    if get_prefetcher(get_tenant().id) is not None:
+        st.subheader("Speculative answers")
+        st.json(get_prefetcher(get_tenant().id).stats())
+    st.stop()
+
+# ?profile=<ADMIN_TOKEN> profiles every turn of this session
+if profiling.is_admin(st.query_params.get("profile")):
+    st.session_state.profile = True
+
 # Custom CSS + Navbar
-st.markdown("""
+st.markdown(f"""
 <link href="https://fonts.googleapis.com/css2?family=Cairo:wght@300;400;500;600;700&display=swap" rel="stylesheet">
 <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
 
 
 <style>
-    * {
+    * {{
         font-family: 'Cairo', 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif !important;
-    }
-    .stApp {
+    }}
+    .stApp {{
         font-family: 'Cairo', sans-serif !important;
         padding-top: 80px !important;
-    }
-    .fixed-navbar {
+    }}
+    .fixed-navbar {{
         position: fixed;
         top: 0;
         left: 0;
@@ -44,8 +130,8 @@ st.markdown("""
         justify-content: space-between;
         align-items: center;
         border-bottom: 1px solid #e0e0e0;
-    }
-    .navbar-title {
+    }}
+    .navbar-title {{
         color: #000000;
         font-weight: 600;
         font-size: 1.5rem;
@@ -53,8 +139,8 @@ st.markdown("""
         display: flex;
         align-items: center;
         gap: 10px;
-    }
-    .navbar-button, .navbar-home {
+    }}
+    .navbar-button, .navbar-home {{
         background: linear-gradient(45deg, #000000, #333333);
         color: white;
         padding: 10px 20px;
@@ -69,16 +155,16 @@ st.markdown("""
         display: flex;
         align-items: center;
         gap: 8px;
-    }
-    .navbar-button:hover, .navbar-home:hover {
+    }}
+    .navbar-button:hover, .navbar-home:hover {{
         transform: translateY(-2px);
         box-shadow: 0 6px 20px rgba(0,0,0,0.3);
         text-decoration: none;
         color: white;
-    }
+    }}
 </style>
 <navbar>
-<a href="https://3qrab.netlify.app/" target="_blank" style="
+<a href="{tenant.store_url}" target="_blank" style="
     display: inline-block;
     background: linear-gradient(45deg, #000000, #333333);
     color: white;
@@ -99,16 +185,16 @@ st.markdown("""
             unsafe_allow_html=True)
 
 # Welcome section
-st.markdown("""
+st.markdown(f"""
 <style>
-*{
+*{{
 direction:rtl;
-}
+}}
 </style>
 <div style="text-align: center; padding: 2rem 0; background: linear-gradient(135deg, #f8f9fa 0%, #ffffff 100%); border-radius: 15px; margin-bottom: 2rem; box-shadow: 0 4px 20px rgba(0,0,0,0.05);">
-    <h1 style="color: #000000; font-weight: 600; margin: 0 0 1rem 0; font-size: 2.5rem;">أهلاً بك في متجر 3QRab</h1>
+    <h1 style="color: #000000; font-weight: 600; margin: 0 0 1rem 0; font-size: 2.5rem;">أهلاً بك في متجر {tenant.store_name}</h1>
     <p style="color: #666666; font-size: 1.1rem; margin: 1rem 0; font-weight: 400;">
-        أنا موسي، مساعدك الذكي • يسعدني مساعدتك في كل احتياجاتك ⌚
+        {tenant.greeting}
     </p>
     <div style="display: flex; justify-content: center; gap: 20px; margin-top: 1.5rem;">
         <span style="background: #f0f0f0; padding: 8px 16px; border-radius: 20px; color: #333; font-size: 14px;">💬 دردشة ذكية</span>
@@ -119,10 +205,25 @@ direction:rtl;
 """,
             unsafe_allow_html=True)
 
+startup.mark("first_render")
+
+# Initialize session state (after the header, so the page shows while the
+# Gemini SDK is imported on the first run)
+if "chatbot" not in st.session_state:
+    st.session_state.chatbot = get_chatbot(tenant.id)
+    st.session_state.analyzer = get_analyzer(tenant.analysis_model)
+    st.session_state.conversation_id = new_conversation_id()
+    st.session_state.messages = MessageHistory(st.session_state.conversation_id)
+    st.session_state.memory = ConversationMemory(
+        conversation_id=st.session_state.conversation_id, archive=get_archive(),
+        search_index=get_search_index(), writer=shared_writer)
+
+startup.mark("resources")
+
 # Call to action button
-st.markdown("""
+st.markdown(f"""
 <div style="text-align: center; margin: 2rem 0;">
-    <a href="https://3qrab.netlify.app/" target="_blank" style="
+    <a href="{tenant.store_url}" target="_blank" style="
         display: inline-block;
         background: linear-gradient(45deg, #000000, #333333);
         color: white;
@@ -147,26 +248,38 @@ col1, col2, col3 = st.columns([1, 1, 1])
 with col2:
     if st.button("🗑️ مسح المحادثة", use_container_width=True,
                  type="secondary"):
-        st.session_state.messages = []
         st.session_state.memory.clear_memory()
-        st.session_state.conversation_id = datetime.now().strftime(
-            "%Y%m%d_%H%M%S")
+        st.session_state.conversation_id = new_conversation_id()
+        st.session_state.messages.clear(st.session_state.conversation_id)
+        st.session_state.memory.conversation_id = st.session_state.conversation_id
         st.rerun()
 
+# Chat input (pinned to the bottom of the page wherever it is called)
+typed_prompt = st.chat_input("💬 مرحباً! اكتب سؤالك أو استفسارك هنا...")
+
+# Voice input/output (one persistent component, rendered before the chat so
+# streamed replies can be spoken while they are generated)
+voice_prompt = voice_bridge(analyzer=st.session_state.analyzer, reply=bool(typed_prompt))
+
 # Chat interface
-st.markdown("""
+st.markdown(f"""
 <div style="background: white; border-radius: 15px; padding: 1.5rem; margin: 2rem 0; box-shadow: 0 4px 20px rgba(0,0,0,0.05); border: 1px solid #f0f0f0;">
     <div style="text-align: center; margin-bottom: 1.5rem;">
         <h3 style="color: #000000; font-weight: 500; margin: 0; display: flex; align-items: center; justify-content: center; gap: 10px;">
-            <span style="background: linear-gradient(45deg, #000000, #333333); color: white; padding: 8px 12px; border-radius: 50%; font-size: 16px;">⌚</span>
-            محادثة مع موسي
+            <span style="background: linear-gradient(45deg, #000000, #333333); color: white; padding: 8px 12px; border-radius: 50%; font-size: 16px;">{avatar_badge(24)}</span>
+            محادثة مع {tenant.persona}
         </h3>
-        <p style="color: #666; margin: 0.5rem 0 0 0; font-size: 14px;">مساعد ذكي لمتجر 3QRab • خبير في خدمة العملاء</p>
+        <p style="color: #666; margin: 0.5rem 0 0 0; font-size: 14px;">مساعد ذكي لمتجر {tenant.store_name} • خبير في خدمة العملاء</p>
     </div>
 </div>
 """,
             unsafe_allow_html=True)
 
+# Older messages live on disk until asked for
+if st.session_state.messages.has_earlier:
+    if st.button("⬆️ عرض الرسائل السابقة", use_container_width=True):
+        st.session_state.messages.load_earlier()
+
 # Display chat messages
 for message in st.session_state.messages:
     if message["role"] == "user":
@@ -186,8 +299,8 @@ for message in st.session_state.messages:
         st.markdown(f"""
         <div style="background: linear-gradient(135deg, #ffffff 0%, #f8f9fa 100%); padding: 1.2rem; border-radius: 15px; margin: 1rem 0; border: 1px solid #e0e0e0; box-shadow: 0 4px 15px rgba(0,0,0,0.08);">
             <div style="display: flex; align-items: center; gap: 10px; margin-bottom: 8px;">
-                <span style="background: linear-gradient(45deg, #000000, #333333); color: white; padding: 6px 10px; border-radius: 50%; font-size: 14px;">⌚</span>
-                <strong style="color: #000000; font-weight: 600;">موسي</strong>
+                <span style="background: linear-gradient(45deg, #000000, #333333); color: white; padding: 6px 10px; border-radius: 50%; font-size: 14px;">{avatar_badge(30)}</span>
+                <strong style="color: #000000; font-weight: 600;">{tenant.persona}</strong>
                 <span style="background: #f0f0f0; color: #666; padding: 2px 8px; border-radius: 10px; font-size: 12px;">مساعد ذكي</span>
             </div>
             <div style="color: #333333; padding-left: 40px; line-height: 1.6;">{message["content"]}</div>
@@ -195,93 +308,140 @@ for message in st.session_state.messages:
         """,
                     unsafe_allow_html=True)
 
-# Chat input
-prompt = st.chat_input("💬 مرحباً! اكتب سؤالك أو استفسارك هنا...")
+prompt = typed_prompt or voice_prompt
 
 if prompt:
-    timestamp = datetime.now().isoformat()
-    analysis = {
-        "intent": "question",
-        "sentiment": "neutral",
-        "topic": "general",
-        "complexity": "moderate",
-        "keywords": []
-    }
-
-    user_message = {
-        "role": "user",
-        "content": prompt,
-        "timestamp": timestamp,
-        "analysis": analysis
-    }
-    st.session_state.messages.append(user_message)
-
-    # Display user message
-    st.markdown(f"""
-    <div style="background: linear-gradient(135deg, #f8f9fa 0%, #e9ecef 100%); padding: 1.2rem; border-radius: 15px; margin: 1rem 0; border-left: 4px solid #000000; box-shadow: 0 2px 10px rgba(0,0,0,0.05);">
-        <div style="display: flex; align-items: center; gap: 10px; margin-bottom: 8px;">
-            <span style="background: #000000; color: white; padding: 6px 10px; border-radius: 50%; font-size: 14px;">👤</span>
-            <strong style="color: #000000; font-weight: 600;">أنت</strong>
-        </div>
-<div style="color: #333333; padding-right: 40px; line-height: 1.6; text-align: right; direction: rtl;">
-  {prompt}
-</div>
+    turn = profiling.start_turn(st.session_state.get("profile", False),
+                                st.session_state.conversation_id)
+    # Streamlit's rerun and stop exceptions skip except clauses, not finally
+    try:
+        timestamp = datetime.now().isoformat()
+        # Server-side voice transcripts get a real analysis, started while the
+        # customer was still speaking
+        analysis = (pop_voice_analysis(prompt) if prompt == voice_prompt else None) or {
+            "intent": "question",
+            "sentiment": "neutral",
+            "topic": "general",
+            "complexity": "moderate",
+            "keywords": []
+        }
+        turn.mark("analysis")
+
+        user_message = {
+            "role": "user",
+            "content": prompt,
+            "timestamp": timestamp,
+            "analysis": analysis
+        }
+        st.session_state.messages.append(user_message)
+
+        # Display user message
+        st.markdown(f"""
+        <div style="background: linear-gradient(135deg, #f8f9fa 0%, #e9ecef 100%); padding: 1.2rem; border-radius: 15px; margin: 1rem 0; border-left: 4px solid #000000; box-shadow: 0 2px 10px rgba(0,0,0,0.05);">
+            <div style="display: flex; align-items: center; gap: 10px; margin-bottom: 8px;">
+                <span style="background: #000000; color: white; padding: 6px 10px; border-radius: 50%; font-size: 14px;">👤</span>
+                <strong style="color: #000000; font-weight: 600;">أنت</strong>
+            </div>
+    <div style="color: #333333; padding-right: 40px; line-height: 1.6; text-align: right; direction: rtl;">
+      {prompt}
     </div>
-    """,
-                unsafe_allow_html=True)
-
-    # Generate response
-    with st.spinner("🤔 جاري التفكير..."):
-        try:
-            context = st.session_state.memory.get_context()
-            response = st.session_state.chatbot.generate_response(
-                prompt, context=context, analysis=analysis)
-
-            st.markdown(f"""
-            <div style="background: linear-gradient(135deg, #ffffff 0%, #f8f9fa 100%); padding: 1.2rem; border-radius: 15px; margin: 1rem 0; border: 1px solid #e0e0e0; box-shadow: 0 4px 15px rgba(0,0,0,0.08);">
-                <div style="display: flex; align-items: center; gap: 10px; margin-bottom: 8px;">
-                    <span style="background: linear-gradient(45deg, #000000, #333333); color: white; padding: 6px 10px; border-radius: 50%; font-size: 14px;"><img width="30px" height="30px" style="border-radius: 50%;"src="https://img.freepik.com/free-vector/graident-ai-robot-vectorart_78370-4114.jpg?t=st=1756413685~exp=1756417285~hmac=afaa35dc6c3deea2251c284ed0897072d313414ce96e7d371fb8f1186030ff0c&w=1480"/></span>
-                    <strong style="color: #000000; font-weight: 600;">موسي</strong>
-                    <span style="background: #f0f0f0; color: #666; padding: 2px 8px; border-radius: 10px; font-size: 12px;">مساعد ذكي</span>
-                </div>
-              <div style="color: #333333; padding-right: 40px; line-height: 1.6; text-align: right; direction: rtl;">
-  {response}
-</div>
+        </div>
+        """,
+                    unsafe_allow_html=True)
+
+        # Generate response
+        with st.spinner("🤔 جاري التفكير..."):
+            try:
+                # Order tracking is answered locally from the conversation slots,
+                # with the order's status when an order service is configured
+                tools = get_tool_executor()
+                direct_reply = tracking_reply(
+                    prompt, st.session_state.memory.update_slots(prompt),
+                    st.session_state.chatbot.tenant.tracking_url,
+                    lookup=order_lookup(tools) if tools else None)
+                context = st.session_state.memory.get_context(query=prompt)
+                turn.mark("context")
+                prefetcher = get_prefetcher(st.session_state.chatbot.tenant.id)
+                prepared = None
+                if prefetcher is not None and not direct_reply:
+                    prepared = prefetcher.take(st.session_state.conversation_id, prompt)
+                if direct_reply:
+                    stream = speak_stream(iter([direct_reply]))
+                elif prepared:
+                    stream = speak_stream(iter([prepared]))
+                else:
+                    stream = speak_stream(charge_stream(
+                        st.session_state.conversation_id,
+                        st.session_state.chatbot.generate_response_stream(
+                            prompt, context=context, analysis=analysis)))
+
+                response_placeholder = st.empty()
+                response = ""
+                for chunk in stream:
+                    response += chunk
+                    response_placeholder.markdown(f"""
+                    <div style="background: linear-gradient(135deg, #ffffff 0%, #f8f9fa 100%); padding: 1.2rem; border-radius: 15px; margin: 1rem 0; border: 1px solid #e0e0e0; box-shadow: 0 4px 15px rgba(0,0,0,0.08);">
+                        <div style="display: flex; align-items: center; gap: 10px; margin-bottom: 8px;">
+                            <span style="background: linear-gradient(45deg, #000000, #333333); color: white; padding: 6px 10px; border-radius: 50%; font-size: 14px;">{avatar_badge(30)}</span>
+                            <strong style="color: #000000; font-weight: 600;">{tenant.persona}</strong>
+                            <span style="background: #f0f0f0; color: #666; padding: 2px 8px; border-radius: 10px; font-size: 12px;">مساعد ذكي</span>
+                        </div>
+                      <div style="color: #333333; padding-right: 40px; line-height: 1.6; text-align: right; direction: rtl;">
+          {response}
+        </div>
 
           
-            """,
-                        unsafe_allow_html=True)
-
-            assistant_message = {
-                "role": "assistant",
-                "content": response,
-                "timestamp": datetime.now().isoformat()
-            }
-            st.session_state.messages.append(assistant_message)
-            st.session_state.memory.add_interaction(
-                user_input=prompt,
-                assistant_response=response,
-                timestamp=timestamp,
-                analysis=analysis)
-        except Exception as e:
-            error_msg = f"عذراً، حدث خطأ: {str(e)}"
-            st.error(error_msg)
-            st.session_state.messages.append({
-                "role":
-                "assistant",
-                "content":
-                error_msg,
-                "timestamp":
-                datetime.now().isoformat()
-            })
+                    """,
+                                unsafe_allow_html=True)
+                response = response.strip()
+                turn.mark("generate_render")
+
+                assistant_message = {
+                    "role": "assistant",
+                    "content": response,
+                    "timestamp": datetime.now().isoformat()
+                }
+                st.session_state.messages.append(assistant_message)
+                st.session_state.memory.add_interaction(
+                    user_input=prompt,
+                    assistant_response=response,
+                    timestamp=timestamp,
+                    analysis=analysis)
+                # Answer the likely next question while this answer is being read
+                if prefetcher is not None:
+                    memory = st.session_state.memory
+                    prefetcher.schedule(st.session_state.conversation_id, prompt,
+                                        lambda question: memory.get_context(query=question))
+
+                # A thank-you closes the question for the cost-per-resolution report
+                ledger = get_ledger()
+                if ledger is not None and keyword_analysis(prompt)["intent"] == "compliment":
+                    ledger.mark_resolved(st.session_state.conversation_id)
+                turn.mark("persist")
+            except Exception as e:
+                error_msg = f"عذراً، حدث خطأ: {str(e)}"
+                st.error(error_msg)
+                st.session_state.messages.append({
+                    "role":
+                    "assistant",
+                    "content":
+                    error_msg,
+                    "timestamp":
+                    datetime.now().isoformat()
+                })
+    finally:
+        turn.finish()
 
 # Footer
-st.markdown("""
+st.markdown(f"""
 
   
     <p style="color: #999999; margin-top: 1.5rem; font-size: 0.85rem; font-weight: 500;">
-        مدعوم بتقنية الذكاء الاصطناعي • موسي المساعد الذكي • 3QRab © 2025
+        مدعوم بتقنية الذكاء الاصطناعي • {tenant.persona} المساعد الذكي • {tenant.store_name} © 2025
     </p>
 </div>
 """,
             unsafe_allow_html=True)
+
+startup.mark("page")
+startup.report()
@@ -0,0 +1,275 @@
+import os
+import json
+import zlib
+import struct
+import hashlib
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+from slots import extract_phones
+
+try:
+    import zstandard
+except ImportError:  # Optional dependency; archives fall back to zlib
+    zstandard = None
+
+# Index record: key hash, segment day (YYYYMMDD), offset, length, codec, dictionary id
+INDEX_RECORD = struct.Struct("<8sIQIBI")
+
+CODEC_ZLIB = 0
+CODEC_ZSTD = 1
+
+
+def _key_hash(key: str) -> bytes:
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+
+
+class ConversationArchive:
+    """Archive of finished conversations in daily compressed segments"""
+
+    def __init__(self, directory: str = "conversation_archive", level: int = 10):
+        """
+        Initialize the archive
+
+        Args:
+            directory: Directory holding segments, the index and dictionaries
+            level: Compression level
+        """
+        self.directory = directory
+        self.level = level
+        self.index_file = os.path.join(directory, "index.bin")
+        self._lock = threading.Lock()
+        self._dictionaries: Dict[int, Any] = {}
+        self._dict_id = 0
+        # Index entries by key hash, and how much of the index file they cover
+        self._index: Dict[bytes, List[tuple]] = {}
+        self._index_bytes = 0
+
+        os.makedirs(os.path.join(directory, "segments"), exist_ok=True)
+        self._load_dictionaries()
+
+    def archive_conversation(self, conversation_id: str, interactions: List[Dict[str, Any]]):
+        """
+        Append a conversation to today's segment and index it
+
+        Args:
+            conversation_id: Conversation identifier
+            interactions: Interactions leaving the live store
+        """
+        if not interactions:
+            return
+
+        phones = []
+        for interaction in interactions:
+            for phone in extract_phones(interaction.get("user_input", "")):
+                if phone not in phones:
+                    phones.append(phone)
+
+        record = {
+            "conversation_id": conversation_id,
+            "phones": phones,
+            "archived_at": datetime.now(timezone.utc).isoformat(),
+            "interactions": interactions
+        }
+        raw = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+        with self._lock:
+            codec, dict_id, payload = self._compress(raw)
+            day = int(datetime.now(timezone.utc).strftime("%Y%m%d"))
+            try:
+                with open(self._segment_path(day), "ab") as f:
+                    offset = f.tell()
+                    f.write(payload)
+                with open(self.index_file, "ab") as f:
+                    for key in [f"conv:{conversation_id}"] + [f"phone:{phone}" for phone in phones]:
+                        f.write(INDEX_RECORD.pack(_key_hash(key), day, offset, len(payload), codec, dict_id))
+            except OSError as e:
+                logging.error(f"Failed to archive conversation {conversation_id}: {str(e)}")
+
+    def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Retrieve an archived conversation
+
+        A conversation archived in several parts (e.g. turns dropped by
+        truncation, then the rest on clear) is stitched back together.
+
+        Args:
+            conversation_id: Conversation identifier
+
+        Returns:
+            The conversation record, or None if it was never archived
+        """
+        records = [self._read(entry) for entry in self._lookup(f"conv:{conversation_id}")]
+        records = [record for record in records if record]
+        if not records:
+            return None
+
+        merged = dict(records[-1])
+        merged["interactions"] = [i for record in records for i in record["interactions"]]
+        merged["phones"] = sorted({p for record in records for p in record.get("phones", [])})
+        return merged
+
+    def find_by_phone(self, phone: str) -> List[Dict[str, Any]]:
+        """
+        Retrieve every archived conversation mentioning a phone number
+
+        Args:
+            phone: Egyptian mobile number in any supported format
+
+        Returns:
+            Matching conversation records, oldest first
+        """
+        phones = extract_phones(phone)
+        if not phones:
+            return []
+        records = [self._read(entry) for entry in self._lookup(f"phone:{phones[0]}")]
+        return [record for record in records if record]
+
+    def train_dictionary(self, samples: Optional[Iterable[str]] = None, size: int = 16 * 1024) -> bool:
+        """
+        Train a zstd dictionary on bot replies and use it for new segments
+
+        Args:
+            samples: Texts to train on; defaults to the archived assistant responses
+            size: Dictionary size in bytes
+
+        Returns:
+            True if a dictionary was trained and activated
+        """
+        if zstandard is None:
+            logging.warning("zstandard is not installed; archive stays on zlib")
+            return False
+
+        if samples is None:
+            samples = self._archived_responses()
+        samples = [text.encode("utf-8") for text in samples if text]
+        if len(samples) < 10:
+            logging.warning("Not enough samples to train an archive dictionary")
+            return False
+
+        try:
+            dictionary = zstandard.train_dictionary(size, samples)
+        except zstandard.ZstdError as e:
+            logging.error(f"Failed to train archive dictionary: {str(e)}")
+            return False
+
+        dict_id = dictionary.dict_id()
+        with open(os.path.join(self.directory, f"dict-{dict_id}.zdict"), "wb") as f:
+            f.write(dictionary.as_bytes())
+        with self._lock:
+            self._dictionaries[dict_id] = dictionary
+            self._dict_id = dict_id
+        return True
+
+    def _segment_path(self, day: int) -> str:
+        return os.path.join(self.directory, "segments", f"{day}.seg")
+
+    def _load_dictionaries(self):
+        """Load all dictionaries; the newest one is used for writing"""
+        if zstandard is None:
+            return
+        newest = None
+        for name in os.listdir(self.directory):
+            if name.startswith("dict-") and name.endswith(".zdict"):
+                path = os.path.join(self.directory, name)
+                with open(path, "rb") as f:
+                    dictionary = zstandard.ZstdCompressionDict(f.read())
+                self._dictionaries[dictionary.dict_id()] = dictionary
+                mtime = os.path.getmtime(path)
+                if newest is None or mtime > newest[0]:
+                    newest = (mtime, dictionary.dict_id())
+        if newest:
+            self._dict_id = newest[1]
+
+    def _compress(self, raw: bytes):
+        if zstandard is None:
+            return CODEC_ZLIB, 0, zlib.compress(raw, min(self.level, 9))
+        dictionary = self._dictionaries.get(self._dict_id)
+        compressor = zstandard.ZstdCompressor(level=self.level, dict_data=dictionary)
+        return CODEC_ZSTD, self._dict_id if dictionary else 0, compressor.compress(raw)
+
+    def _decompress(self, codec: int, dict_id: int, payload: bytes) -> bytes:
+        if codec == CODEC_ZLIB:
+            return zlib.decompress(payload)
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read this archive segment")
+        dictionary = self._dictionaries.get(dict_id) if dict_id else None
+        return zstandard.ZstdDecompressor(dict_data=dictionary).decompress(payload)
+
+    def _lookup(self, key: str) -> List[tuple]:
+        """Find index entries for a key in the in-memory index"""
+        with self._lock:
+            self._refresh_index()
+            return list(self._index.get(_key_hash(key), ()))
+
+    def _refresh_index(self):
+        """Load index records appended since the last lookup; lock held"""
+        try:
+            size = os.path.getsize(self.index_file)
+        except OSError:
+            size = 0
+        size -= size % INDEX_RECORD.size
+        if size < self._index_bytes:
+            # The index was replaced; start over
+            self._index = {}
+            self._index_bytes = 0
+        if size == self._index_bytes:
+            return
+
+        with open(self.index_file, "rb") as f:
+            f.seek(self._index_bytes)
+            data = f.read(size - self._index_bytes)
+        data = data[:len(data) - len(data) % INDEX_RECORD.size]
+        for entry in INDEX_RECORD.iter_unpack(data):
+            self._index.setdefault(entry[0], []).append(entry)
+        self._index_bytes += len(data)
+
+    def _read(self, entry: tuple) -> Optional[Dict[str, Any]]:
+        """Read one record: a single seek and decompress"""
+        _, day, offset, length, codec, dict_id = entry
+        try:
+            with open(self._segment_path(day), "rb") as f:
+                f.seek(offset)
+                payload = f.read(length)
+            return json.loads(self._decompress(codec, dict_id, payload))
+        except Exception as e:
+            logging.error(f"Failed to read archived conversation: {str(e)}")
+            return None
+
+    def _archived_responses(self) -> List[str]:
+        """Collect assistant responses from the archived segments"""
+        responses = []
+        seen = set()
+        if not os.path.exists(self.index_file):
+            return responses
+        with open(self.index_file, "rb") as f:
+            data = f.read()
+        for entry in INDEX_RECORD.iter_unpack(data[:len(data) - len(data) % INDEX_RECORD.size]):
+            location = entry[1:3]
+            if location in seen:
+                continue
+            seen.add(location)
+            record = self._read(entry)
+            if record:
+                responses.extend(i.get("assistant_response", "") for i in record["interactions"])
+        return responses
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Conversation archive maintenance")
+    parser.add_argument("command", choices=["train", "get", "phone"])
+    parser.add_argument("value", nargs="?", help="Conversation id or phone number")
+    parser.add_argument("--directory", default="conversation_archive")
+    args = parser.parse_args()
+
+    conversation_archive = ConversationArchive(args.directory)
+    if args.command == "train":
+        print("Dictionary trained" if conversation_archive.train_dictionary() else "Dictionary not trained")
+    elif args.command == "get":
+        print(json.dumps(conversation_archive.get(args.value), ensure_ascii=False, indent=2))
+    else:
+        print(json.dumps(conversation_archive.find_by_phone(args.value), ensure_ascii=False, indent=2))
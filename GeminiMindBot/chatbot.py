@@ -1,56 +1,63 @@
-import os
-from google import genai
-from google.genai import types
-import json
+import hashlib
+import contextvars
 import logging
-from typing import Optional
+import threading
+from typing import Dict, Iterator, Optional
+
+from gemini_client import (get_client, create_cached_content, usage_from_response, is_unavailable_error,
+                           OverflowClient)
+from single_flight import shared_flight, request_key
+from ledger import record_usage
+from tenants import get_tenant, add_reload_listener
+from response_cache import shared_response_cache
+from tools import get_tool_executor
+from admission import shared_admission, AdmissionRejected, PRIORITY_CHAT, PRIORITY_ANALYSIS
+
+# Seconds a chat request may wait for an upstream slot before falling back
+CHAT_QUEUE_TIMEOUT = 8.0
+
+# Model turns that may call tools before the answer has to come
+MAX_TOOL_ROUNDS = 2
+
+# Passed along a shared stream when an answer used live lookups, so it is not cached
+_TOOLS_USED = object()
 
 class ChatBot:
     """Main chatbot class that handles interactions with Gemini API"""
     
-    def __init__(self):
-        """Initialize the chatbot with Gemini API client"""
-        api_key = os.environ.get("GEMINI_API_KEY", "")
-        if not api_key:
-            raise ValueError("GEMINI_API_KEY environment variable is required")
+    def __init__(self, client=None, tenant=None, tools=None):
+        """
+        Initialize the chatbot with Gemini API client
         
-        self.client = genai.Client(api_key=api_key)
-        self.model_name = "gemini-2.5-flash"
+        Args:
+            client: Gemini client to use (defaults to the shared client of the chat backend)
+            tenant: TenantProfile of the store to answer for (defaults to the default store)
+            tools: ToolExecutor for order and stock lookups (defaults to the one
+                configured by ORDER_SERVICE, if any)
+        """
+        self.client = client or get_client("chat")
+        self.tenant = tenant or get_tenant()
+        self.tools = tools if tools is not None else get_tool_executor()
+        self.model_name = self.tenant.chat_model
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Whether warmup asked for the instruction to be cached upstream
+        self._use_cached_content = False
         
-        # System instruction for the chatbot
-        self.system_instruction = (
-            "أنت مساعد ذكي لمتجر 3QRab، واسمك موسى "
-            "تتحدث بشخصية ودودة ومتحمسة للتكنولوجيا. "
-            
-            "عن موسي (المساعد الذكي):\n"
-            "• شخصيته: ودود، صبور، يحب مساعدة العملاء بوضوح وسهولة\n"
-            "• شغفه: متخصص في خدمة العملاء ومساعدتهم في كل احتياجاتهم\n"
-            "• مهارته: خبير في منتجات المتجر وسياسات الخدمة\n"
-            "• رؤيته: تقديم تجربة تسوق سهلة وممتعة لكل عميل\n"
-            "• أسلوبه: يستمع جيداً، يرد بسرعة، يقدم حلول عملية\n"
-            
-            "معلومات المتجر:\n"
-            "• المنتجات: ساعة كربون أسود بـ 400 جنيه مصري\n"
-            "• الدفع: نقداً عند الاستلام\n"
-            "• الشحن: حسب العنوان ، التوصيل 3-4 أيام\n"
-            "• الإرجاع: 7 أيام للاستبدال، 3 أيام لاسترداد المبلغ\n"
-            "• التواصل: 01026897739 أو ehab.hussein.dev@gmail.com\n"
-            "• انت مينفعش تعمل اوردر لي العميل\n"
-
-            "كيف ترد (بشخصية موسي):\n"
-            "1. اسأل عن اسم العميل بودية: 'أهلاً بك! أنا موسي مساعد المتجر، ممكن أعرف اسمك؟'\n"
-            "2. استخدم اسم العميل واجعله يشعر بالترحيب الشخصي\n"
-            "3. أضف لمسة شخصية: 'يسعدني أن أساعدك!' أو 'كوني جزء من عائلة 3QRab!'\n"
-            "4. اربط بشغف التكنولوجيا عند المناسب: 'أحب تجربة تقنيات AI جديدة لخدمتك!'\n"
-            "5. لتتبع الطلبات: 'أهلاً [الاسم]! يمكنك تتبع طلبك: https://3qrab.netlify.app/track-order?phone=0100000000'\n"
-            "6. كن صبوراً ومتفهماً واستمع لاحتياجات العميل\n"
-            "7. قدم تجربة شخصية فريدة لكل عميل\n"
-            "8. حاول تبيع المنتج بطرق ذكيه كتاجر يفهم\n"
-            "9. اختصر الاجابات واذكر  المفيد للسؤال فقط\n"
-            "تحدث بروح موسي المتحمسة والودودة دائماً! ⌚"
-        )
+        # Tenant version, compiled instruction and its cached content, swapped as one
+        self._prompt = (self.tenant.version, self.tenant.system_instruction(), None)
+        shared_response_cache.set_quota(self.tenant.id, self.tenant.cache_quota_bytes)
+    
+    @property
+    def system_instruction(self) -> str:
+        return self._prompt[1]
     
-    def generate_response(self, user_input: str, context: str = "", analysis: Optional[dict] = None) -> str:
+    @property
+    def cached_content(self) -> Optional[str]:
+        return self._prompt[2]
+    
+    def generate_response(self, user_input: str, context: str = "", analysis: Optional[dict] = None,
+                          route: str = "chat", priority: int = PRIORITY_CHAT) -> str:
         """
         Generate a response using Gemini API with conversation context
         
@@ -58,50 +65,319 @@ class ChatBot:
             user_input: The user's current message
             context: Previous conversation context from memory
             analysis: Question analysis data
+            route: Ledger route the call is billed to
+            priority: Admission priority of the upstream call
             
         Returns:
             Generated response from the AI
         """
+        from google.genai import types
+        
+        self._local.usage = {}
+        full_prompt = None
         try:
-            # Prepare the prompt with context and analysis
-            prompt_parts = []
-            
-            if context:
-                prompt_parts.append(f"Previous conversation context:\n{context}\n")
+            tenant = self._current_tenant()
+            key = self._request_key(user_input, context, analysis)
+            # Only answers that do not depend on the conversation are reused
+            if not context:
+                cached = shared_response_cache.get(tenant.id, key)
+                if cached is not None:
+                    return cached
+            full_prompt = self._build_prompt(user_input, context, analysis)
             
-            if analysis:
-                analysis_text = self._format_analysis(analysis)
-                prompt_parts.append(f"Question analysis:\n{analysis_text}\n")
-            
-            prompt_parts.append(f"Current user message: {user_input}")
-            
-            full_prompt = "\n".join(prompt_parts)
-            
-            # Generate response using Gemini
-            response = self.client.models.generate_content(
-                model=self.model_name,
-                contents=[
+            def generate():
+                contents = [
                     types.Content(
                         role="user", 
                         parts=[types.Part(text=full_prompt)]
                     )
-                ],
-                config=types.GenerateContentConfig(
-                    system_instruction=self.system_instruction,
-                    temperature=0.7,
-                    max_output_tokens=1000
-                )
-            )
+                ]
+                used_tools = False
+                for round_number in range(MAX_TOOL_ROUNDS + 1):
+                    with shared_admission.admit(priority, CHAT_QUEUE_TIMEOUT):
+                        response = self.client.models.generate_content(
+                            model=self.model_name,
+                            contents=contents,
+                            config=self._generation_config(final=round_number == MAX_TOOL_ROUNDS)
+                        )
+                    self._add_usage(usage_from_response(response), route)
+                    calls = self._function_call_parts(response)
+                    if not calls:
+                        break
+                    # The upstream slot is not held while the lookups run
+                    used_tools = True
+                    contents.extend(self._run_tools(calls))
+                return response.text, used_tools
             
-            if response.text:
-                return response.text.strip()
+            # Identical requests already in flight share one Gemini call
+            text, used_tools = shared_flight.do(key, generate)
+            
+            if text:
+                # Answers built from live lookups go stale quickly
+                if not context and not used_tools:
+                    self._cache_response(tenant, key, text.strip())
+                return text.strip()
             else:
                 return "I apologize, but I couldn't generate a response. Please try again."
                 
         except Exception as e:
+            if isinstance(e, AdmissionRejected) or is_unavailable_error(e):
+                return self._unavailable_response(full_prompt, analysis, e)
             logging.error(f"Error generating response: {str(e)}")
             return f"I encountered an error while processing your request: {str(e)}"
     
+    def generate_response_stream(self, user_input: str, context: str = "",
+                                 analysis: Optional[dict] = None) -> Iterator[str]:
+        """
+        Generate a response as a stream of text chunks
+        
+        Args:
+            user_input: The user's current message
+            context: Previous conversation context from memory
+            analysis: Question analysis data
+            
+        Yields:
+            Text chunks as they arrive from Gemini
+        """
+        from google.genai import types
+        
+        self._local.usage = {}
+        full_prompt = None
+        chunks = []
+        try:
+            tenant = self._current_tenant()
+            key = self._request_key(user_input, context, analysis)
+            if not context:
+                cached = shared_response_cache.get(tenant.id, key)
+                if cached is not None:
+                    yield cached
+                    return
+            full_prompt = self._build_prompt(user_input, context, analysis)
+            
+            def start_stream():
+                # Runs in the caller that starts the shared call, which is charged
+                # for it; any caller may read the chunks that carry the usage
+                charge = contextvars.copy_context()
+                return pump(charge, self._local.usage)
+            
+            def pump(charge, totals):
+                contents = [
+                    types.Content(
+                        role="user",
+                        parts=[types.Part(text=full_prompt)]
+                    )
+                ]
+                for round_number in range(MAX_TOOL_ROUNDS + 1):
+                    calls = []
+                    config = self._generation_config(final=round_number == MAX_TOOL_ROUNDS)
+                    # The upstream slot is returned when Gemini finishes, not when the page does
+                    stream = shared_admission.stream(
+                        PRIORITY_CHAT, CHAT_QUEUE_TIMEOUT,
+                        lambda: self.client.models.generate_content_stream(
+                            model=self.model_name,
+                            contents=contents,
+                            config=config
+                        )
+                    )
+                    last_chunk = None
+                    for chunk in stream:
+                        last_chunk = chunk
+                        chunk_calls = self._function_call_parts(chunk)
+                        if chunk_calls:
+                            calls.extend(chunk_calls)
+                        elif chunk.text:
+                            yield chunk.text
+                    # Usage metadata is complete on the final chunk
+                    charge.run(self._add_usage, usage_from_response(last_chunk), "chat", totals)
+                    if not calls:
+                        return
+                    yield _TOOLS_USED
+                    contents.extend(self._run_tools(calls))
+            
+            # Identical requests already in flight share one Gemini stream
+            used_tools = False
+            for text in shared_flight.stream(key, start_stream):
+                if text is _TOOLS_USED:
+                    used_tools = True
+                    continue
+                chunks.append(text)
+                yield text
+            
+            if chunks and not context and not used_tools:
+                self._cache_response(tenant, key, "".join(chunks).strip())
+            if not chunks:
+                yield "I apologize, but I couldn't generate a response. Please try again."
+                
+        except Exception as e:
+            if isinstance(e, AdmissionRejected) or is_unavailable_error(e):
+                if chunks:
+                    # The customer already has part of the answer; don't append another one
+                    logging.warning(f"Chat stream cut off upstream: {str(e)}")
+                    return
+                yield self._unavailable_response(full_prompt, analysis, e)
+                return
+            logging.error(f"Error streaming response: {str(e)}")
+            yield f"I encountered an error while processing your request: {str(e)}"
+    
+    @property
+    def last_usage(self) -> Dict[str, int]:
+        """
+        Token usage of the last response generated by the current thread
+        
+        A call shared by identical concurrent requests is charged once, to
+        the request that started it; the others report no usage.
+        """
+        return getattr(self._local, "usage", {})
+    
+    def _add_usage(self, usage: Dict[str, int], route: str = "chat",
+                   totals: Optional[Dict[str, int]] = None):
+        """Record one upstream call and add it to a turn's usage, the current thread's by default"""
+        record_usage(route, self.model_name, usage)
+        totals = self._local.usage if totals is None else totals
+        for name, count in usage.items():
+            totals[name] = totals.get(name, 0) + count
+    
+    def _function_call_parts(self, response) -> list:
+        """Parts of a response that call tools, kept whole so signatures go back to the model"""
+        if not self.tools or not getattr(response, "function_calls", None):
+            return []
+        from google.genai import types
+        
+        candidates = getattr(response, "candidates", None) or []
+        content = candidates[0].content if candidates else None
+        if content is not None and content.parts:
+            return [part for part in content.parts if part.function_call]
+        return [types.Part(function_call=call) for call in response.function_calls]
+    
+    def _run_tools(self, calls: list) -> list:
+        """
+        Run the tools a model turn asked for
+        
+        Args:
+            calls: Parts holding the function calls
+            
+        Returns:
+            The model turn and the tool results, to append to the contents
+        """
+        from google.genai import types
+        
+        requests = [(part.function_call.name, dict(part.function_call.args or {})) for part in calls]
+        results = self.tools.execute(requests)
+        return [
+            types.Content(role="model", parts=calls),
+            types.Content(role="user", parts=[
+                types.Part.from_function_response(name=name, response=result)
+                for (name, _), result in zip(requests, results)
+            ])
+        ]
+    
+    def _current_tenant(self):
+        """Pick up a reloaded profile of this bot's tenant, if there is one"""
+        latest = get_tenant(self.tenant.id)
+        if latest.id != self.tenant.id or latest is self.tenant:
+            return self.tenant
+        if latest.version != self.tenant.version:
+            self._swap_tenant(latest)
+        else:
+            # Only fields answers don't depend on changed; the cached content stays valid
+            self.tenant = latest
+        return self.tenant
+    
+    def _swap_tenant(self, latest):
+        """Switch to a new tenant version and re-create its cached content"""
+        with self._lock:
+            if self.tenant.version == latest.version:
+                return
+            old_cache = self.cached_content
+            self.tenant = latest
+            self.model_name = latest.chat_model
+            # Until the new cache exists the instruction is sent inline
+            self._prompt = (latest.version, latest.system_instruction(), None)
+            shared_response_cache.set_quota(latest.id, latest.cache_quota_bytes)
+            recreate = self._use_cached_content
+        
+        if recreate:
+            threading.Thread(target=self._create_cached_content, args=(latest.version, old_cache),
+                             name="gemini-cache-refresh", daemon=True).start()
+    
+    def _create_cached_content(self, version: int, old_cache: Optional[str] = None):
+        """Cache the instruction of a tenant version, unless a newer one arrived meanwhile"""
+        version_seen, instruction, _ = self._prompt
+        if version_seen != version:
+            return
+        name = create_cached_content(self.client, self.model_name, instruction,
+                                     tools=self.tools.declarations() if self.tools else None)
+        with self._lock:
+            if self._prompt[0] == version:
+                self._prompt = (version, instruction, name)
+        if old_cache:
+            try:
+                self.client.caches.delete(name=old_cache)
+            except Exception as e:
+                logging.info(f"Old cached content not deleted: {str(e)}")
+    
+    def _cache_response(self, tenant, key: str, text: str):
+        """Keep an answer unless the store knowledge changed meanwhile"""
+        if get_tenant(tenant.id).version != tenant.version:
+            return
+        shared_response_cache.put(tenant.id, key, text)
+    
+    def _build_prompt(self, user_input: str, context: str = "", analysis: Optional[dict] = None) -> str:
+        """Prepare the prompt with context and analysis"""
+        prompt_parts = []
+        
+        if context:
+            prompt_parts.append(f"Previous conversation context:\n{context}\n")
+        
+        if analysis:
+            analysis_text = self._format_analysis(analysis)
+            prompt_parts.append(f"Question analysis:\n{analysis_text}\n")
+        
+        prompt_parts.append(f"Current user message: {user_input}")
+        
+        return "\n".join(prompt_parts)
+    
+    def _request_key(self, user_input: str, context: str, analysis: Optional[dict]) -> str:
+        """Key under which identical in-flight requests are coalesced"""
+        context_hash = hashlib.sha256(context.encode("utf-8")).hexdigest() if context else ""
+        return request_key("chat", self.tenant.id, self.model_name, user_input, context_hash, analysis or {})
+    
+    def _generation_config(self, final: bool = False):
+        """
+        Build the generation config shared by blocking and streaming calls
+        
+        Args:
+            final: Whether this is the last model turn of the tool loop, which
+                must answer in text because no further tool results go back
+        """
+        from google.genai import types
+        
+        if final and self.tools:
+            # A cached-content request can't carry a tool config, so the last
+            # round sends the instruction inline with function calling off
+            return types.GenerateContentConfig(
+                system_instruction=self.system_instruction,
+                tools=self.tools.declarations(),
+                tool_config=types.ToolConfig(
+                    function_calling_config=types.FunctionCallingConfig(mode="NONE")
+                ),
+                temperature=0.7,
+                max_output_tokens=1000
+            )
+        if self.cached_content:
+            # Tools, like the instruction, are part of the cached content
+            return types.GenerateContentConfig(
+                cached_content=self.cached_content,
+                temperature=0.7,
+                max_output_tokens=1000
+            )
+        return types.GenerateContentConfig(
+            system_instruction=self.system_instruction,
+            tools=self.tools.declarations() if self.tools else None,
+            temperature=0.7,
+            max_output_tokens=1000
+        )
+    
     def _format_analysis(self, analysis: dict) -> str:
         """Format the question analysis for inclusion in the prompt"""
         if not analysis:
@@ -113,14 +389,96 @@ class ChatBot:
         
         return "\n".join(formatted)
     
-    def test_connection(self) -> bool:
-        """Test if the Gemini API connection is working"""
+    def _fallback_response(self, analysis: Optional[dict] = None) -> str:
+        """
+        Answer locally when the API is saturated
+        
+        Args:
+            analysis: Question analysis data
+            
+        Returns:
+            Short reply built from the tenant's facts for the detected topic
+        """
+        topic = (analysis or {}).get("topic", "general")
+        return self.tenant.fallback_response(topic)
+    
+    def _unavailable_response(self, prompt: Optional[str], analysis: Optional[dict],
+                              error: Exception) -> str:
+        """
+        Answer locally when the API could not be used for a request
+        
+        Args:
+            prompt: Prompt built for the API call, if it got that far
+            analysis: Question analysis data
+            error: AdmissionRejected, or an error meaning the API is throttled or down
+            
+        Returns:
+            The overflow model's answer, or the tenant's short fallback reply
+        """
+        overflow = self._overflow_response(prompt) if prompt else None
+        if overflow:
+            logging.warning(f"Chat API unavailable, answering locally: {str(error)}")
+            return overflow
+        logging.warning(f"Chat API unavailable, using fallback: {str(error)}")
+        return self._fallback_response(analysis)
+    
+    def _overflow_response(self, prompt: str) -> Optional[str]:
+        """
+        Answer from the local model when the API quota leaves no upstream slot
+        
+        Args:
+            prompt: Prompt built for the API call
+            
+        Returns:
+            The local answer, or None without an overflow backend or if it failed
+        """
+        if not isinstance(self.client, OverflowClient):
+            return None
         try:
-            response = self.client.models.generate_content(
+            response = self.client.fallback.models.generate_content(
                 model=self.model_name,
-                contents="Hello, this is a test message."
+                contents=prompt,
+                config=self.client.local_config(self._generation_config())
             )
+            return (response.text or "").strip() or None
+        except Exception as e:
+            logging.error(f"Local overflow answer failed: {str(e)}")
+            return None
+    
+    def test_connection(self) -> bool:
+        """Test if the Gemini API connection is working"""
+        try:
+            with shared_admission.admit(PRIORITY_ANALYSIS, CHAT_QUEUE_TIMEOUT):
+                response = self.client.models.generate_content(
+                    model=self.model_name,
+                    contents="Hello, this is a test message."
+                )
             return bool(response.text)
         except Exception as e:
             logging.error(f"API connection test failed: {str(e)}")
             return False
+    
+    def warmup(self):
+        """
+        Prepare the API path before the first customer message
+        
+        Opens the connection (DNS, TLS) with a cheap metadata call and tries
+        to cache the system instruction. Meant to run in a background thread.
+        """
+        try:
+            self.client.models.get(model=self.model_name)
+        except Exception as e:
+            logging.error(f"Warmup request failed: {str(e)}")
+            return
+        
+        self._use_cached_content = True
+        self._create_cached_content(self._prompt[0])
+
+
+def _invalidate_responses(tenant_id: str):
+    """Drop the cached answers a knowledge reload made stale"""
+    dropped = shared_response_cache.invalidate(tenant_id)
+    logging.info(f"Dropped {dropped} cached answers of {tenant_id} after reload")
+
+
+add_reload_listener(_invalidate_responses)
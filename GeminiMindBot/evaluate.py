@@ -0,0 +1,234 @@
+"""
+Bulk evaluation of a question corpus through the analyzer and chatbot
+
+Usage:
+    python evaluate.py questions.csv --output answers.jsonl --workers 16
+    GEMINI_BACKEND=local python evaluate.py questions.jsonl -o answers.jsonl
+
+Input rows need a "question" column/field and may have an "id" and a
+"thread_id"; rows sharing a thread_id are asked in order as one
+conversation. Results are appended to the output as JSON lines while the
+run progresses, so an interrupted run resumes where it stopped.
+
+Upstream calls still go through the admission controller; raise
+GEMINI_RPM to the project's real quota for large runs.
+"""
+import os
+import csv
+import json
+import time
+import asyncio
+import logging
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from chatbot import ChatBot
+from analyzer import QuestionAnalyzer
+from memory import ConversationMemory
+from ledger import conversation
+
+
+def load_questions(path: str) -> List[Dict[str, Any]]:
+    """
+    Read questions from a CSV or JSONL file
+
+    Args:
+        path: Input file; the format is chosen by extension
+
+    Returns:
+        Rows with id, thread_id and question
+    """
+    rows = []
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            records = list(csv.DictReader(f))
+        else:
+            records = [json.loads(line) for line in f if line.strip()]
+
+    for number, record in enumerate(records, start=1):
+        question = (record.get("question") or "").strip()
+        if not question:
+            continue
+        row_id = str(record["id"]) if record.get("id") not in (None, "") else str(number)
+        thread_id = record.get("thread_id")
+        rows.append({
+            "id": row_id,
+            "thread_id": str(thread_id) if thread_id not in (None, "") else row_id,
+            "question": question
+        })
+    return rows
+
+
+def load_completed(path: str) -> Dict[str, Dict[str, Any]]:
+    """Read the results of a previous run of the same output file"""
+    completed = {}
+    if not os.path.exists(path):
+        return completed
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # A run killed mid-write leaves a partial last line
+                continue
+            completed[result["id"]] = result
+    return completed
+
+
+class Evaluator:
+    """Runs conversation threads through the analyzer and chatbot"""
+
+    def __init__(self, output_path: str, workers: int = 8, analyze: bool = True):
+        """
+        Initialize the evaluator
+
+        Args:
+            output_path: JSONL file results are appended to
+            workers: Maximum number of threads evaluated concurrently
+            analyze: Whether to run QuestionAnalyzer before each answer
+        """
+        self.output_path = output_path
+        self.workers = workers
+        self.analyze = analyze
+        self.chatbot = ChatBot()
+        self.analyzer = QuestionAnalyzer() if analyze else None
+        self._output = None
+        self._done = 0
+        self._total = 0
+
+    async def run(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Evaluate all rows, skipping those already in the output
+
+        Args:
+            rows: Rows from load_questions
+
+        Returns:
+            Results of every row, including ones from a previous run
+        """
+        completed = load_completed(self.output_path)
+        threads: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        for row in rows:
+            threads.setdefault(row["thread_id"], []).append(row)
+
+        self._total = len(rows)
+        self._done = sum(1 for row in rows if row["id"] in completed)
+        if self._done:
+            logging.info(f"Resuming: {self._done} of {self._total} questions already done")
+
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.workers))
+        semaphore = asyncio.Semaphore(self.workers)
+
+        with open(self.output_path, "a", encoding="utf-8") as self._output:
+            results = await asyncio.gather(*(
+                self._run_thread(thread, completed, semaphore) for thread in threads.values()
+            ))
+        return [result for thread_results in results for result in thread_results]
+
+    async def _run_thread(self, thread: List[Dict[str, Any]], completed: Dict[str, Dict[str, Any]],
+                          semaphore: asyncio.Semaphore) -> List[Dict[str, Any]]:
+        """Ask the questions of one conversation in order"""
+        memory = ConversationMemory(conversation_id=thread[0]["thread_id"], memory_file=None)
+        results = []
+
+        async with semaphore:
+            for row in thread:
+                result = completed.get(row["id"])
+                if result is None:
+                    result = await asyncio.to_thread(self._run_turn, row, memory.get_context(query=row["question"]))
+                    self._write(result)
+                # Replay finished turns too, so resumed threads keep their context
+                memory.add_interaction(row["question"], result["answer"],
+                                       result["timestamp"], result["analysis"])
+                results.append(result)
+        return results
+
+    def _run_turn(self, row: Dict[str, Any], context: str) -> Dict[str, Any]:
+        """Analyze and answer one question; runs on a worker thread"""
+        with conversation(row["thread_id"]):
+            started = time.perf_counter()
+            analysis = {}
+            analysis_usage = {}
+            if self.analyzer:
+                analysis = self.analyzer.analyze_question(row["question"])
+                analysis_usage = self.analyzer.last_usage
+            analyzed = time.perf_counter()
+
+            answer = self.chatbot.generate_response(row["question"], context=context, analysis=analysis)
+            finished = time.perf_counter()
+
+        return {
+            "id": row["id"],
+            "thread_id": row["thread_id"],
+            "question": row["question"],
+            "answer": answer,
+            "analysis": analysis,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "latency_ms": {
+                "analysis": round((analyzed - started) * 1000, 1),
+                "generation": round((finished - analyzed) * 1000, 1),
+                "total": round((finished - started) * 1000, 1)
+            },
+            "usage": {
+                "analysis": analysis_usage,
+                "chat": self.chatbot.last_usage
+            }
+        }
+
+    def _write(self, result: Dict[str, Any]):
+        """Append one result and flush it, which is the checkpoint"""
+        self._output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        self._output.flush()
+        self._done += 1
+        if self._done % 50 == 0 or self._done == self._total:
+            logging.info(f"{self._done}/{self._total} questions evaluated")
+
+
+def summarize(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Aggregate latency percentiles and token usage over a run"""
+    if not results:
+        return {"questions": 0}
+
+    latencies = sorted(result["latency_ms"]["total"] for result in results)
+
+    def percentile(share: float) -> float:
+        return latencies[min(len(latencies) - 1, int(share * len(latencies)))]
+
+    tokens: Dict[str, int] = {}
+    for result in results:
+        for usage in result.get("usage", {}).values():
+            for name, count in usage.items():
+                tokens[name] = tokens.get(name, 0) + count
+
+    return {
+        "questions": len(results),
+        "latency_ms": {"p50": percentile(0.5), "p95": percentile(0.95), "max": latencies[-1]},
+        "tokens": tokens
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a question corpus through the chatbot")
+    parser.add_argument("input", help="CSV or JSONL file with a question column")
+    parser.add_argument("-o", "--output", required=True, help="JSONL file for results (resumable)")
+    parser.add_argument("-w", "--workers", type=int, default=8, help="Concurrent conversations")
+    parser.add_argument("--no-analysis", action="store_true", help="Skip QuestionAnalyzer")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    rows = load_questions(args.input)
+    evaluator = Evaluator(args.output, workers=args.workers, analyze=not args.no_analysis)
+
+    started = time.perf_counter()
+    results = asyncio.run(evaluator.run(rows))
+    summary = summarize(results)
+    summary["wall_seconds"] = round(time.perf_counter() - started, 1)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+import os
+import time
+import logging
+import threading
+from typing import Any, Dict, Iterator, Optional
+
+from admission import is_rate_limit_error
+
+# Backends a role can use: the Gemini API, the offline stand-in, a local
+# llama.cpp model, or the API with the local model taking its overflow
+BACKENDS = ("gemini", "local", "llama", "overflow")
+
+# Seconds calls skip the API after it was throttled or unreachable
+OVERFLOW_COOLDOWN = float(os.environ.get("OVERFLOW_COOLDOWN", "30"))
+
+_clients: Dict[str, Any] = {}
+_client_lock = threading.Lock()
+_preloading = False
+
+
+def backend_for(role: str = "chat") -> str:
+    """
+    Backend configured for a role
+
+    CHAT_BACKEND and ANALYSIS_BACKEND pick the backend per role;
+    GEMINI_BACKEND applies to roles without their own setting.
+
+    Args:
+        role: "chat" or "analysis"
+
+    Returns:
+        One of BACKENDS
+    """
+    backend = os.environ.get(f"{role.upper()}_BACKEND") or os.environ.get("GEMINI_BACKEND") or "gemini"
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected one of {', '.join(BACKENDS)}")
+    return backend
+
+
+def get_client(role: str = "chat"):
+    """
+    Get the process-wide client of a role's backend, importing it on first use
+
+    The SDK is slow to import, so nothing imports it at module level; the
+    first caller pays for it once and every session shares the client and
+    its connection pool afterwards. GEMINI_BACKEND=local swaps in the
+    offline stand-in from local_gemini; see backend_for for the others.
+
+    Args:
+        role: "chat" or "analysis"
+
+    Returns:
+        genai.Client or a client with the same generate_content calls
+    """
+    backend = backend_for(role)
+    client = _clients.get(backend)
+    if client is not None:
+        return client
+
+    with _client_lock:
+        if backend not in _clients:
+            _clients[backend] = _create_client(backend)
+        return _clients[backend]
+
+
+def _create_client(backend: str):
+    """Build the client of a backend; the client lock is held"""
+    if backend == "local":
+        from local_gemini import LocalGeminiClient
+        return LocalGeminiClient()
+
+    if backend == "llama":
+        from llama_backend import LlamaCppClient
+        return LlamaCppClient()
+
+    if backend == "overflow":
+        # OVERFLOW_FALLBACK=local tries the routing without a model file
+        fallback = os.environ.get("OVERFLOW_FALLBACK", "llama")
+        if fallback not in ("local", "llama"):
+            raise ValueError(f"Unknown overflow fallback {fallback}, expected local or llama")
+        for name in ("gemini", fallback):
+            if name not in _clients:
+                _clients[name] = _create_client(name)
+        return OverflowClient(_clients["gemini"], _clients[fallback])
+
+    api_key = os.environ.get("GEMINI_API_KEY", "")
+    if not api_key:
+        raise ValueError("GEMINI_API_KEY environment variable is required")
+
+    from google import genai
+    return genai.Client(api_key=api_key)
+
+
+def is_unavailable_error(error: Exception) -> bool:
+    """Check whether an API error means the API is throttled or down, rather than the request is bad"""
+    if is_rate_limit_error(error):
+        return True
+    code = getattr(error, "code", None)
+    if isinstance(code, int) and code >= 500:
+        return True
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    try:
+        import httpx
+        return isinstance(error, httpx.TransportError)
+    except ImportError:
+        return False
+
+
+class _OverflowModels:
+    def __init__(self, client: "OverflowClient"):
+        self.client = client
+
+    def get(self, model: str):
+        return self.client.primary.models.get(model=model)
+
+    def generate_content(self, model: str, contents: Any, config: Any = None):
+        if self.client.overflowing():
+            return self.client.fallback.models.generate_content(
+                model=model, contents=contents, config=self.client.local_config(config))
+        try:
+            return self.client.primary.models.generate_content(model=model, contents=contents, config=config)
+        except Exception as e:
+            if not is_unavailable_error(e):
+                raise
+            self.client.overflow(e)
+            return self.client.fallback.models.generate_content(
+                model=model, contents=contents, config=self.client.local_config(config))
+
+    def generate_content_stream(self, model: str, contents: Any, config: Any = None) -> Iterator[Any]:
+        if not self.client.overflowing():
+            stream = iter(self.client.primary.models.generate_content_stream(
+                model=model, contents=contents, config=config))
+            try:
+                first = next(stream, None)
+            except Exception as e:
+                if not is_unavailable_error(e):
+                    raise
+                self.client.overflow(e)
+            else:
+                # Once the API has started answering, the stream stays on it
+                if first is not None:
+                    yield first
+                    yield from stream
+                return
+        yield from self.client.fallback.models.generate_content_stream(
+            model=model, contents=contents, config=self.client.local_config(config))
+
+
+class _OverflowCaches:
+    """The API's caches, remembering each cached instruction for calls that overflow"""
+
+    def __init__(self, client: "OverflowClient"):
+        self.client = client
+
+    def create(self, model: str, config: Any = None):
+        cache = self.client.primary.caches.create(model=model, config=config)
+        with self.client.lock:
+            self.client.instructions[cache.name] = getattr(config, "system_instruction", None)
+        return cache
+
+    def delete(self, name: str):
+        with self.client.lock:
+            self.client.instructions.pop(name, None)
+        return self.client.primary.caches.delete(name=name)
+
+
+class OverflowClient:
+    """
+    Gemini client that hands calls to a local model while the API is unavailable
+
+    A call failing with a rate-limit, server or connection error is
+    answered by the fallback instead, and for OVERFLOW_COOLDOWN seconds
+    after that every call goes straight to the fallback. Errors caused by
+    the request itself are raised as usual.
+    """
+
+    def __init__(self, primary, fallback, cooldown: float = OVERFLOW_COOLDOWN):
+        """
+        Initialize the client
+
+        Args:
+            primary: genai.Client
+            fallback: Local client such as LlamaCppClient
+            cooldown: Seconds the API is skipped after a failure
+        """
+        self.primary = primary
+        self.fallback = fallback
+        self.cooldown = cooldown
+        self.models = _OverflowModels(self)
+        self.caches = _OverflowCaches(self)
+        self.instructions: Dict[str, Optional[str]] = {}
+        self.lock = threading.Lock()
+        self._until = 0.0
+        self._stats = {"overflows": 0, "served_locally": 0}
+
+    def overflowing(self) -> bool:
+        """Whether calls currently skip the API"""
+        return time.monotonic() < self._until
+
+    def overflow(self, error: Exception):
+        """Send calls to the fallback for the cooldown after an API failure"""
+        logging.warning(f"Gemini API unavailable, answering locally for {self.cooldown:.0f}s: {str(error)}")
+        with self.lock:
+            self._until = time.monotonic() + self.cooldown
+            self._stats["overflows"] += 1
+
+    def local_config(self, config: Any) -> Any:
+        """A config for the fallback, with the instruction inline instead of in cached content"""
+        with self.lock:
+            self._stats["served_locally"] += 1
+            cached = getattr(config, "cached_content", None)
+            if not cached:
+                return config
+            instruction = self.instructions.get(cached)
+        return config.model_copy(update={"cached_content": None, "system_instruction": instruction})
+
+    def stats(self) -> Dict[str, Any]:
+        """Overflow events, calls answered locally and whether the API is skipped now"""
+        with self.lock:
+            return dict(self._stats, overflowing=self.overflowing())
+
+
+def preload():
+    """
+    Import the SDK and build the client in a background thread
+
+    Lets the first page render while the import runs; get_client() then
+    just waits on the lock if it is called before the preload finishes.
+    Only the first call per process starts a thread.
+    """
+    global _preloading
+    with _client_lock:
+        if _preloading or _clients:
+            return
+        _preloading = True
+
+    def run():
+        try:
+            get_client()
+        except Exception as e:
+            logging.error(f"Failed to preload Gemini client: {str(e)}")
+
+    threading.Thread(target=run, name="gemini-preload", daemon=True).start()
+
+
+def create_cached_content(client, model_name: str, system_instruction: str,
+                          ttl: str = "3600s", tools: Optional[list] = None) -> Optional[Any]:
+    """
+    Create cached content holding a system instruction
+
+    Gemini only caches prompts above a minimum token count, so this is
+    allowed to fail; callers then keep sending the instruction inline.
+
+    Args:
+        client: genai.Client instance
+        model_name: Model the cache is created for
+        system_instruction: Instruction to cache
+        ttl: Cache lifetime
+        tools: Tool declarations, which cannot be sent alongside cached content
+
+    Returns:
+        Name of the cached content, or None if it could not be created
+    """
+    from google.genai import types
+
+    try:
+        cache = client.caches.create(
+            model=model_name,
+            config=types.CreateCachedContentConfig(
+                system_instruction=system_instruction,
+                tools=tools,
+                ttl=ttl
+            )
+        )
+        return cache.name
+    except Exception as e:
+        logging.info(f"Cached content not created for {model_name}: {str(e)}")
+        return None
+
+
+def usage_from_response(response) -> Dict[str, int]:
+    """
+    Extract token counts from a response's usage metadata
+
+    Args:
+        response: GenerateContentResponse (for streams, the last chunk)
+
+    Returns:
+        Prompt, cached, thought and output token counts
+    """
+    usage = getattr(response, "usage_metadata", None)
+    return {
+        "prompt_tokens": getattr(usage, "prompt_token_count", None) or 0,
+        "cached_tokens": getattr(usage, "cached_content_token_count", None) or 0,
+        "thought_tokens": getattr(usage, "thoughts_token_count", None) or 0,
+        "output_tokens": getattr(usage, "candidates_token_count", None) or 0,
+    }
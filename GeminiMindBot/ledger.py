@@ -0,0 +1,331 @@
+import os
+import time
+import uuid
+import atexit
+import sqlite3
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+# USD per million tokens: input, cached input, output (thinking is billed as output)
+PRICING = {
+    "gemini-2.5-flash": {"input": 0.30, "cached": 0.075, "output": 2.50},
+    "gemini-2.5-pro": {"input": 1.25, "cached": 0.31, "output": 10.00},
+    "gemini-2.5-flash-lite": {"input": 0.10, "cached": 0.025, "output": 0.40},
+}
+
+# Batch API calls are billed at this share of the interactive price
+BATCH_DISCOUNT = 0.5
+
+# Columns calls can be aggregated by
+GROUPINGS = ("conversation_id", "day", "route", "model")
+
+_conversation = contextvars.ContextVar("ledger_conversation", default=None)
+_turn = contextvars.ContextVar("ledger_turn", default=None)
+
+
+def call_cost(model: str, usage: Dict[str, int]) -> float:
+    """
+    Price one call
+
+    Args:
+        model: Model name as sent to the API
+        usage: Token counts from usage_from_response
+
+    Returns:
+        Cost in USD, 0 for models without a price
+    """
+    prices = PRICING.get(model)
+    if prices is None:
+        return 0.0
+    cached = usage.get("cached_tokens", 0)
+    uncached = max(0, usage.get("prompt_tokens", 0) - cached)
+    output = usage.get("output_tokens", 0) + usage.get("thought_tokens", 0)
+    return (uncached * prices["input"] + cached * prices["cached"] + output * prices["output"]) / 1_000_000
+
+
+@contextmanager
+def conversation(conversation_id: Optional[str]) -> Iterator[None]:
+    """Attribute the calls made inside the block to a conversation, as one turn of it"""
+    token = _conversation.set(conversation_id)
+    turn_token = _turn.set(uuid.uuid4().hex)
+    try:
+        yield
+    finally:
+        _turn.reset(turn_token)
+        _conversation.reset(token)
+
+
+def charge_stream(conversation_id: Optional[str], chunks: Iterator[Any]) -> Iterator[Any]:
+    """Attribute the calls a lazily consumed stream makes to a conversation"""
+    with conversation(conversation_id):
+        yield from chunks
+
+
+class UsageLedger:
+    """Token and cost ledger of upstream calls, stored in SQLite"""
+
+    def __init__(self, path: str = "usage_ledger.db", flush_interval: float = 5.0,
+                 flush_size: int = 200, daily_budget: float = 0.0,
+                 conversation_budget: float = 0.0):
+        """
+        Initialize the ledger
+
+        Args:
+            path: SQLite database file
+            flush_interval: Seconds between background flushes
+            flush_size: Buffered calls that trigger an early flush
+            daily_budget: USD per day above which a warning is logged, 0 to disable
+            conversation_budget: USD per conversation above which a warning is logged, 0 to disable
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.daily_budget = daily_budget
+        self.conversation_budget = conversation_budget
+        self._buffer: List[tuple] = []
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._writer: Optional[threading.Thread] = None
+        self._day_costs: Dict[int, float] = {}
+        self._conversation_costs: Dict[str, float] = {}
+        self._alerted = set()
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS calls (
+                ts REAL NOT NULL,
+                day INTEGER NOT NULL,
+                conversation_id TEXT,
+                route TEXT NOT NULL,
+                model TEXT NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                cached_tokens INTEGER NOT NULL,
+                thought_tokens INTEGER NOT NULL,
+                output_tokens INTEGER NOT NULL,
+                cost REAL NOT NULL,
+                turn_id TEXT
+            );
+            CREATE INDEX IF NOT EXISTS calls_day ON calls (day);
+            CREATE INDEX IF NOT EXISTS calls_conversation ON calls (conversation_id);
+            CREATE TABLE IF NOT EXISTS resolutions (
+                conversation_id TEXT PRIMARY KEY,
+                ts REAL NOT NULL
+            );
+        """)
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(calls)")]
+        if "turn_id" not in columns:
+            # Ledgers from before turns were recorded
+            self._db.execute("ALTER TABLE calls ADD COLUMN turn_id TEXT")
+            self._db.commit()
+        today = int(datetime.now().strftime("%Y%m%d"))
+        row = self._db.execute("SELECT COALESCE(SUM(cost), 0) FROM calls WHERE day = ?", (today,)).fetchone()
+        self._day_costs[today] = row[0]
+        atexit.register(self.flush)
+
+    def record(self, route: str, model: str, usage: Dict[str, int],
+               conversation_id: Optional[str] = None):
+        """
+        Buffer one upstream call
+
+        Args:
+            route: Call site, e.g. "chat" or "analysis"
+            model: Model name
+            usage: Token counts from usage_from_response
+            conversation_id: Conversation to charge; defaults to the one set with conversation()
+        """
+        if not usage:
+            return
+        if conversation_id is None:
+            conversation_id = _conversation.get()
+        now = time.time()
+        day = int(datetime.fromtimestamp(now).strftime("%Y%m%d"))
+        cost = call_cost(model, usage) * (BATCH_DISCOUNT if route == "batch" else 1.0)
+        entry = (now, day, conversation_id, route, model,
+                 usage.get("prompt_tokens", 0), usage.get("cached_tokens", 0),
+                 usage.get("thought_tokens", 0), usage.get("output_tokens", 0), cost, _turn.get())
+
+        with self._lock:
+            self._buffer.append(entry)
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="usage-ledger", daemon=True)
+                self._writer.start()
+            if len(self._buffer) >= self.flush_size:
+                self._wake.set()
+            self._check_budgets(day, conversation_id, cost)
+
+    def mark_resolved(self, conversation_id: str):
+        """Count a conversation as resolved for the cost-per-resolution report"""
+        with self._db_lock:
+            self._db.execute("INSERT OR REPLACE INTO resolutions VALUES (?, ?)", (conversation_id, time.time()))
+            self._db.commit()
+
+    def flush(self):
+        """Write buffered calls to the database"""
+        with self._lock:
+            entries, self._buffer = self._buffer, []
+        if not entries:
+            return
+        try:
+            with self._db_lock:
+                self._db.executemany("INSERT INTO calls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", entries)
+                self._db.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Failed to write usage ledger: {str(e)}")
+
+    def totals(self, by: str = "day", since_day: Optional[int] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        Aggregate tokens and cost
+
+        Args:
+            by: One of GROUPINGS
+            since_day: Only include calls from this day (YYYYMMDD) on
+            limit: Maximum number of groups, most expensive first
+
+        Returns:
+            One row per group with call count, token sums and cost
+        """
+        if by not in GROUPINGS:
+            raise ValueError(f"Unknown grouping: {by}")
+        self.flush()
+        with self._db_lock:
+            cursor = self._db.execute(f"""
+                SELECT {by}, COUNT(*), SUM(prompt_tokens), SUM(cached_tokens),
+                       SUM(thought_tokens), SUM(output_tokens), SUM(cost)
+                FROM calls WHERE day >= ? GROUP BY {by} ORDER BY SUM(cost) DESC LIMIT ?
+            """, (since_day or 0, limit))
+            rows = cursor.fetchall()
+        return [{
+            by: row[0], "calls": row[1], "prompt_tokens": row[2], "cached_tokens": row[3],
+            "thought_tokens": row[4], "output_tokens": row[5], "cost": round(row[6], 6)
+        } for row in rows]
+
+    def report(self, since_day: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Summarize spend per answered question and per resolved conversation
+
+        Args:
+            since_day: Only include calls from this day (YYYYMMDD) on
+
+        Returns:
+            Totals, cache share and unit costs
+        """
+        self.flush()
+        with self._db_lock:
+            total_cost, prompt, cached, questions, conversations = self._db.execute("""
+                SELECT COALESCE(SUM(cost), 0), COALESCE(SUM(prompt_tokens), 0),
+                       COALESCE(SUM(cached_tokens), 0),
+                       COUNT(DISTINCT CASE WHEN route = 'chat' THEN COALESCE(turn_id, rowid) END),
+                       COUNT(DISTINCT conversation_id)
+                FROM calls WHERE day >= ?
+            """, (since_day or 0,)).fetchone()
+            resolved, resolved_cost = self._db.execute("""
+                SELECT COUNT(DISTINCT r.conversation_id), COALESCE(SUM(c.cost), 0)
+                FROM resolutions r JOIN calls c ON c.conversation_id = r.conversation_id
+                WHERE c.day >= ?
+            """, (since_day or 0,)).fetchone()
+
+        return {
+            "cost": round(total_cost, 6),
+            "conversations": conversations,
+            "questions": questions or 0,
+            "resolved_conversations": resolved,
+            "cached_share": round(cached / prompt, 3) if prompt else 0.0,
+            "cost_per_question": round(total_cost / questions, 6) if questions else None,
+            "cost_per_resolved": round(resolved_cost / resolved, 6) if resolved else None,
+            "routes": self.totals("route", since_day)
+        }
+
+    def _write_loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def _check_budgets(self, day: int, conversation_id: Optional[str], cost: float):
+        """Log a warning the first time a budget is exceeded; lock held"""
+        if day not in self._day_costs:
+            # Budgets are daily, so yesterday's running totals can go
+            self._day_costs.clear()
+            self._conversation_costs.clear()
+            self._alerted.clear()
+        self._day_costs[day] = self._day_costs.get(day, 0.0) + cost
+        if self.daily_budget and self._day_costs[day] > self.daily_budget and ("day", day) not in self._alerted:
+            self._alerted.add(("day", day))
+            logging.warning(f"Daily Gemini spend ${self._day_costs[day]:.4f} exceeded budget ${self.daily_budget:.4f}")
+
+        if conversation_id is None:
+            return
+        spent = self._conversation_costs.get(conversation_id, 0.0) + cost
+        self._conversation_costs[conversation_id] = spent
+        if self.conversation_budget and spent > self.conversation_budget \
+                and ("conversation", conversation_id) not in self._alerted:
+            self._alerted.add(("conversation", conversation_id))
+            logging.warning(f"Conversation {conversation_id} spent ${spent:.4f}, "
+                            f"over budget ${self.conversation_budget:.4f}")
+
+
+_ledger: Optional[UsageLedger] = None
+_ledger_failed = False
+_ledger_lock = threading.Lock()
+
+
+def get_ledger() -> Optional[UsageLedger]:
+    """
+    Get the process-wide ledger configured from the environment
+
+    USAGE_LEDGER sets the database file (empty disables the ledger),
+    LEDGER_DAILY_BUDGET and LEDGER_CONVERSATION_BUDGET the alert
+    thresholds in USD.
+
+    Returns:
+        The ledger, or None if it is disabled or cannot be opened
+    """
+    global _ledger, _ledger_failed
+    path = os.environ.get("USAGE_LEDGER", "usage_ledger.db")
+    if not path or _ledger_failed:
+        return None
+
+    with _ledger_lock:
+        if _ledger is None:
+            try:
+                _ledger = UsageLedger(
+                    path,
+                    daily_budget=float(os.environ.get("LEDGER_DAILY_BUDGET", "0")),
+                    conversation_budget=float(os.environ.get("LEDGER_CONVERSATION_BUDGET", "0"))
+                )
+            except (sqlite3.Error, ValueError) as e:
+                logging.error(f"Usage ledger unavailable: {str(e)}")
+                _ledger_failed = True
+                return None
+        return _ledger
+
+
+def record_usage(route: str, model: str, usage: Dict[str, int]):
+    """Record a call in the process-wide ledger, if enabled"""
+    ledger = get_ledger()
+    if ledger is not None:
+        ledger.record(route, model, usage)
+
+
+if __name__ == "__main__":
+    import json
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Gemini token and cost ledger")
+    parser.add_argument("command", choices=["report", "totals"])
+    parser.add_argument("--by", choices=GROUPINGS, default="day")
+    parser.add_argument("--since", type=int, help="First day to include, YYYYMMDD")
+    parser.add_argument("--db", default=os.environ.get("USAGE_LEDGER", "usage_ledger.db"))
+    args = parser.parse_args()
+
+    usage_ledger = UsageLedger(args.db)
+    if args.command == "report":
+        print(json.dumps(usage_ledger.report(args.since), ensure_ascii=False, indent=2))
+    else:
+        for total in usage_ledger.totals(args.by, args.since):
+            print(json.dumps(total, ensure_ascii=False))
@@ -0,0 +1,226 @@
+"""
+Local CPU model served through llama.cpp, shaped like genai.Client
+
+Usage:
+    LLAMA_MODEL_PATH=models/qwen2.5-1.5b-instruct-q4_k_m.gguf python llama_backend.py
+    python llama_backend.py --model model.gguf --threads 8 --requests 20 -o llama_benchmark.json
+
+Selected per role with CHAT_BACKEND / ANALYSIS_BACKEND=llama, or as the
+overflow of the Gemini API with =overflow (see gemini_client.get_client).
+The benchmark answers store questions in Arabic with the default store's
+instruction and reports time to first token, decode speed and throughput.
+"""
+import os
+import json
+import time
+import argparse
+import threading
+from typing import Any, Dict, Iterator, List, Optional
+
+from local_gemini import _Response, _Usage, _contents_text
+
+try:
+    import llama_cpp
+except ImportError:
+    llama_cpp = None
+
+# Questions the benchmark asks, one per store topic
+BENCHMARK_QUESTIONS = [
+    "ما هي أسعار الساعات عندكم؟",
+    "إزاي أدفع؟ ينفع كاش عند الاستلام؟",
+    "الشحن بياخد قد إيه لإسكندرية؟",
+    "عايز أرجع الساعة، إيه سياسة الاسترجاع؟",
+    "الساعة الكربون الأسود مقاومة للمية؟",
+]
+
+
+def is_available() -> bool:
+    """Check whether a local model is installed and configured"""
+    return llama_cpp is not None and bool(os.environ.get("LLAMA_MODEL_PATH"))
+
+
+def _schema(config: Any) -> Optional[Dict[str, Any]]:
+    """JSON schema of a config's response_schema, for grammar-constrained output"""
+    schema = getattr(config, "response_schema", None)
+    if schema is None:
+        return None
+    if isinstance(schema, dict):
+        return schema
+    return schema.json_schema.model_dump(exclude_none=True, mode="json")
+
+
+class _LlamaModels:
+    def __init__(self, llama, max_tokens: int):
+        self.llama = llama
+        self.max_tokens = max_tokens
+        # One llama.cpp context decodes one request at a time
+        self._lock = threading.Lock()
+
+    def get(self, model: str):
+        return {"name": model, "path": self.llama.model_path}
+
+    def generate_content(self, model: str, contents: Any, config: Any = None) -> _Response:
+        with self._lock:
+            result = self.llama.create_chat_completion(**self._request(contents, config))
+        usage = result.get("usage", {})
+        return _Response(result["choices"][0]["message"].get("content") or "",
+                         _Usage(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)))
+
+    def generate_content_stream(self, model: str, contents: Any, config: Any = None) -> Iterator[_Response]:
+        request = self._request(contents, config)
+        with self._lock:
+            prompt_tokens = len(self.llama.tokenize(
+                "\n".join(message["content"] for message in request["messages"]).encode("utf-8")))
+            output_tokens = 0
+            for chunk in self.llama.create_chat_completion(stream=True, **request):
+                text = chunk["choices"][0]["delta"].get("content")
+                if text:
+                    # llama.cpp streams one token per chunk
+                    output_tokens += 1
+                    yield _Response(text)
+        yield _Response(None, _Usage(prompt_tokens, output_tokens))
+
+    def _request(self, contents: Any, config: Any) -> Dict[str, Any]:
+        """Chat completion arguments for a generate_content call"""
+        messages = []
+        instruction = getattr(config, "system_instruction", None)
+        if isinstance(instruction, str) and instruction:
+            messages.append({"role": "system", "content": instruction})
+        # Tool declarations are not passed on: the local model answers without lookups
+        messages.append({"role": "user", "content": _contents_text(contents)})
+
+        request = {
+            "messages": messages,
+            "max_tokens": min(getattr(config, "max_output_tokens", None) or self.max_tokens, self.max_tokens),
+            "temperature": 0.7,
+        }
+        if getattr(config, "temperature", None) is not None:
+            request["temperature"] = config.temperature
+        if getattr(config, "response_mime_type", None) == "application/json":
+            request["response_format"] = {"type": "json_object"}
+            schema = _schema(config)
+            if schema:
+                request["response_format"]["schema"] = schema
+        return request
+
+
+class _Caches:
+    def create(self, model: str, config: Any = None):
+        raise NotImplementedError("The local model does not support cached content")
+
+
+class LlamaCppClient:
+    """
+    Quantized GGUF model on the CPU, as a stand-in for genai.Client
+
+    Implements the generate_content and generate_content_stream calls the
+    chatbot and analyzer make. Tools and cached content are not supported:
+    the instruction is always sent inline and lookups are skipped.
+    """
+
+    def __init__(self, model_path: Optional[str] = None, threads: Optional[int] = None,
+                 context_size: Optional[int] = None, max_tokens: Optional[int] = None):
+        """
+        Load the model
+
+        Args:
+            model_path: GGUF file (LLAMA_MODEL_PATH)
+            threads: CPU threads for decoding (LLAMA_THREADS, defaults to all cores)
+            context_size: Prompt plus answer tokens (LLAMA_CONTEXT, 4096)
+            max_tokens: Longest answer in tokens (LLAMA_MAX_TOKENS, 512)
+        """
+        if llama_cpp is None:
+            raise RuntimeError("The local model backend requires the 'llama-cpp-python' package")
+        model_path = model_path or os.environ.get("LLAMA_MODEL_PATH", "")
+        if not model_path:
+            raise ValueError("LLAMA_MODEL_PATH environment variable is required")
+        if threads is None:
+            threads = int(os.environ.get("LLAMA_THREADS", "0")) or os.cpu_count()
+        if context_size is None:
+            context_size = int(os.environ.get("LLAMA_CONTEXT", "4096"))
+        if max_tokens is None:
+            max_tokens = int(os.environ.get("LLAMA_MAX_TOKENS", "512"))
+
+        llama = llama_cpp.Llama(model_path=model_path, n_ctx=context_size, n_threads=threads, verbose=False)
+        self.models = _LlamaModels(llama, max_tokens)
+        self.caches = _Caches()
+
+
+def _percentile(values: List[float], share: float) -> float:
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(share * len(ordered)))], 1)
+
+
+def benchmark(client: LlamaCppClient, instruction: str, requests: int, max_tokens: int) -> Dict[str, Any]:
+    """
+    Answer store questions one after another and time them
+
+    Args:
+        client: Loaded local model
+        instruction: System instruction sent with every question
+        requests: Number of questions, cycling through BENCHMARK_QUESTIONS
+        max_tokens: Answer length cap
+
+    Returns:
+        Time to first token, decode speed and throughput
+    """
+    from google.genai import types
+
+    config = types.GenerateContentConfig(system_instruction=instruction, temperature=0.7,
+                                         max_output_tokens=max_tokens)
+    first_token_ms, total_ms, decode_rates, prompt_tokens, output_tokens = [], [], [], [], []
+    started = time.perf_counter()
+    for index in range(requests):
+        question = f"Current user message: {BENCHMARK_QUESTIONS[index % len(BENCHMARK_QUESTIONS)]}"
+        request_started = time.perf_counter()
+        first = None
+        usage = None
+        for chunk in client.models.generate_content_stream(model="local", contents=question, config=config):
+            if chunk.text and first is None:
+                first = time.perf_counter()
+            if chunk.usage_metadata is not None:
+                usage = chunk.usage_metadata
+        finished = time.perf_counter()
+        first = first or finished
+
+        first_token_ms.append((first - request_started) * 1000)
+        total_ms.append((finished - request_started) * 1000)
+        prompt_tokens.append(usage.prompt_token_count)
+        output_tokens.append(usage.candidates_token_count)
+        if usage.candidates_token_count > 1 and finished > first:
+            decode_rates.append((usage.candidates_token_count - 1) / (finished - first))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "requests": requests,
+        "threads": client.models.llama.n_threads,
+        "avg_prompt_tokens": round(sum(prompt_tokens) / requests, 1),
+        "avg_output_tokens": round(sum(output_tokens) / requests, 1),
+        "first_token_ms": {"p50": _percentile(first_token_ms, 0.5), "p95": _percentile(first_token_ms, 0.95)},
+        "total_ms": {"p50": _percentile(total_ms, 0.5), "p95": _percentile(total_ms, 0.95)},
+        "decode_tokens_per_second": round(sum(decode_rates) / len(decode_rates), 1) if decode_rates else 0.0,
+        "output_tokens_per_second": round(sum(output_tokens) / elapsed, 1),
+        "requests_per_minute": round(requests / elapsed * 60, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the local model on Arabic store answers")
+    parser.add_argument("--model", default=os.environ.get("LLAMA_MODEL_PATH", ""), help="GGUF file")
+    parser.add_argument("--threads", type=int, default=None, help="CPU threads (default: all cores)")
+    parser.add_argument("--requests", type=int, default=10)
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("-o", "--output", default="", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    from tenants import get_tenant
+
+    loading = time.perf_counter()
+    client = LlamaCppClient(model_path=args.model, threads=args.threads, max_tokens=args.max_tokens)
+    report = {"model": os.path.basename(args.model), "load_ms": round((time.perf_counter() - loading) * 1000, 1)}
+    report.update(benchmark(client, get_tenant().system_instruction(), args.requests, args.max_tokens))
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,387 @@
+"""
+Multi-session load test of the Streamlit app
+
+Usage:
+    python loadtest.py --sessions 50 --turns 10
+    python loadtest.py --mode websocket --sessions 50 --turns 10 --label v1.4
+    python loadtest.py --mode websocket --url ws://host:8501 --script questions.jsonl
+
+Each session sends a scripted conversation, one question per rerun, and
+the report records rerun latency against the number of messages already
+in the conversation, memory per session and throughput.
+
+The apptest mode runs every session in this process with Streamlit's
+AppTest, interleaved turn by turn, so it measures the script and its
+shared resources without a browser or server. The websocket mode starts `streamlit run app.py` (or
+connects to --url) and drives it like browsers would, over the same
+websocket protocol; server memory is only measured for a server it started.
+
+Both modes use the local Gemini stand-in unless GEMINI_BACKEND is set,
+and lift the admission quota unless GEMINI_RPM is set, so the app rather
+than the API quota is measured. Sessions write their files to a scratch
+working directory. The full report goes to --output and a one-line
+summary is appended to --history, to compare releases.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP = os.path.join(APP_DIR, "app.py")
+
+# Used when no --script is given; sessions start at different questions
+DEFAULT_SCRIPT = [
+    "السلام عليكم",
+    "اسمي أحمد",
+    "بكام الساعة؟",
+    "الدفع إزاي؟",
+    "الشحن لإسكندرية بياخد قد إيه؟",
+    "لو الساعة مش عجبتني أرجعها إزاي؟",
+    "عايز أتابع طلبي",
+    "01012345678",
+    "هل الساعة ضد الماء؟",
+    "شكراً جزيلاً",
+]
+
+
+def load_script(path: Optional[str]) -> List[List[str]]:
+    """
+    Read the scripted conversations
+
+    Args:
+        path: CSV or JSONL file in the evaluate.py format, rows sharing a
+            thread_id forming one conversation; None for the built-in script
+
+    Returns:
+        Conversations as lists of questions
+    """
+    if not path:
+        return [DEFAULT_SCRIPT]
+    from evaluate import load_questions
+
+    threads: "OrderedDict[str, List[str]]" = OrderedDict()
+    for row in load_questions(path):
+        threads.setdefault(row["thread_id"], []).append(row["question"])
+    return list(threads.values())
+
+
+def session_script(conversations: List[List[str]], session: int, turns: int) -> List[str]:
+    """Questions one session asks, cycling its conversation to fill the turns"""
+    questions = conversations[session % len(conversations)]
+    offset = session // len(conversations)
+    return [questions[(offset + turn) % len(questions)] for turn in range(turns)]
+
+
+def rss_bytes(pid: Optional[int] = None) -> int:
+    """Resident memory of a process, 0 where it cannot be read"""
+    try:
+        with open(f"/proc/{pid or os.getpid()}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class LoadTest:
+    """Runs concurrent scripted sessions and collects per-turn samples"""
+
+    def __init__(self, sessions: int = 10, turns: int = 10, timeout: float = 60):
+        """
+        Initialize the load test
+
+        Args:
+            sessions: Concurrent sessions
+            turns: Questions sent by each session
+            timeout: Seconds one rerun may take before it counts as failed
+        """
+        self.sessions = sessions
+        self.turns = turns
+        self.timeout = timeout
+        self.samples: List[Dict[str, Any]] = []
+        # Set once the warm-up session is done, for the throughput figure
+        self.started = time.perf_counter()
+
+    def _record(self, session: int, turn: int, started: float, ok: bool, error: str = ""):
+        sample = {
+            "session": session,
+            "turn": turn,
+            # Messages on the page before this question: one question and one answer per turn
+            "history": turn * 2,
+            "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+            "ok": ok,
+        }
+        if error:
+            sample["error"] = error
+        self.samples.append(sample)
+
+    def run_apptest(self, conversations: List[List[str]]) -> Dict[str, int]:
+        """
+        Run the sessions in this process with AppTest
+
+        AppTest owns the process-wide Streamlit runtime during a run, so
+        sessions are interleaved turn by turn instead of running in parallel;
+        use websocket mode for concurrency and throughput.
+
+        Args:
+            conversations: Scripted conversations from load_script
+
+        Returns:
+            Resident memory before and after, in bytes
+        """
+        from streamlit.testing.v1 import AppTest
+
+        # A first session imports the app's modules, which is not per-session memory
+        AppTest.from_file(APP, default_timeout=self.timeout).run()
+        baseline = rss_bytes()
+        self.started = time.perf_counter()
+
+        apps = []
+        for _ in range(self.sessions):
+            at = AppTest.from_file(APP, default_timeout=self.timeout)
+            at.run()
+            apps.append(at)
+
+        scripts = [session_script(conversations, session, self.turns) for session in range(self.sessions)]
+        for turn in range(self.turns):
+            for session, at in enumerate(apps):
+                started = time.perf_counter()
+                try:
+                    at.chat_input[0].set_value(scripts[session][turn]).run()
+                    errors = [str(exception.value) for exception in at.exception]
+                    self._record(session, turn, started, not errors, "; ".join(errors))
+                except Exception as e:
+                    self._record(session, turn, started, False, str(e))
+        return {"baseline": baseline, "loaded": rss_bytes()}
+
+    async def run_websocket(self, url: str, conversations: List[List[str]],
+                            server_pid: Optional[int] = None) -> Dict[str, int]:
+        """
+        Drive a running server over its websocket, like browsers would
+
+        Args:
+            url: Server address, e.g. ws://localhost:8501
+            conversations: Scripted conversations from load_script
+            server_pid: Server process to measure memory of, if local
+
+        Returns:
+            Server resident memory before and after, in bytes (0 if not measured)
+        """
+        import websockets
+
+        connected = asyncio.Barrier(self.sessions)
+        stream_url = url.rstrip("/") + "/_stcore/stream"
+
+        # A first session imports the app's modules, which is not per-session memory
+        async with websockets.connect(stream_url, subprotocols=["streamlit"], max_size=None) as ws:
+            await self._rerun(ws, None)
+        baseline = rss_bytes(server_pid) if server_pid else 0
+        self.started = time.perf_counter()
+
+        async def run_session(session: int):
+            async with websockets.connect(stream_url, subprotocols=["streamlit"], max_size=None) as ws:
+                chat_input_id, _ = await self._rerun(ws, None)
+                await connected.wait()
+                for turn, question in enumerate(session_script(conversations, session, self.turns)):
+                    started = time.perf_counter()
+                    try:
+                        _, error = await asyncio.wait_for(self._rerun(ws, (chat_input_id, question)),
+                                                          self.timeout)
+                        self._record(session, turn, started, not error, error)
+                    except Exception as e:
+                        self._record(session, turn, started, False, str(e) or type(e).__name__)
+
+        await asyncio.gather(*(run_session(session) for session in range(self.sessions)))
+        return {"baseline": baseline, "loaded": rss_bytes(server_pid) if server_pid else 0}
+
+    @staticmethod
+    async def _rerun(ws, chat_message: Optional[Tuple[str, str]]) -> Tuple[Optional[str], str]:
+        """
+        Request one script run and wait for it to finish
+
+        Args:
+            ws: Open websocket of the session
+            chat_message: Chat input widget id and the text to submit, None for the first load
+
+        Returns:
+            The chat input widget id seen during the run, and the error shown if any
+        """
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        message = BackMsg()
+        message.rerun_script.query_string = ""
+        if chat_message:
+            widget = message.rerun_script.widget_states.widgets.add()
+            widget.id = chat_message[0]
+            widget.chat_input_value.data = chat_message[1]
+        await ws.send(message.SerializeToString())
+
+        chat_input_id = None
+        error = ""
+        while True:
+            forward = ForwardMsg()
+            forward.ParseFromString(await ws.recv())
+            kind = forward.WhichOneof("type")
+            if kind == "delta" and forward.delta.WhichOneof("type") == "new_element":
+                element = forward.delta.new_element
+                if element.WhichOneof("type") == "chat_input":
+                    chat_input_id = element.chat_input.id
+                elif element.WhichOneof("type") == "exception":
+                    error = element.exception.message
+            elif kind == "script_finished" and \
+                    forward.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                return chat_input_id, error
+
+
+def start_server(port: int, workdir: str, timeout: float = 60) -> subprocess.Popen:
+    """
+    Start the app with `streamlit run` and wait until it is healthy
+
+    Args:
+        port: Port to listen on
+        workdir: Working directory of the server, where it writes its files
+        timeout: Seconds to wait for the health check
+
+    Returns:
+        The server process
+    """
+    server = subprocess.Popen(
+        [sys.executable, "-m", "streamlit", "run", APP, "--server.headless", "true",
+         "--server.port", str(port), "--server.enableXsrfProtection", "false",
+         "--server.enableStaticServing", "true",
+         "--browser.gatherUsageStats", "false"],
+        cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode}")
+        try:
+            with urllib.request.urlopen(f"http://localhost:{port}/_stcore/health", timeout=2):
+                return server
+        except OSError:
+            time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError("Server did not become healthy in time")
+
+
+def summarize(samples: List[Dict[str, Any]], wall_seconds: float,
+              memory: Dict[str, int], sessions: int) -> Dict[str, Any]:
+    """Aggregate latency per history length, memory per session and throughput"""
+    def percentiles(values: List[float]) -> Dict[str, float]:
+        values = sorted(values)
+        if not values:
+            return {}
+
+        def percentile(share: float) -> float:
+            return values[min(len(values) - 1, int(share * len(values)))]
+
+        return {"p50": percentile(0.5), "p95": percentile(0.95), "max": values[-1]}
+
+    ok = [sample for sample in samples if sample["ok"]]
+    by_history: Dict[int, List[float]] = {}
+    for sample in ok:
+        by_history.setdefault(sample["history"], []).append(sample["latency_ms"])
+
+    report = {
+        "sessions": sessions,
+        "turns": len(samples),
+        "errors": len(samples) - len(ok),
+        "wall_seconds": round(wall_seconds, 1),
+        "throughput_turns_per_second": round(len(ok) / wall_seconds, 2) if wall_seconds else 0,
+        "latency_ms": percentiles([sample["latency_ms"] for sample in ok]),
+        "latency_by_history": [dict(history=history, count=len(values), **percentiles(values))
+                               for history, values in sorted(by_history.items())],
+    }
+    if memory.get("loaded"):
+        report["memory_mb"] = {
+            "baseline": round(memory["baseline"] / 1024 / 1024, 1),
+            "loaded": round(memory["loaded"] / 1024 / 1024, 1),
+            "per_session": round((memory["loaded"] - memory["baseline"]) / sessions / 1024 / 1024, 2)
+        }
+    errors = [sample["error"] for sample in samples if sample.get("error")]
+    if errors:
+        report["first_errors"] = errors[:5]
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the Streamlit app with concurrent sessions")
+    parser.add_argument("--mode", choices=["apptest", "websocket"], default="apptest")
+    parser.add_argument("-s", "--sessions", type=int, default=10, help="Concurrent sessions")
+    parser.add_argument("-t", "--turns", type=int, default=10, help="Questions per session")
+    parser.add_argument("--script", help="CSV or JSONL conversations in the evaluate.py format")
+    parser.add_argument("--url", help="Existing server for websocket mode, e.g. ws://localhost:8501")
+    parser.add_argument("--port", type=int, default=8599, help="Port of the server websocket mode starts")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds before a rerun counts as failed")
+    parser.add_argument("--workdir", help="Working directory for the sessions' files (default: a scratch one)")
+    parser.add_argument("-o", "--output", default="loadtest_report.json", help="Full report")
+    parser.add_argument("--history", default="loadtest_history.jsonl", help="Summary appended per run")
+    parser.add_argument("--label", default=time.strftime("%Y-%m-%d %H:%M"), help="Release or run name")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    os.environ.setdefault("GEMINI_BACKEND", "local")
+    os.environ.setdefault("GEMINI_RPM", "1000000")
+    os.environ.setdefault("TENANTS_FILE", os.path.join(APP_DIR, "tenants.json"))
+
+    output = os.path.abspath(args.output)
+    history = os.path.abspath(args.history)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="loadtest_")
+    os.makedirs(workdir, exist_ok=True)
+    conversations = load_script(args.script)
+    test = LoadTest(sessions=args.sessions, turns=args.turns, timeout=args.timeout)
+
+    logging.info(f"{args.mode}: {args.sessions} sessions x {args.turns} turns in {workdir}")
+    server = None
+    try:
+        if args.mode == "apptest":
+            # The app writes memory, pages and ledgers relative to the working directory
+            os.chdir(workdir)
+            sys.path.insert(0, APP_DIR)
+            memory = test.run_apptest(conversations)
+        else:
+            if not args.url:
+                server = start_server(args.port, workdir)
+            memory = asyncio.run(test.run_websocket(args.url or f"ws://localhost:{args.port}",
+                                                    conversations, server.pid if server else None))
+        wall_seconds = time.perf_counter() - test.started
+    finally:
+        if args.mode == "apptest":
+            # Write what the sessions left queued before the scratch directory goes
+            from write_behind import shared_writer
+            from ledger import get_ledger
+            shared_writer.flush()
+            if get_ledger() is not None:
+                get_ledger().flush()
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = summarize(test.samples, wall_seconds, memory, args.sessions)
+    report.update(label=args.label, mode=args.mode)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(dict(report, samples=test.samples), f, ensure_ascii=False, indent=2)
+    with open(history, "a", encoding="utf-8") as f:
+        summary = {key: value for key, value in report.items() if key != "latency_by_history"}
+        f.write(json.dumps(summary, ensure_ascii=False) + "\n")
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+import os
+import re
+import json
+import time
+from types import SimpleNamespace
+from typing import Any, Iterator, Optional
+
+from analyzer import keyword_analysis, encode_analysis
+from slots import extract_phones, is_tracking_request
+from tools import describe_order
+
+# Canned store answers per topic, in the bot's voice
+REPLIES = {
+    "product": "أهلاً بك! الساعة الكربون الأسود بـ 400 جنيه مصري، تصميم أنيق ومناسب لكل يوم ⌚",
+    "payment": "الدفع نقداً عند الاستلام، وسعر الساعة 400 جنيه مصري. يسعدني أساعدك!",
+    "shipping": "الشحن حسب العنوان والتوصيل خلال 3-4 أيام 🚚 لو عندك طلب تقدر تتابعه برقم موبايلك.",
+    "returns": "تقدر تستبدل خلال 7 أيام، أو تسترد المبلغ خلال 3 أيام من الاستلام.",
+    "general": "أهلاً بك! أنا موسي مساعد متجر 3QRab، ممكن أعرف اسمك وإزاي أقدر أساعدك؟",
+}
+
+# Questions about availability, answered with a stock lookup when tools are declared
+STOCK_PATTERN = re.compile(r"متوفر|متوفرة|متاح|متاحة|موجود|موجودة|ستوك|stock|available", re.IGNORECASE)
+
+
+class _Usage:
+    def __init__(self, prompt_tokens: int, output_tokens: int):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.cached_content_token_count = 0
+        self.thoughts_token_count = 0
+        self.total_token_count = prompt_tokens + output_tokens
+
+
+class _Response:
+    """Minimal stand-in for GenerateContentResponse"""
+
+    def __init__(self, text: Optional[str], usage: Optional[_Usage] = None):
+        self.text = text
+        self.usage_metadata = usage
+        self.function_calls = None
+        self.candidates = []
+
+
+def _estimate_tokens(text: str) -> int:
+    """Rough token count: about four characters per token"""
+    return max(1, len(text) // 4)
+
+
+def _contents_text(contents: Any) -> str:
+    """Flatten the contents argument of generate_content into plain text"""
+    if isinstance(contents, str):
+        return contents
+    if not isinstance(contents, list):
+        contents = [contents]
+
+    texts = []
+    for content in contents:
+        if isinstance(content, str):
+            texts.append(content)
+            continue
+        parts = getattr(content, "parts", None)
+        if parts is None and isinstance(content, dict):
+            parts = content.get("parts", [])
+        for part in parts or []:
+            text = getattr(part, "text", None)
+            if text is None and isinstance(part, dict):
+                text = part.get("text")
+            if text:
+                texts.append(text)
+            result = getattr(part, "function_response", None)
+            if result is not None:
+                texts.append(f"Tool result {result.name}: {json.dumps(result.response, ensure_ascii=False)}")
+    return "\n".join(texts)
+
+
+def _call_response(name: str, args: dict, usage: _Usage) -> _Response:
+    """A response asking for one tool call, shaped like the SDK's"""
+    from google.genai import types
+
+    part = types.Part(function_call=types.FunctionCall(name=name, args=args))
+    response = _Response(None, usage)
+    response.function_calls = [part.function_call]
+    response.candidates = [types.Candidate(content=types.Content(role="model", parts=[part]))]
+    return response
+
+
+def _tool_reply(name: str, result: dict) -> str:
+    """Answer from a tool result, in the bot's voice"""
+    if result.get("error"):
+        return "عذراً، مش قادر أوصل لبيانات الطلبات دلوقتي، جرب كمان شوية 🙏"
+    if name == "check_stock":
+        if result.get("in_stock"):
+            return f"الساعة الكربون الأسود متوفرة دلوقتي، وفاضل منها {result.get('quantity')} قطع بس ⌚"
+        return "للأسف الساعة الكربون الأسود خلصت حالياً، وهتنزل تاني قريب ⌚"
+    line = describe_order(result)
+    if line is None:
+        return "مش لاقي طلب بالرقم ده، اتأكد من الرقم اللي طلبت بيه 📦"
+    return f"أهلاً بك! {line} 🚚"
+
+
+class _Models:
+    def __init__(self, latency: float, token_delay: float):
+        self.latency = latency
+        self.token_delay = token_delay
+
+    def get(self, model: str):
+        return {"name": model}
+
+    def generate_content(self, model: str, contents: Any, config: Any = None) -> _Response:
+        prompt = _contents_text(contents)
+        call = self._tool_call(prompt, config)
+        if call:
+            time.sleep(self.latency)
+            return _call_response(*call, _Usage(_estimate_tokens(prompt), 10))
+        text = self._answer(prompt, config)
+        time.sleep(self.latency + self.token_delay * _estimate_tokens(text))
+        return _Response(text, _Usage(_estimate_tokens(prompt), _estimate_tokens(text)))
+
+    def generate_content_stream(self, model: str, contents: Any, config: Any = None) -> Iterator[_Response]:
+        prompt = _contents_text(contents)
+        call = self._tool_call(prompt, config)
+        if call:
+            time.sleep(self.latency)
+            yield _call_response(*call, _Usage(_estimate_tokens(prompt), 10))
+            return
+        text = self._answer(prompt, config)
+        time.sleep(self.latency)
+
+        words = re.findall(r"\S+\s*", text)
+        for start in range(0, len(words), 4):
+            chunk = "".join(words[start:start + 4])
+            time.sleep(self.token_delay * _estimate_tokens(chunk))
+            yield _Response(chunk)
+        yield _Response(None, _Usage(_estimate_tokens(prompt), _estimate_tokens(text)))
+
+    def _tool_call(self, prompt: str, config: Any) -> Optional[tuple]:
+        """Pick the tool a model would call first, if tools are declared"""
+        if not getattr(config, "tools", None) or "Tool result " in prompt:
+            return None
+        calling = getattr(getattr(config, "tool_config", None), "function_calling_config", None)
+        if calling is not None and str(getattr(calling.mode, "value", calling.mode)) == "NONE":
+            return None
+        match = re.search(r"Current user message: (.*)", prompt, re.DOTALL)
+        message = match.group(1) if match else prompt
+        if is_tracking_request(message):
+            # The number may come from this message or the known customer details
+            phones = extract_phones(message) or extract_phones(prompt)
+            if phones:
+                return "order_status", {"phone": phones[-1]}
+        if STOCK_PATTERN.search(message):
+            return "check_stock", {"product": "ساعة كربون أسود"}
+        return None
+
+    def _answer(self, prompt: str, config: Any) -> str:
+        """Produce an analysis JSON, an answer from a tool result or a canned store answer"""
+        if getattr(config, "response_mime_type", None) == "application/json":
+            match = re.search(r'User message: "(.*)"', prompt, re.DOTALL)
+            analysis = keyword_analysis(match.group(1) if match else prompt)
+            if getattr(config, "response_schema", None) is not None:
+                return encode_analysis(analysis)
+            return json.dumps(analysis, ensure_ascii=False)
+
+        results = re.findall(r"^Tool result (\w+): (.*)$", prompt, re.MULTILINE)
+        if results:
+            name, result = results[-1]
+            return _tool_reply(name, json.loads(result))
+
+        match = re.search(r"Current user message: (.*)", prompt, re.DOTALL)
+        message = match.group(1) if match else prompt
+        return REPLIES.get(keyword_analysis(message)["topic"], REPLIES["general"])
+
+
+class _Caches:
+    def create(self, model: str, config: Any = None):
+        raise NotImplementedError("The local stand-in does not support cached content")
+
+
+class _BatchJob:
+    """Minimal stand-in for BatchJob with inlined responses"""
+
+    def __init__(self, name: str, responses: list):
+        self.name = name
+        self.state = "JOB_STATE_SUCCEEDED"
+        self.error = None
+        self.dest = SimpleNamespace(inlined_responses=responses, file_name=None)
+
+
+class _Batches:
+    def __init__(self, models: _Models):
+        self.models = models
+        self._jobs = {}
+
+    def create(self, model: str, src: list, config: Any = None) -> _BatchJob:
+        responses = []
+        for request in src:
+            request_config = request.get("config") or {}
+            if isinstance(request_config, dict):
+                request_config = SimpleNamespace(**request_config)
+            prompt = _contents_text(request.get("contents", []))
+            text = self.models._answer(prompt, request_config)
+            responses.append(SimpleNamespace(
+                response=_Response(text, _Usage(_estimate_tokens(prompt), _estimate_tokens(text))),
+                error=None,
+                metadata=request.get("metadata")
+            ))
+        job = _BatchJob(f"batches/local-{len(self._jobs) + 1}", responses)
+        self._jobs[job.name] = job
+        return job
+
+    def get(self, name: str) -> _BatchJob:
+        return self._jobs[name]
+
+
+class LocalGeminiClient:
+    """
+    Offline stand-in for genai.Client
+
+    Answers from canned store replies and the keyword analyzer, with a
+    configurable delay, so the app, the evaluation CLI and load tests can
+    run without an API key or quota. Enabled with GEMINI_BACKEND=local.
+    """
+
+    def __init__(self, latency: Optional[float] = None, token_delay: Optional[float] = None):
+        """
+        Initialize the stand-in
+
+        Args:
+            latency: Seconds before the first token (LOCAL_GEMINI_LATENCY)
+            token_delay: Seconds per generated token (LOCAL_GEMINI_TOKEN_DELAY)
+        """
+        if latency is None:
+            latency = float(os.environ.get("LOCAL_GEMINI_LATENCY", "0.3"))
+        if token_delay is None:
+            token_delay = float(os.environ.get("LOCAL_GEMINI_TOKEN_DELAY", "0.005"))
+        self.models = _Models(latency, token_delay)
+        self.caches = _Caches()
+        self.batches = _Batches(self.models)
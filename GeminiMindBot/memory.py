@@ -1,21 +1,104 @@
 import json
+import uuid
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 import os
 
+from slots import extract_slots
+from turn_index import TurnIndex, format_turn
+
+# Bytes read per step when scanning a history file backwards
+TAIL_BLOCK = 64 * 1024
+
+# Rough prompt tokens the earlier turns of a conversation may take in the context
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "800"))
+
+
+def read_tail(path: str, count: int, end: Optional[int] = None) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Read the last JSON lines of a file without reading the rest
+    
+    Args:
+        path: JSONL file
+        count: Number of lines wanted
+        end: Byte offset to read backwards from, defaults to the end of the file
+        
+    Returns:
+        The records, oldest first, and the byte offset of the first one
+    """
+    with open(path, 'rb') as f:
+        if end is None:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+        position = end
+        buffer = b""
+        # One newline more than lines wanted, so the first line is complete
+        while position > 0 and buffer.count(b"\n") <= count:
+            step = min(TAIL_BLOCK, position)
+            position -= step
+            f.seek(position)
+            buffer = f.read(step) + buffer
+    
+    lines = buffer.split(b"\n")
+    offset = position
+    if position > 0:
+        # The first piece is the end of a line that starts further back
+        offset += len(lines[0]) + 1
+        lines = lines[1:]
+    
+    entries = []
+    for line in lines:
+        if line.strip():
+            entries.append((offset, line))
+        offset += len(line) + 1
+    entries = entries[-count:] if count else []
+    
+    records = []
+    for _, line in entries:
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            # A partially written last line
+            continue
+    return records, entries[0][0] if entries else end
+
+
 class ConversationMemory:
     """Manages conversation memory and context for the chatbot"""
     
-    def __init__(self, max_interactions: int = 20):
+    def __init__(self, max_interactions: int = 20, conversation_id: Optional[str] = None,
+                 archive=None, search_index=None,
+                 memory_file: Optional[str] = "conversation_memory.jsonl", writer=None):
         """
         Initialize conversation memory
         
         Args:
             max_interactions: Maximum number of interactions to store
+            conversation_id: Identifier used when the conversation is archived
+            archive: ConversationArchive receiving turns that leave the live store
+            search_index: ConversationSearchIndex updated with every new turn
+            memory_file: File the memory is persisted to, None to keep it in memory only.
+                A .jsonl file is appended to and only its tail is read on load;
+                a .json file is rewritten and read whole
+            writer: WriteBehindWriter that saves in the background; saves are synchronous without one
         """
         self.max_interactions = max_interactions
+        self.conversation_id = conversation_id or f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        self.archive = archive
+        self.search_index = search_index
         self.interactions: List[Dict[str, Any]] = []
-        self.memory_file = "conversation_memory.json"
+        # Customer details extracted locally from this session's messages (name,
+        # phone); not restored from the memory file, which sessions share
+        self.slots: Dict[str, str] = {}
+        # This conversation's turns, for picking the context; the memory file
+        # holds other sessions' turns too
+        self.turn_index = TurnIndex()
+        # This conversation's turns not archived yet
+        self._unarchived: List[Dict[str, Any]] = []
+        self.memory_file = memory_file
+        self.writer = writer
+        # Byte offset in a .jsonl memory file of the oldest turn read so far
+        self._history_start = 0
         self.load_memory()
     
     def add_interaction(self, user_input: str, assistant_response: str, 
@@ -33,41 +116,75 @@ class ConversationMemory:
             "user_input": user_input,
             "assistant_response": assistant_response,
             "timestamp": timestamp,
-            "analysis": analysis or {}
+            "analysis": analysis or {},
+            "conversation_id": self.conversation_id
         }
         
         self.interactions.append(interaction)
+        self._unarchived.append(interaction)
+        self.update_slots(user_input)
+        self.turn_index.add(interaction)
+        
+        if self.search_index is not None:
+            self.search_index.add(self.conversation_id, interaction)
         
-        # Keep only the most recent interactions
+        # Keep only the most recent interactions; only this conversation's are archived
         if len(self.interactions) > self.max_interactions:
             self.interactions = self.interactions[-self.max_interactions:]
+        if len(self._unarchived) > self.max_interactions:
+            self._archive(self._unarchived[:-self.max_interactions])
+            self._unarchived = self._unarchived[-self.max_interactions:]
         
-        self.save_memory()
+        if self._append_only:
+            self._append(json.dumps(interaction, ensure_ascii=False) + "\n")
+        else:
+            self.save_memory()
     
-    def get_context(self, num_interactions: int = 5) -> str:
+    def get_context(self, num_interactions: int = 5, query: Optional[str] = None,
+                    max_tokens: int = CONTEXT_TOKEN_BUDGET) -> str:
         """
         Get conversation context for the chatbot
         
         Args:
-            num_interactions: Number of recent interactions to include
+            num_interactions: Maximum number of earlier turns to include
+            query: The new user message; earlier turns relevant to it are
+                picked besides the last two, otherwise only the latest are sent
+            max_tokens: Rough token budget for the turns
             
         Returns:
             Formatted context string
         """
-        if not self.interactions:
+        if not len(self.turn_index) and not self.slots:
             return ""
         
-        # Get the most recent interactions
-        recent_interactions = self.interactions[-num_interactions:]
+        if query:
+            turns = self.turn_index.select(query, limit=num_interactions, max_tokens=max_tokens)
+        else:
+            turns = self.turn_index.select("", limit=num_interactions, recent=num_interactions,
+                                           max_tokens=max_tokens)
         
         context_parts = []
-        for interaction in recent_interactions:
-            context_parts.append(f"User: {interaction['user_input']}")
-            context_parts.append(f"Assistant: {interaction['assistant_response']}")
+        if self.slots.get("name") or self.slots.get("phone"):
+            details = [f"{key}={self.slots[key]}" for key in ("name", "phone") if self.slots.get(key)]
+            context_parts.append(f"Known customer details: {', '.join(details)}")
             context_parts.append("---")
+        context_parts.extend(format_turn(interaction) for interaction in turns)
         
         return "\n".join(context_parts)
     
+    def update_slots(self, user_input: str) -> Dict[str, str]:
+        """
+        Merge the slots found in a user message into the conversation slots
+        
+        Args:
+            user_input: User's message
+            
+        Returns:
+            The updated slots
+        """
+        self.slots.update(extract_slots(user_input))
+        return self.slots
+    
     def get_memory_summary(self) -> str:
         """
         Generate a summary of the conversation memory
@@ -75,14 +192,16 @@ class ConversationMemory:
         Returns:
             Summary of key topics and themes
         """
-        if not self.interactions:
+        # A .json memory file holds other sessions' turns too
+        interactions = self._own(self.interactions)
+        if not interactions:
             return ""
         
         # Extract topics and intents from analysis data
         topics = set()
         intents = set()
         
-        for interaction in self.interactions:
+        for interaction in interactions:
             analysis = interaction.get("analysis", {})
             if "topic" in analysis:
                 topics.add(analysis["topic"])
@@ -97,7 +216,7 @@ class ConversationMemory:
         if intents:
             summary_parts.append(f"User intents: {', '.join(intents)}")
         
-        summary_parts.append(f"Total interactions: {len(self.interactions)}")
+        summary_parts.append(f"Total interactions: {len(interactions)}")
         
         return "\n".join(summary_parts)
     
@@ -106,12 +225,61 @@ class ConversationMemory:
         return len(self.interactions)
     
     def clear_memory(self):
-        """Clear all stored interactions"""
-        self.interactions = []
-        self.save_memory()
+        """
+        Clear this conversation's interactions
+        
+        They are archived and dropped from memory. Other sessions' turns
+        stay: a .json memory file is rewritten without this conversation's
+        turns, and the shared .jsonl file is left as it is.
+        """
+        self._archive(self._unarchived)
+        self._unarchived = []
+        self.interactions = [interaction for interaction in self.interactions
+                             if interaction.get("conversation_id") != self.conversation_id]
+        self.slots = {}
+        self.turn_index.clear()
+        self._history_start = 0
+        if not self._append_only:
+            self.save_memory()
+    
+    def _archive(self, interactions: List[Dict[str, Any]]):
+        """Hand interactions leaving the live store to the archive"""
+        if self.archive and interactions:
+            self.archive.archive_conversation(self.conversation_id, interactions)
+    
+    def _own(self, interactions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """This conversation's turns among turns read from the shared memory file"""
+        return [interaction for interaction in interactions
+                if interaction.get("conversation_id") == self.conversation_id]
+    
+    @property
+    def _append_only(self) -> bool:
+        return bool(self.memory_file) and self.memory_file.endswith(".jsonl")
+    
+    def _append(self, text: str):
+        """Append to the .jsonl memory file, in the background if a writer is set"""
+        if self.writer is not None:
+            self.writer.append(self.memory_file, text)
+            return
+        try:
+            with open(self.memory_file, 'a', encoding='utf-8') as f:
+                f.write(text)
+        except Exception as e:
+            print(f"Failed to save memory: {str(e)}")
     
     def save_memory(self):
-        """Save memory to a JSON file"""
+        """
+        Save memory to a .json file
+        
+        Does nothing for a .jsonl file: every turn is appended to it as it
+        is added, and rewriting it would drop other sessions' turns.
+        """
+        if not self.memory_file or self._append_only:
+            return
+        if self.writer is not None:
+            # A copy, since the list keeps changing while the write is queued
+            self.writer.submit(self.memory_file, list(self.interactions))
+            return
         try:
             with open(self.memory_file, 'w') as f:
                 json.dump(self.interactions, f, indent=2)
@@ -119,15 +287,56 @@ class ConversationMemory:
             print(f"Failed to save memory: {str(e)}")
     
     def load_memory(self):
-        """Load memory from a JSON file"""
+        """Load memory from a JSON file, or only the recent turns of a .jsonl file"""
         try:
-            if os.path.exists(self.memory_file):
-                with open(self.memory_file, 'r') as f:
-                    self.interactions = json.load(f)
+            if self._append_only and not os.path.exists(self.memory_file):
+                self._migrate(self.memory_file[:-1])
+            if self.memory_file and os.path.exists(self.memory_file):
+                if self._append_only:
+                    # The file's tail holds other sessions' turns too
+                    tail, self._history_start = read_tail(self.memory_file, self.max_interactions)
+                    self.interactions = self._own(tail)
+                else:
+                    with open(self.memory_file, 'r') as f:
+                        self.interactions = json.load(f)
         except Exception as e:
             print(f"Failed to load memory: {str(e)}")
             self.interactions = []
     
+    def _migrate(self, legacy_file: str):
+        """Convert a .json memory file from before append-only storage, once"""
+        if not os.path.exists(legacy_file):
+            return
+        with open(legacy_file, 'r') as f:
+            interactions = json.load(f)
+        with open(self.memory_file, 'w', encoding='utf-8') as f:
+            f.write("".join(json.dumps(i, ensure_ascii=False) + "\n" for i in interactions))
+    
+    def load_older(self, count: int = 20) -> List[Dict[str, Any]]:
+        """
+        Read turns older than those in memory, on demand
+        
+        Each call continues further back; the turns are returned rather
+        than kept, so memory stays bounded. Other sessions' turns in the
+        shared file are skipped.
+        
+        Args:
+            count: Least number of this conversation's turns to read, if there are that many
+            
+        Returns:
+            Older turns, oldest first; empty when the start of the file is reached
+        """
+        if not self._append_only or not os.path.exists(self.memory_file):
+            return []
+        older: List[Dict[str, Any]] = []
+        try:
+            while len(older) < count and self._history_start > 0:
+                rows, self._history_start = read_tail(self.memory_file, count, end=self._history_start)
+                older = self._own(rows) + older
+        except Exception as e:
+            print(f"Failed to load older memory: {str(e)}")
+        return older
+    
     def get_user_preferences(self) -> Dict[str, Any]:
         """
         Extract user preferences from conversation history
@@ -141,8 +350,10 @@ class ConversationMemory:
             "complexity_preference": "unknown"
         }
         
+        interactions = self._own(self.interactions)
+        
         # Count topic frequencies
-        for interaction in self.interactions:
+        for interaction in interactions:
             analysis = interaction.get("analysis", {})
             topic = analysis.get("topic")
             if topic:
@@ -150,7 +361,7 @@ class ConversationMemory:
         
         # Analyze complexity preferences
         complexities = [interaction.get("analysis", {}).get("complexity") 
-                       for interaction in self.interactions]
+                       for interaction in interactions]
         complexities = [c for c in complexities if c]
         
         if complexities:
@@ -161,3 +372,57 @@ class ConversationMemory:
             preferences["complexity_preference"] = max(complexity_counts.keys(), key=lambda x: complexity_counts[x])
         
         return preferences
+
+
+if __name__ == "__main__":
+    import time
+    import shutil
+    import argparse
+    import tempfile
+    
+    parser = argparse.ArgumentParser(description="Benchmark session construction against history size")
+    parser.add_argument("--max-mb", type=float, default=1024, help="Largest history file, in MB")
+    parser.add_argument("--legacy-max-mb", type=float, default=64, help="Largest .json file to load whole")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    
+    line = json.dumps({
+        "user_input": "عايز أعرف سعر الساعة والشحن لإسكندرية",
+        "assistant_response": "أهلاً بك! الساعة الكربون الأسود بـ 400 جنيه مصري، والتوصيل خلال 3-4 أيام 🚚" * 3,
+        "timestamp": datetime.now().isoformat(),
+        "analysis": {"intent": "question", "sentiment": "curious", "topic": "product",
+                     "complexity": "simple", "keywords": ["سعر", "الساعة", "الشحن"]}
+    }, ensure_ascii=False) + "\n"
+    
+    directory = tempfile.mkdtemp()
+    try:
+        size = 1024
+        while size <= args.max_mb * 1024 * 1024:
+            path = os.path.join(directory, "history.jsonl")
+            count = max(1, size // len(line.encode("utf-8")))
+            with open(path, "w", encoding="utf-8") as f:
+                for start in range(0, count, 10000):
+                    f.write(line * min(10000, count - start))
+            
+            timings = {}
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                ConversationMemory(memory_file=path)
+            timings["jsonl_ms"] = (time.perf_counter() - started) * 1000 / args.repeat
+            
+            if size <= args.legacy_max_mb * 1024 * 1024:
+                legacy = os.path.join(directory, "history.json")
+                with open(path, "r", encoding="utf-8") as f, open(legacy, "w", encoding="utf-8") as out:
+                    json.dump([json.loads(entry) for entry in f], out)
+                started = time.perf_counter()
+                for _ in range(args.repeat):
+                    ConversationMemory(memory_file=legacy)
+                timings["json_ms"] = (time.perf_counter() - started) * 1000 / args.repeat
+                os.remove(legacy)
+            
+            os.remove(path)
+            label = f"{size / 1024:.0f} KB" if size < 1024 * 1024 else f"{size / 1024 / 1024:.0f} MB"
+            print(f"{label:>8} {count:>9} turns  " + "  ".join(f"{k}={v:.2f}" for k, v in timings.items()))
+            size *= 4
+    finally:
+        shutil.rmtree(directory)
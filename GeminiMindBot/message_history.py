@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import logging
+import weakref
+from typing import Any, Dict, Iterator, List
+
+# Spill files untouched for this many seconds belong to sessions that are gone
+PAGES_MAX_AGE = 24 * 3600
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _prune_pages(directory: str):
+    """Delete the spill files of sessions idle for longer than PAGES_MAX_AGE"""
+    cutoff = time.time() - PAGES_MAX_AGE
+    try:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+    except OSError:
+        pass
+
+
+class MessageHistory:
+    """Chat messages of one session with only the recent ones kept in memory"""
+
+    def __init__(self, conversation_id: str, keep: int = 40, page_size: int = 20,
+                 directory: str = "message_pages"):
+        """
+        Initialize an empty history
+
+        The spill file is deleted when the conversation is cleared or the
+        history is garbage collected with its session; files left behind
+        by a crash are pruned once they are older than PAGES_MAX_AGE.
+
+        Args:
+            conversation_id: Conversation the messages belong to; names the spill file
+            keep: Messages kept in memory and rendered
+            page_size: Messages spilled to disk, and loaded back, at a time
+            directory: Directory holding one spill file per conversation
+        """
+        self.conversation_id = conversation_id
+        self.keep = keep
+        self.page_size = page_size
+        self.directory = directory
+        self.recent: List[Dict[str, Any]] = []
+        self.earlier: List[Dict[str, Any]] = []
+        # Byte offset of each spilled page, oldest first
+        self._pages: List[int] = []
+        self._loaded_pages = 0
+        _prune_pages(directory)
+
+    @property
+    def spill_file(self) -> str:
+        return os.path.join(self.directory, f"{self.conversation_id}.jsonl")
+
+    @property
+    def has_earlier(self) -> bool:
+        """Whether spilled pages remain that are not loaded"""
+        return self._loaded_pages < len(self._pages)
+
+    def append(self, message: Dict[str, Any]):
+        """
+        Add a message, spilling the oldest page once the memory budget is reached
+
+        Pages loaded with load_earlier are dropped again, so a new turn
+        always renders only the recent messages.
+
+        Args:
+            message: Message with role, content and timestamp
+        """
+        self.recent.append(message)
+        self.earlier = []
+        self._loaded_pages = 0
+        if len(self.recent) >= self.keep + self.page_size:
+            self._spill(self.recent[:self.page_size])
+            self.recent = self.recent[self.page_size:]
+
+    def load_earlier(self) -> int:
+        """
+        Load the next older page from disk
+
+        Returns:
+            Number of messages loaded
+        """
+        if not self.has_earlier:
+            return 0
+        index = len(self._pages) - 1 - self._loaded_pages
+        end = self._pages[index + 1] if index + 1 < len(self._pages) else None
+        try:
+            with open(self.spill_file, "rb") as f:
+                f.seek(self._pages[index])
+                data = f.read() if end is None else f.read(end - self._pages[index])
+        except OSError as e:
+            logging.error(f"Failed to load earlier messages: {str(e)}")
+            return 0
+
+        page = [json.loads(line) for line in data.decode("utf-8").splitlines() if line]
+        self.earlier = page + self.earlier
+        self._loaded_pages += 1
+        return len(page)
+
+    def clear(self, conversation_id: str):
+        """
+        Forget all messages, deleting their spill file, and start a new conversation
+
+        Args:
+            conversation_id: Identifier of the new conversation
+        """
+        if self._pages:
+            _remove(self.spill_file)
+        self.recent = []
+        self.earlier = []
+        self._pages = []
+        self._loaded_pages = 0
+        self.conversation_id = conversation_id
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        """Messages to render: loaded earlier pages, then the recent ones"""
+        yield from self.earlier
+        yield from self.recent
+
+    def __len__(self) -> int:
+        return len(self.earlier) + len(self.recent)
+
+    def _spill(self, messages: List[Dict[str, Any]]):
+        """Append a page of messages to the conversation's spill file"""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.spill_file, "ab") as f:
+                offset = f.tell()
+                f.write("".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages).encode("utf-8"))
+            if not self._pages:
+                # The file goes when the session's history does
+                weakref.finalize(self, _remove, self.spill_file)
+            self._pages.append(offset)
+        except OSError as e:
+            # Dropping the page keeps memory bounded; it only disappears from view
+            logging.error(f"Failed to spill messages: {str(e)}")
@@ -0,0 +1,350 @@
+"""
+Speculative answers to the customer's likely next question
+
+Usage:
+    python prefetch.py train search_journal.jsonl -o prefetch_model.json
+    python prefetch.py predict prefetch_model.json product information
+
+A FollowUpPredictor learns from stored conversations which topic usually
+follows which, and the most common question asked for each topic. While
+the customer reads an answer, the Prefetcher generates answers to the top
+predicted questions in the background, and serves one when the next
+message is close enough to the question it answered.
+"""
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from admission import PRIORITY_PREFETCH
+from analyzer import keyword_analysis
+from ledger import call_cost, conversation
+from search_index import analyze_text
+
+# Transitions seen less often than this from a topic/intent pair fall back to the topic alone
+MIN_SUPPORT = 5
+
+# Share of terms a message must have in common with a predicted question to be served its answer
+MATCH_THRESHOLD = float(os.environ.get("PREFETCH_MATCH", "0.5"))
+
+# Seconds a matching message waits for its speculative answer to finish before a live
+# call is made; kept short, since the live call would otherwise start this much later
+TAKE_TIMEOUT = float(os.environ.get("PREFETCH_WAIT", "0.15"))
+
+
+def _state(analysis: Dict[str, Any]) -> Tuple[str, str]:
+    return analysis.get("topic") or "general", analysis.get("intent") or "question"
+
+
+def similarity(first: str, second: str) -> float:
+    """Jaccard similarity of the index terms of two messages"""
+    a, b = set(analyze_text(first)), set(analyze_text(second))
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+class FollowUpPredictor:
+    """Topic transition counts with the most asked question per topic"""
+
+    def __init__(self, transitions: Optional[Dict[str, Dict[str, int]]] = None,
+                 questions: Optional[Dict[str, str]] = None):
+        """
+        Initialize a predictor, usually from load()
+
+        Args:
+            transitions: Next-topic counts keyed by "topic/intent" and by "topic"
+            questions: Representative question per topic
+        """
+        self.transitions = {state: Counter(counts) for state, counts in (transitions or {}).items()}
+        self.questions = dict(questions or {})
+
+    @classmethod
+    def train(cls, paths: List[str]) -> "FollowUpPredictor":
+        """
+        Count topic transitions in stored conversations
+
+        Turns are labelled with keyword_analysis of their user input, like
+        the messages the predictor is asked about when serving; the stored
+        analysis is a placeholder for typed messages.
+
+        Args:
+            paths: JSONL files with conversation_id, timestamp and user_input
+                per row, e.g. search_journal.jsonl
+
+        Returns:
+            The trained predictor
+        """
+        conversations: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        for path in paths:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if row.get("conversation_id") and row.get("user_input"):
+                        conversations[row["conversation_id"]].append(row)
+
+        transitions: Dict[str, Counter] = defaultdict(Counter)
+        asked: Dict[str, Counter] = defaultdict(Counter)
+        for rows in conversations.values():
+            rows.sort(key=lambda row: row.get("timestamp", ""))
+            states = [_state(keyword_analysis(row["user_input"])) for row in rows]
+            for row, (topic, _) in zip(rows, states):
+                asked[topic][row["user_input"].strip()] += 1
+            for (topic, intent), (next_topic, _) in zip(states, states[1:]):
+                transitions[f"{topic}/{intent}"][next_topic] += 1
+                transitions[topic][next_topic] += 1
+
+        questions = {topic: counts.most_common(1)[0][0] for topic, counts in asked.items()}
+        return cls(transitions, questions)
+
+    def predict(self, analysis: Dict[str, Any], top_k: int = 2) -> List[Tuple[str, float, str]]:
+        """
+        Predict the next question after a turn
+
+        Args:
+            analysis: Analysis of the customer's last message
+            top_k: Number of predictions
+
+        Returns:
+            Next topic, its probability and the question to answer, most likely first
+        """
+        topic, intent = _state(analysis)
+        counts = self.transitions.get(f"{topic}/{intent}")
+        if not counts or sum(counts.values()) < MIN_SUPPORT:
+            counts = self.transitions.get(topic)
+        if not counts:
+            return []
+        total = sum(counts.values())
+        return [(next_topic, count / total, self.questions[next_topic])
+                for next_topic, count in counts.most_common(top_k) if next_topic in self.questions]
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"transitions": self.transitions, "questions": self.questions}, f,
+                      ensure_ascii=False, indent=2)
+
+    @classmethod
+    def load(cls, path: str) -> "FollowUpPredictor":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["transitions"], data["questions"])
+
+
+class _Speculation:
+    """One answer generated ahead of the question"""
+
+    def __init__(self, question: str, future: Future):
+        self.question = question
+        self.future = future
+        self.started = time.perf_counter()
+
+
+class Prefetcher:
+    """Generates likely next answers in the background and serves them on a match"""
+
+    def __init__(self, chatbot, predictor: FollowUpPredictor, top_k: int = 1,
+                 min_probability: float = 0.3, daily_budget: float = 1.0, max_workers: int = 4):
+        """
+        Initialize the prefetcher
+
+        Args:
+            chatbot: ChatBot generating the answers
+            predictor: Trained FollowUpPredictor
+            top_k: Answers generated per turn, 1 or 2
+            min_probability: Predictions less likely than this are not generated
+            daily_budget: USD spent on speculative answers per day before pausing
+            max_workers: Speculative generations running at once
+        """
+        self.chatbot = chatbot
+        self.predictor = predictor
+        self.top_k = top_k
+        self.min_probability = min_probability
+        self.daily_budget = daily_budget
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._pending: Dict[str, List[_Speculation]] = {}
+        self._lock = threading.Lock()
+        self._day = time.strftime("%Y%m%d")
+        self._spent_today = 0.0
+        self._stats = {"scheduled": 0, "generated": 0, "served": 0, "missed_turns": 0, "timed_out": 0,
+                       "over_budget": 0, "tokens": 0, "wasted_tokens": 0, "spent_usd": 0.0,
+                       "latency_saved_ms": 0.0}
+
+    def schedule(self, conversation_id: str, message: str, get_context: Callable[[str], str]):
+        """
+        Start generating the likely next answers of a conversation
+
+        Replaces the conversation's earlier speculations, which were not used.
+
+        Args:
+            conversation_id: Conversation the answers are for
+            message: The customer's last message
+            get_context: Builds the conversation context for a message, as the
+                live turn does, e.g. lambda question: memory.get_context(query=question)
+        """
+        predictions = [prediction for prediction in self.predictor.predict(keyword_analysis(message), self.top_k)
+                       if prediction[1] >= self.min_probability]
+        contexts = [(question, get_context(question)) for _, _, question in predictions]
+        with self._lock:
+            self._discard(self._pending.pop(conversation_id, []))
+            if self._over_budget():
+                self._stats["over_budget"] += len(predictions)
+                return
+            speculations = []
+            for question, context in contexts:
+                future = self._pool.submit(self._generate, conversation_id, question, context)
+                speculations.append(_Speculation(question, future))
+                self._stats["scheduled"] += 1
+            if speculations:
+                self._pending[conversation_id] = speculations
+
+    def take(self, conversation_id: str, message: str) -> Optional[str]:
+        """
+        Get a prepared answer for the customer's new message
+
+        Args:
+            conversation_id: Conversation of the message
+            message: The new message
+
+        Returns:
+            The speculative answer if one matches and is ready within
+            TAKE_TIMEOUT, otherwise None
+        """
+        with self._lock:
+            speculations = self._pending.pop(conversation_id, [])
+        if not speculations:
+            return None
+
+        best = max(speculations, key=lambda speculation: similarity(message, speculation.question))
+        if similarity(message, best.question) < MATCH_THRESHOLD:
+            with self._lock:
+                self._stats["missed_turns"] += 1
+                self._discard(speculations)
+            return None
+
+        waited = time.perf_counter()
+        try:
+            answer, tokens, generation_ms = best.future.result(timeout=TAKE_TIMEOUT)
+        except FutureTimeout:
+            # Still queued or generating: the live call is made and this answer goes to waste
+            with self._lock:
+                self._stats["timed_out"] += 1
+                self._discard(speculations)
+            return None
+        except Exception as e:
+            logging.error(f"Speculative answer failed: {str(e)}")
+            with self._lock:
+                self._discard([speculation for speculation in speculations if speculation is not best])
+            return None
+        waited_ms = (time.perf_counter() - waited) * 1000
+        with self._lock:
+            self._discard([speculation for speculation in speculations if speculation is not best])
+            if answer is None:
+                return None
+            self._stats["served"] += 1
+            # The customer only waited for what was left of the generation
+            self._stats["latency_saved_ms"] += max(0.0, generation_ms - waited_ms)
+        return answer
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit rate, wasted-token rate, spend and latency saved"""
+        with self._lock:
+            stats = dict(self._stats)
+        turns = stats["served"] + stats["missed_turns"] + stats["timed_out"]
+        stats["hit_rate"] = round(stats["served"] / turns, 3) if turns else 0.0
+        stats["wasted_token_rate"] = round(stats["wasted_tokens"] / stats["tokens"], 3) if stats["tokens"] else 0.0
+        stats["avg_latency_saved_ms"] = round(stats["latency_saved_ms"] / stats["served"], 1) if stats["served"] else 0.0
+        stats["latency_saved_ms"] = round(stats["latency_saved_ms"], 1)
+        stats["spent_usd"] = round(stats["spent_usd"], 6)
+        return stats
+
+    def _generate(self, conversation_id: str, question: str, context: str) -> Tuple[Optional[str], int, float]:
+        """Answer a predicted question on a pool thread; None if no model call was made"""
+        started = time.perf_counter()
+        with conversation(conversation_id):
+            answer = self.chatbot.generate_response(question, context=context,
+                                                    analysis=keyword_analysis(question),
+                                                    route="prefetch", priority=PRIORITY_PREFETCH)
+        elapsed = (time.perf_counter() - started) * 1000
+        usage = self.chatbot.last_usage
+        if not usage:
+            # Fallbacks and errors come back as text without a model call
+            return None, 0, elapsed
+        tokens = usage.get("prompt_tokens", 0) + usage.get("output_tokens", 0) + usage.get("thought_tokens", 0)
+        cost = call_cost(self.chatbot.model_name, usage)
+        with self._lock:
+            self._stats["generated"] += 1
+            self._stats["tokens"] += tokens
+            self._stats["spent_usd"] += cost
+            self._spent_today += cost
+        return answer, tokens, elapsed
+
+    def _discard(self, speculations: List[_Speculation]):
+        """Count unused answers as waste, once they finish; lock held"""
+        for speculation in speculations:
+            speculation.future.add_done_callback(self._wasted)
+
+    def _wasted(self, future: Future):
+        try:
+            _, tokens, _ = future.result()
+        except Exception as e:
+            logging.error(f"Speculative answer failed: {str(e)}")
+            return
+        with self._lock:
+            self._stats["wasted_tokens"] += tokens
+
+    def _over_budget(self) -> bool:
+        """Whether today's speculative spend is used up; lock held"""
+        today = time.strftime("%Y%m%d")
+        if today != self._day:
+            self._day = today
+            self._spent_today = 0.0
+        return self.daily_budget > 0 and self._spent_today >= self.daily_budget
+
+
+def load_predictor(path: Optional[str] = None) -> Optional[FollowUpPredictor]:
+    """
+    Load the trained predictor configured by PREFETCH_MODEL
+
+    Args:
+        path: Model file; defaults to PREFETCH_MODEL or prefetch_model.json
+
+    Returns:
+        The predictor, or None if prefetching is disabled or not trained
+    """
+    path = path if path is not None else os.environ.get("PREFETCH_MODEL", "prefetch_model.json")
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        return FollowUpPredictor.load(path)
+    except (OSError, ValueError, KeyError) as e:
+        logging.error(f"Prefetch model unavailable: {str(e)}")
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train or inspect the follow-up predictor")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    train_parser = subparsers.add_parser("train")
+    train_parser.add_argument("files", nargs="+", help="search_journal.jsonl or similar")
+    train_parser.add_argument("-o", "--output", default="prefetch_model.json")
+    predict_parser = subparsers.add_parser("predict")
+    predict_parser.add_argument("model")
+    predict_parser.add_argument("topic")
+    predict_parser.add_argument("intent", nargs="?", default="question")
+    args = parser.parse_args()
+
+    if args.command == "train":
+        predictor = FollowUpPredictor.train(args.files)
+        predictor.save(args.output)
+        print(json.dumps({"states": len(predictor.transitions), "topics": len(predictor.questions)}))
+    else:
+        predictor = FollowUpPredictor.load(args.model)
+        for next_topic, probability, question in predictor.predict({"topic": args.topic, "intent": args.intent}, 3):
+            print(json.dumps({"topic": next_topic, "probability": round(probability, 3),
+                              "question": question}, ensure_ascii=False))
@@ -0,0 +1,256 @@
+import os
+import sys
+import hmac
+import json
+import time
+import random
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+# Share of turns profiled without a session toggle, 0 disables sampling
+SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+# Number of profiled turns kept; older ones are deleted
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "50"))
+INTERVAL = float(os.environ.get("PROFILE_INTERVAL_MS", "5")) / 1000
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+# Profiled turns can overlap; tracemalloc runs while any of them does
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+_tracing_owned = False
+
+# This module's frames and allocations are left out of the profiles
+_OWN_FILE = os.path.abspath(__file__)
+
+
+class _StackSampler(threading.Thread):
+    """Samples one thread's stack at a fixed interval into collapsed stacks"""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="turn-profiler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                if os.path.abspath(code.co_filename) != _OWN_FILE:
+                    names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(names))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+class _NullTurn:
+    """Profiler stand-in for turns that are not profiled"""
+
+    enabled = False
+
+    def mark(self, name: str):
+        pass
+
+    def finish(self):
+        pass
+
+
+_NULL_TURN = _NullTurn()
+
+
+class TurnProfile:
+    """Statistical profile and allocation snapshot of one chat turn"""
+
+    enabled = True
+
+    def __init__(self, label: str, directory: str = PROFILE_DIR, interval: float = INTERVAL):
+        """
+        Start profiling the calling thread
+
+        Args:
+            label: Identifies the turn in file names, e.g. the conversation id
+            directory: Rotating directory the profiles are written to
+            interval: Seconds between stack samples
+        """
+        self.label = label
+        self.directory = directory
+        self.started = time.perf_counter()
+        self._previous = self.started
+        self.phases: Dict[str, float] = {}
+        _start_tracing()
+        self._sampler = _StackSampler(threading.get_ident(), interval)
+        self._sampler.start()
+
+    def mark(self, name: str):
+        """
+        Record that a phase of the turn has finished
+
+        Args:
+            name: Phase name, e.g. "analysis" or "persist"
+        """
+        now = time.perf_counter()
+        self.phases[name] = round((now - self._previous) * 1000, 1)
+        self._previous = now
+
+    def finish(self) -> Optional[str]:
+        """
+        Stop profiling and write the results
+
+        Returns:
+            Base path of the written files, None if writing failed
+        """
+        self._sampler.stop()
+        duration = round((time.perf_counter() - self.started) * 1000, 1)
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, _OWN_FILE),
+            tracemalloc.Filter(False, tracemalloc.__file__)
+        ])
+        _stop_tracing()
+
+        base = os.path.join(self.directory, f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{self.label}")
+        top = snapshot.statistics("lineno")[:20]
+        meta = {
+            "label": self.label,
+            "created": datetime.now().isoformat(),
+            "duration_ms": duration,
+            "phases": self.phases,
+            "samples": self._sampler.samples,
+            "interval_ms": round(self._sampler.interval * 1000, 2),
+            "top_allocations": [
+                {"location": str(stat.traceback[0]), "kb": round(stat.size / 1024, 1), "count": stat.count}
+                for stat in top
+            ]
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(base + ".folded", "w", encoding="utf-8") as f:
+                for stack, count in self._sampler.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            snapshot.dump(base + ".tracemalloc")
+            with open(base + ".json", "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False, indent=2)
+            _rotate(self.directory, PROFILE_KEEP)
+        except OSError as e:
+            logging.error(f"Failed to write turn profile: {str(e)}")
+            return None
+        logging.info(f"Profiled turn {self.label}: {duration}ms, {self._sampler.samples} samples")
+        return base
+
+
+def _start_tracing():
+    global _tracing_users, _tracing_owned
+    with _tracing_lock:
+        if _tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            _tracing_owned = True
+        _tracing_users += 1
+
+
+def _stop_tracing():
+    global _tracing_users, _tracing_owned
+    with _tracing_lock:
+        _tracing_users -= 1
+        if _tracing_users == 0 and _tracing_owned:
+            tracemalloc.stop()
+            _tracing_owned = False
+
+
+def start_turn(session_enabled: bool, label: str):
+    """
+    Start profiling a turn if the session asked for it or it was sampled
+
+    Args:
+        session_enabled: Per-session toggle
+        label: Identifies the turn, e.g. the conversation id
+
+    Returns:
+        A TurnProfile, or a shared no-op stand-in when the turn is not profiled
+    """
+    if session_enabled or (SAMPLE_RATE and random.random() < SAMPLE_RATE):
+        try:
+            return TurnProfile(label)
+        except Exception as e:
+            logging.error(f"Failed to start turn profile: {str(e)}")
+    return _NULL_TURN
+
+
+def is_admin(token: Optional[str]) -> bool:
+    """Check a token against ADMIN_TOKEN; always False when none is configured"""
+    return bool(ADMIN_TOKEN) and token is not None and hmac.compare_digest(
+        token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+
+def list_profiles(directory: str = PROFILE_DIR) -> List[Dict[str, Any]]:
+    """
+    Read the metadata of the stored profiles
+
+    Returns:
+        Profile metadata with its base path, newest first
+    """
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(directory), reverse=True):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        meta["base"] = os.path.join(directory, name[:-len(".json")])
+        profiles.append(meta)
+    return profiles
+
+
+def _rotate(directory: str, keep: int):
+    """Delete all but the newest profiles"""
+    bases = sorted({name.rsplit(".", 1)[0] for name in os.listdir(directory)}, reverse=True)
+    for base in bases[keep:]:
+        for extension in (".json", ".folded", ".tracemalloc"):
+            path = os.path.join(directory, base + extension)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def render_admin_page():
+    """Streamlit view of the stored profiles"""
+    import streamlit as st
+
+    st.title("Turn profiles")
+    st.caption(f"Sample rate {SAMPLE_RATE:.2%} • add ?profile=<token> to a chat URL to profile that session")
+    profiles = list_profiles()
+    if not profiles:
+        st.info("No profiles recorded yet")
+        return
+
+    for meta in profiles:
+        title = f"{meta['created']} • {meta['label']} • {meta['duration_ms']} ms"
+        with st.expander(title):
+            st.write("Phases (ms)")
+            st.json(meta["phases"])
+            st.write(f"{meta['samples']} stack samples every {meta['interval_ms']} ms")
+            st.dataframe(meta["top_allocations"])
+            for extension, help_text in ((".folded", "flamegraph.pl / speedscope input"),
+                                         (".tracemalloc", "tracemalloc.Snapshot.load input")):
+                path = meta["base"] + extension
+                if os.path.exists(path):
+                    with open(path, "rb") as f:
+                        st.download_button(f"Download {extension}", f.read(),
+                                           file_name=os.path.basename(path), help=help_text,
+                                           key=path)
@@ -0,0 +1,329 @@
+"""
+Offline relabeling of stored interactions
+
+Usage:
+    python relabel.py search_journal.jsonl conversation_memory.jsonl
+    GEMINI_BACKEND=local python relabel.py search_journal.jsonl --workers 4
+
+Interactions saved with the placeholder analysis from app.py are labeled
+with the keyword analyzer in a process pool. Those it cannot classify are
+sent to Gemini as a single Batch API job instead of one interactive call
+each. Labeled rows are stamped with LABELS_VERSION and skipped by later
+runs; rows left ambiguous because the batch failed are retried.
+
+JSONL journals are never rewritten, since the app appends to them and its
+search index points into them by byte offset: labels are appended to a
+sidecar (search_index.labels_file) keyed by each row's offset, which the
+index merges when it loads. The running app sees them after a restart.
+JSON memory files are small and rewritten whole.
+"""
+import os
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from ledger import record_usage
+from gemini_client import usage_from_response
+from analyzer import QuestionAnalyzer, AnalysisParseError, decode_analysis, keyword_analysis
+from search_index import FILTER_FIELDS, labels_file, read_labels, apply_labels
+
+# Bump when the labeling rules change to relabel everything once more
+LABELS_VERSION = 1
+
+# Analysis app.py stores when no real analysis was made
+PLACEHOLDER_ANALYSIS = {
+    "intent": "question",
+    "sentiment": "neutral",
+    "topic": "general",
+    "complexity": "moderate"
+}
+
+TERMINAL_STATES = ("JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED",
+                   "JOB_STATE_EXPIRED", "JOB_STATE_PARTIALLY_SUCCEEDED")
+
+
+def needs_relabel(row: Dict[str, Any]) -> bool:
+    """Check whether a stored interaction still carries the placeholder analysis"""
+    if row.get("labels_version", 0) >= LABELS_VERSION:
+        return False
+    if row.get("label_source") == "keyword":
+        # Left ambiguous by an earlier run whose batch failed
+        return True
+    analysis = row.get("analysis") or {}
+    if analysis.get("keywords"):
+        return False
+    return all(analysis.get(field, value) == value for field, value in PLACEHOLDER_ANALYSIS.items())
+
+
+def is_ambiguous(analysis: Dict[str, Any]) -> bool:
+    """Keyword results that need the model: a question about nothing recognised"""
+    return analysis["intent"] == "question" and analysis["topic"] == "general"
+
+
+def _label_row(row: Dict[str, Any]) -> Tuple[bool, Optional[str]]:
+    """
+    Label one stored row in place with the keyword analyzer
+
+    Returns:
+        Whether it changed, and the question if the model should decide
+    """
+    if not needs_relabel(row):
+        return False, None
+
+    question = row.get("user_input", "")
+    analysis = keyword_analysis(question)
+    _apply(row, analysis, "keyword")
+    if is_ambiguous(analysis):
+        # Stored with keyword labels but no version, so a failed batch is retried
+        return True, question
+    row["labels_version"] = LABELS_VERSION
+    return True, None
+
+
+def _label_journal_row(item: Tuple[int, str, Optional[Dict[str, Any]]]) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """
+    Label one journal row, with its earlier corrected labels merged in; runs in a pool worker
+
+    Returns:
+        The sidecar entry to append if the labels changed, and the question if the model should decide
+    """
+    offset, line, entry = item
+    if not line.strip():
+        return None, None
+    row = apply_labels(json.loads(line), entry)
+    changed, question = _label_row(row)
+    if not changed:
+        return None, None
+    return _label_entry(offset, row), question
+
+
+def _label_entry(offset: int, row: Dict[str, Any]) -> Dict[str, Any]:
+    entry = {"offset": offset, "analysis": row["analysis"], "label_source": row["label_source"]}
+    if "labels_version" in row:
+        entry["labels_version"] = row["labels_version"]
+    return entry
+
+
+def _apply(row: Dict[str, Any], analysis: Dict[str, Any], source: str):
+    """Merge labels into a row's analysis, keeping the journal's reduced analysis shape"""
+    if "keywords" not in (row.get("analysis") or {}):
+        # Search journal rows only carry the filterable fields
+        analysis = {field: analysis.get(field) for field in FILTER_FIELDS}
+    row["analysis"] = dict(row.get("analysis") or {}, **analysis)
+    row["label_source"] = source
+
+
+class Relabeler:
+    """Relabels JSONL journals and JSON memory files in place"""
+
+    def __init__(self, workers: Optional[int] = None, chunksize: int = 256,
+                 max_batch: int = 10000, poll_interval: float = 30.0,
+                 use_batch: bool = True):
+        """
+        Initialize the relabeler
+
+        Args:
+            workers: Keyword analysis processes, defaults to the CPU count
+            chunksize: Rows handed to a worker at a time
+            max_batch: Most distinct questions sent in one batch job; the rest wait for the next run
+            poll_interval: Seconds between batch job status checks
+            use_batch: Whether ambiguous rows go to the Batch API at all
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.chunksize = chunksize
+        self.max_batch = max_batch
+        self.poll_interval = poll_interval
+        self.analyzer = QuestionAnalyzer() if use_batch else None
+        self.stats = {"rows": 0, "keyword": 0, "batch": 0, "pending": 0}
+
+    def relabel_file(self, path: str) -> Dict[str, int]:
+        """
+        Relabel one file of stored interactions
+
+        Args:
+            path: A search journal (JSONL) or conversation memory file (JSON list)
+
+        Returns:
+            Counters for this file
+        """
+        before = dict(self.stats)
+        if path.endswith(".jsonl"):
+            self._relabel_journal(path)
+        else:
+            self._relabel_memory(path)
+        return {name: self.stats[name] - before[name] for name in self.stats}
+
+    def _relabel_journal(self, path: str):
+        """Label a JSONL journal through the pool, appending the new labels to its sidecar"""
+        end = os.path.getsize(path)
+        labels = read_labels(path)
+        ambiguous: Dict[str, None] = {}
+        pending: Dict[int, Dict[str, Any]] = {}
+
+        with open(path, "rb") as source, \
+                open(labels_file(path), "a", encoding="utf-8") as target, \
+                multiprocessing.Pool(self.workers) as pool:
+            items = ((offset, line, labels.get(offset)) for offset, line in self._lines(source, end))
+            for entry, question in pool.imap(_label_journal_row, items, self.chunksize):
+                self.stats["rows"] += 1
+                if entry is None:
+                    continue
+                self._count(question)
+                row = dict(entry, user_input=question)
+                offset = row.pop("offset")
+                if labels.get(offset) != {key: entry[key] for key in entry if key != "offset"}:
+                    # Rows still ambiguous from an earlier run already have these labels
+                    target.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                if question:
+                    pending[offset] = row
+                    if len(ambiguous) < self.max_batch:
+                        ambiguous[question] = None
+
+            batch_labels = self._batch_labels(list(ambiguous))
+            for offset, row in pending.items():
+                if self._apply_batch(row, batch_labels):
+                    target.write(json.dumps(_label_entry(offset, row), ensure_ascii=False) + "\n")
+
+    def _relabel_memory(self, path: str):
+        """Relabel a conversation memory file, which is small enough to load"""
+        with open(path, "r", encoding="utf-8") as f:
+            interactions = json.load(f)
+
+        ambiguous: Dict[str, None] = {}
+        rows = []
+        changed = False
+        for interaction in interactions:
+            self.stats["rows"] += 1
+            row = json.loads(json.dumps(interaction, ensure_ascii=False))
+            relabeled, question = _label_row(row)
+            rows.append(row)
+            if relabeled:
+                changed = True
+                self._count(question)
+            if question and len(ambiguous) < self.max_batch:
+                ambiguous[question] = None
+
+        if not changed:
+            return
+        labels = self._batch_labels(list(ambiguous))
+        for row in rows:
+            self._apply_batch(row, labels)
+
+        temporary = path + ".relabel"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+        os.replace(temporary, path)
+
+    def _batch_labels(self, questions: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Label the ambiguous questions with one Batch API job
+
+        Args:
+            questions: Distinct questions the keyword analysis could not place
+
+        Returns:
+            Validated analysis per question; empty if the job failed
+        """
+        if not questions or self.analyzer is None:
+            return {}
+
+        config = self.analyzer.generation_config()
+        requests = [{
+            "contents": [{"role": "user", "parts": [{"text": self.analyzer.build_prompt(question)}]}],
+            "config": config
+        } for question in questions]
+
+        client = self.analyzer.client
+        try:
+            job = client.batches.create(
+                model=self.analyzer.model_name,
+                src=requests,
+                config={"display_name": f"relabel-{time.strftime('%Y%m%d')}"}
+            )
+            logging.info(f"Submitted batch {job.name} with {len(requests)} questions")
+            while self._state(job) not in TERMINAL_STATES:
+                time.sleep(self.poll_interval)
+                job = client.batches.get(name=job.name)
+        except Exception as e:
+            logging.error(f"Batch relabeling failed: {str(e)}")
+            return {}
+
+        if self._state(job) not in ("JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"):
+            logging.error(f"Batch {job.name} ended in {self._state(job)}")
+            return {}
+
+        labels = {}
+        responses = job.dest.inlined_responses if job.dest else None
+        for question, result in zip(questions, responses or []):
+            if result.error or result.response is None:
+                continue
+            record_usage("batch", self.analyzer.model_name, usage_from_response(result.response))
+            try:
+                labels[question] = decode_analysis(result.response.text)
+            except AnalysisParseError as e:
+                # Left with the keyword labels already written, and retried by the next run
+                logging.warning(f"Batch label rejected for {question!r}: {str(e)}")
+        return labels
+
+    @staticmethod
+    def _state(job) -> str:
+        return getattr(job.state, "name", str(job.state))
+
+    def _apply_batch(self, row: Dict[str, Any], labels: Dict[str, Dict[str, Any]]) -> bool:
+        """Apply batch labels to a row still waiting for them"""
+        if row.get("labels_version", 0) >= LABELS_VERSION or row.get("label_source") != "keyword":
+            return False
+        analysis = labels.get(row.get("user_input", ""))
+        if analysis is None:
+            return False
+        _apply(row, analysis, "batch")
+        row["labels_version"] = LABELS_VERSION
+        self.stats["batch"] += 1
+        self.stats["pending"] -= 1
+        return True
+
+    @staticmethod
+    def _lines(source, end: int) -> Iterator[Tuple[int, str]]:
+        """Byte offset and text of the journal's lines up to the size it had when the run started"""
+        position = 0
+        for line in source:
+            if position + len(line) > end:
+                break
+            yield position, line.decode("utf-8")
+            position += len(line)
+
+    def _count(self, question: Optional[str]):
+        if question:
+            self.stats["pending"] += 1
+        else:
+            self.stats["keyword"] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relabel stored interactions offline")
+    parser.add_argument("files", nargs="+", help="search_journal.jsonl and/or conversation_memory.jsonl")
+    parser.add_argument("-w", "--workers", type=int, help="Keyword analysis processes")
+    parser.add_argument("--max-batch", type=int, default=10000, help="Questions per batch job")
+    parser.add_argument("--poll", type=float, default=30.0, help="Seconds between batch status checks")
+    parser.add_argument("--no-batch", action="store_true", help="Only apply keyword labels")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    relabeler = Relabeler(workers=args.workers, max_batch=args.max_batch,
+                          poll_interval=args.poll, use_batch=not args.no_batch)
+    for path in args.files:
+        if not os.path.exists(path):
+            logging.warning(f"Skipping missing file {path}")
+            continue
+        started = time.perf_counter()
+        counters = relabeler.relabel_file(path)
+        counters["seconds"] = round(time.perf_counter() - started, 1)
+        print(json.dumps({"file": path, **counters}, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+
+class _Namespace:
+    """LRU entries of one tenant with their byte total"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+class ResponseCache:
+    """Answers to context-free questions, in per-tenant namespaces with memory quotas"""
+
+    def __init__(self, ttl: float = 24 * 3600, default_quota: int = 8 * 1024 * 1024):
+        """
+        Initialize the cache
+
+        Args:
+            ttl: Seconds an answer stays valid
+            default_quota: Bytes per namespace unless set_quota says otherwise
+        """
+        self.ttl = ttl
+        self.default_quota = default_quota
+        self._namespaces: Dict[str, _Namespace] = {}
+        self._lock = threading.Lock()
+
+    def set_quota(self, namespace: str, max_bytes: int):
+        """Set the memory quota of a namespace, evicting if it shrank"""
+        with self._lock:
+            space = self._namespace(namespace)
+            space.max_bytes = max_bytes
+            self._evict(space)
+
+    def get(self, namespace: str, key: str) -> Optional[str]:
+        """
+        Look up an answer
+
+        Args:
+            namespace: Tenant id
+            key: Request key, see single_flight.request_key
+
+        Returns:
+            The cached answer, or None
+        """
+        with self._lock:
+            space = self._namespace(namespace)
+            entry = space.entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    self._remove(space, key)
+                space.misses += 1
+                return None
+            space.entries.move_to_end(key)
+            space.hits += 1
+            return entry[0]
+
+    def put(self, namespace: str, key: str, text: str):
+        """
+        Store an answer
+
+        Args:
+            namespace: Tenant id
+            key: Request key
+            text: The answer
+        """
+        size = len(text.encode("utf-8"))
+        with self._lock:
+            space = self._namespace(namespace)
+            if size > space.max_bytes:
+                return
+            if key in space.entries:
+                self._remove(space, key)
+            space.entries[key] = (text, time.monotonic() + self.ttl)
+            space.bytes += size
+            self._evict(space)
+
+    def invalidate(self, namespace: str) -> int:
+        """
+        Drop all cached answers of a namespace
+
+        Args:
+            namespace: Tenant id
+
+        Returns:
+            Number of entries dropped
+        """
+        with self._lock:
+            space = self._namespace(namespace)
+            keys = list(space.entries)
+            for key in keys:
+                self._remove(space, key)
+            return len(keys)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Entries, bytes, quota and hit counters per namespace"""
+        with self._lock:
+            return {name: {
+                "entries": len(space.entries), "bytes": space.bytes, "max_bytes": space.max_bytes,
+                "hits": space.hits, "misses": space.misses, "evictions": space.evictions
+            } for name, space in self._namespaces.items()}
+
+    def _namespace(self, namespace: str) -> _Namespace:
+        """Get or create a namespace; lock held"""
+        space = self._namespaces.get(namespace)
+        if space is None:
+            space = self._namespaces[namespace] = _Namespace(self.default_quota)
+        return space
+
+    def _remove(self, space: _Namespace, key: str):
+        text, _ = space.entries.pop(key)
+        space.bytes -= len(text.encode("utf-8"))
+
+    def _evict(self, space: _Namespace):
+        """Drop least recently used entries until the namespace fits its quota; lock held"""
+        while space.bytes > space.max_bytes and space.entries:
+            self._remove(space, next(iter(space.entries)))
+            space.evictions += 1
+
+
+# Process-wide cache shared by every tenant's ChatBot
+shared_response_cache = ResponseCache(ttl=float(os.environ.get("RESPONSE_CACHE_TTL", str(24 * 3600))))
@@ -0,0 +1,393 @@
+import os
+import re
+import json
+import math
+import heapq
+import logging
+import threading
+from array import array
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+# Harakat, tanween, shadda, sukun, superscript alef
+DIACRITICS = re.compile(r"[ً-ْٰ]")
+TOKEN_PATTERN = re.compile(r"\w+")
+
+CHARACTER_MAP = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ؤ": "و", "ئ": "ي", "ى": "ي", "ة": "ه",
+    "ـ": None,
+    "٠": "0", "١": "1", "٢": "2", "٣": "3", "٤": "4",
+    "٥": "5", "٦": "6", "٧": "7", "٨": "8", "٩": "9",
+})
+
+# Light stemming affixes, longest first
+PREFIXES = ("وبال", "وكال", "وال", "بال", "كال", "فال", "لل", "ال", "و", "ب", "ل", "ف")
+SUFFIXES = ("هما", "كما", "ات", "ان", "ون", "ين", "يه", "ها", "هم", "كم", "نا", "ه", "ي")
+
+# Journal lines indexed per lock hold while loading in the background
+LOAD_BATCH = 1000
+
+# Analysis fields that can be used as filters
+FILTER_FIELDS = ("intent", "sentiment", "topic", "complexity")
+
+# Corrected labels are appended next to a journal instead of rewriting it
+LABELS_SUFFIX = ".labels"
+
+
+def normalize_arabic(text: str) -> str:
+    """Unify alef/hamza/yaa/taa marbuta, strip diacritics and tatweel, convert digits"""
+    return DIACRITICS.sub("", text).translate(CHARACTER_MAP).lower()
+
+
+def light_stem(token: str) -> str:
+    """Strip one common prefix and one common suffix, keeping at least 3 letters"""
+    if token.isdigit():
+        return token
+    for prefix in PREFIXES:
+        if token.startswith(prefix) and len(token) - len(prefix) >= 3:
+            token = token[len(prefix):]
+            break
+    for suffix in SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            token = token[:-len(suffix)]
+            break
+    return token
+
+
+def analyze_text(text: str) -> List[str]:
+    """Turn text into index terms"""
+    return [light_stem(token) for token in TOKEN_PATTERN.findall(normalize_arabic(text))]
+
+
+def labels_file(journal_file: str) -> str:
+    """Sidecar holding the corrected labels of a journal's rows"""
+    return journal_file + LABELS_SUFFIX + ".jsonl"
+
+
+def read_labels(journal_file: str) -> Dict[int, Dict[str, Any]]:
+    """
+    Read the corrected labels of a journal
+
+    The sidecar is append-only; a later entry for a row replaces an earlier one.
+
+    Args:
+        journal_file: Journal the labels belong to
+
+    Returns:
+        Label entry (analysis, label_source, labels_version) by the row's byte offset in the journal
+    """
+    labels: Dict[int, Dict[str, Any]] = {}
+    path = labels_file(journal_file)
+    if not os.path.exists(path):
+        return labels
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A partially written last line
+                continue
+            labels[entry.pop("offset")] = entry
+    return labels
+
+
+def apply_labels(row: Dict[str, Any], entry: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """A journal row with its corrected labels merged in"""
+    if not entry:
+        return row
+    row = dict(row, **{key: value for key, value in entry.items() if key != "analysis"})
+    row["analysis"] = dict(row.get("analysis") or {}, **entry.get("analysis", {}))
+    return row
+
+
+class ConversationSearchIndex:
+    """Inverted index over user inputs and assistant responses with BM25 ranking"""
+
+    def __init__(self, journal_file: Optional[str] = "search_journal.jsonl",
+                 k1: float = 1.2, b: float = 0.75, writer=None):
+        """
+        Initialize the index and start loading the journal in the background
+
+        Only the postings and the journal offset of each turn are kept in
+        memory; the turns themselves are read back from the journal for the
+        hits a search returns. Searches made before loading finishes only
+        see the turns loaded so far. Labels corrected by relabel.py are
+        merged in from the journal's sidecar as it stood when loading began.
+
+        Args:
+            journal_file: Append-only log of indexed turns, None to keep the index in memory only
+            k1: BM25 term frequency saturation
+            b: BM25 length normalization
+            writer: WriteBehindWriter appending to the journal in the background;
+                appends are synchronous without one
+        """
+        self.journal_file = journal_file
+        self.k1 = k1
+        self.b = b
+        self.writer = writer
+        self._count = 0
+        # Journal byte offset of each document, or the documents themselves without a journal
+        self._offsets = array("Q")
+        self._documents: List[Dict[str, Any]] = []
+        self._postings: Dict[str, array] = {}
+        self._frequencies: Dict[str, array] = {}
+        self._lengths = array("I")
+        self._total_length = 0
+        self._fields: Dict[str, Dict[str, set]] = {
+            field: {} for field in FILTER_FIELDS + ("conversation_id",)
+        }
+        self._norms: Optional[array] = None
+        self._norms_count = 0
+        self._average_length = 1.0
+        self._lock = threading.Lock()
+        # Orders journal appends so offsets match where the lines land
+        self._journal_lock = threading.Lock()
+        self._journal_end = 0
+        self._labels: Dict[int, Dict[str, Any]] = {}
+        self._loaded = threading.Event()
+
+        if journal_file and os.path.exists(journal_file):
+            self._journal_end = os.path.getsize(journal_file)
+            threading.Thread(target=self._replay, args=(self._journal_end,),
+                             name="search-index-load", daemon=True).start()
+        else:
+            self._loaded.set()
+
+    def wait_loaded(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for the journal to finish loading
+
+        Args:
+            timeout: Seconds to wait, None to wait indefinitely
+
+        Returns:
+            Whether the index is fully loaded
+        """
+        return self._loaded.wait(timeout)
+
+    def add(self, conversation_id: str, interaction: Dict[str, Any]) -> int:
+        """
+        Index one turn
+
+        Args:
+            conversation_id: Conversation the turn belongs to
+            interaction: Interaction as stored by ConversationMemory
+
+        Returns:
+            Document id of the turn
+        """
+        document = {
+            "conversation_id": conversation_id,
+            "user_input": interaction.get("user_input", ""),
+            "assistant_response": interaction.get("assistant_response", ""),
+            "timestamp": interaction.get("timestamp", ""),
+            "analysis": {field: interaction.get("analysis", {}).get(field) for field in FILTER_FIELDS}
+        }
+
+        offset = 0
+        if self.journal_file:
+            line = json.dumps(document, ensure_ascii=False) + "\n"
+            with self._journal_lock:
+                offset = self._journal_end
+                self._journal_end += len(line.encode("utf-8"))
+                if self.writer is not None:
+                    self.writer.append(self.journal_file, line)
+                else:
+                    try:
+                        with open(self.journal_file, "a", encoding="utf-8") as f:
+                            f.write(line)
+                    except OSError as e:
+                        logging.error(f"Failed to write search journal: {str(e)}")
+
+        with self._lock:
+            return self._index(document, offset)
+
+    def search(self, query: str, limit: int = 10, conversation_id: Optional[str] = None,
+               **filters: str) -> List[Dict[str, Any]]:
+        """
+        Find the turns best matching a query
+
+        Args:
+            query: Free text; Arabic is normalized and stemmed like the documents
+            limit: Maximum number of results
+            conversation_id: Only search this conversation
+            filters: Exact matches on analysis fields, e.g. topic="shipping"
+
+        Returns:
+            Matching turns with their score, best first
+        """
+        terms = set(analyze_text(query))
+        with self._lock:
+            allowed = self._filter(conversation_id, filters)
+            if allowed is not None and not allowed:
+                return []
+
+            count = self._count
+            if not count:
+                return []
+            norms = self._length_norms()
+            scores: Dict[int, float] = {}
+
+            for term in terms:
+                postings = self._postings.get(term)
+                if postings is None:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                frequencies = self._frequencies[term]
+                for doc_id, frequency in zip(postings, frequencies):
+                    if allowed is not None and doc_id not in allowed:
+                        continue
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norms[doc_id])
+
+            best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+            if not self.journal_file:
+                return [dict(self._documents[doc_id], score=round(score, 4)) for doc_id, score in best]
+            offsets = [self._offsets[doc_id] for doc_id, _ in best]
+
+        documents = self._read(offsets)
+        return [dict(document, score=round(score, 4))
+                for document, (_, score) in zip(documents, best) if document is not None]
+
+    def _length_norms(self) -> array:
+        """
+        BM25 length normalization per document; lock held
+
+        Recomputed only when the collection grew noticeably, since the
+        average length barely moves between single additions.
+        """
+        count = self._count
+        if self._norms is None or count > self._norms_count * 1.05:
+            self._average_length = (self._total_length / count) or 1.0
+            self._norms = array("f", (self._norm(length) for length in self._lengths))
+            self._norms_count = count
+        elif len(self._norms) < count:
+            self._norms.extend(self._norm(length) for length in self._lengths[len(self._norms):])
+        return self._norms
+
+    def _norm(self, length: int) -> float:
+        return self.k1 * (1 - self.b + self.b * length / self._average_length)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _index(self, document: Dict[str, Any], offset: int) -> int:
+        """Add a document to the in-memory structures; lock held"""
+        doc_id = self._count
+        self._count += 1
+        if self.journal_file:
+            self._offsets.append(offset)
+        else:
+            self._documents.append(document)
+
+        terms = analyze_text(f"{document['user_input']} {document['assistant_response']}")
+        for term, frequency in Counter(terms).items():
+            if term not in self._postings:
+                self._postings[term] = array("I")
+                self._frequencies[term] = array("H")
+            self._postings[term].append(doc_id)
+            self._frequencies[term].append(min(frequency, 65535))
+        self._lengths.append(len(terms))
+        self._total_length += len(terms)
+
+        for field, value in document["analysis"].items():
+            if value:
+                self._fields[field].setdefault(value, set()).add(doc_id)
+        self._fields["conversation_id"].setdefault(document["conversation_id"], set()).add(doc_id)
+        return doc_id
+
+    def _filter(self, conversation_id: Optional[str], filters: Dict[str, str]) -> Optional[set]:
+        """Document ids allowed by the filters, None when unfiltered; lock held"""
+        if conversation_id is not None:
+            filters = dict(filters, conversation_id=conversation_id)
+        allowed = None
+        for field, value in filters.items():
+            if field not in self._fields:
+                raise ValueError(f"Unknown filter field: {field}")
+            ids = self._fields[field].get(value, set())
+            allowed = ids if allowed is None else allowed & ids
+        return allowed
+
+    def _read(self, offsets: List[int]) -> List[Optional[Dict[str, Any]]]:
+        """Read documents back from the journal; None for any that can't be read"""
+        if self.writer is not None and offsets:
+            try:
+                written = os.path.getsize(self.journal_file)
+            except OSError:
+                written = 0
+            if max(offsets) >= written:
+                # A hit is still queued in the write-behind writer
+                self.writer.flush()
+
+        documents = []
+        try:
+            with open(self.journal_file, "rb") as f:
+                for offset in offsets:
+                    f.seek(offset)
+                    try:
+                        documents.append(apply_labels(json.loads(f.readline()), self._labels.get(offset)))
+                    except ValueError:
+                        documents.append(None)
+        except OSError as e:
+            logging.error(f"Failed to read search journal: {str(e)}")
+            return [None] * len(offsets)
+        return documents
+
+    def _replay(self, end: int):
+        """Index the journal up to a byte offset, in batches so searches can run meanwhile"""
+        try:
+            # Only the filterable fields of corrected labels are kept
+            self._labels = {offset: {"analysis": {field: entry.get("analysis", {}).get(field)
+                                                  for field in FILTER_FIELDS}}
+                            for offset, entry in read_labels(self.journal_file).items()}
+            with open(self.journal_file, "rb") as f:
+                offset = 0
+                batch = []
+                while offset < end:
+                    line = f.readline()
+                    if not line:
+                        break
+                    if line.strip():
+                        try:
+                            batch.append((offset, apply_labels(json.loads(line), self._labels.get(offset))))
+                        except ValueError:
+                            # A partially written line
+                            pass
+                    offset += len(line)
+                    if len(batch) >= LOAD_BATCH:
+                        self._index_batch(batch)
+                        batch = []
+                self._index_batch(batch)
+        except Exception as e:
+            logging.error(f"Failed to load search journal: {str(e)}")
+        finally:
+            self._loaded.set()
+
+    def _index_batch(self, batch: List[Any]):
+        with self._lock:
+            for offset, document in batch:
+                self._index(document, offset)
+
+
+if __name__ == "__main__":
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Search stored conversations")
+    parser.add_argument("query")
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--journal", default="search_journal.jsonl")
+    for field in FILTER_FIELDS:
+        parser.add_argument(f"--{field}")
+    args = parser.parse_args()
+
+    index = ConversationSearchIndex(args.journal)
+    index.wait_loaded()
+    filters = {field: getattr(args, field) for field in FILTER_FIELDS if getattr(args, field)}
+    start = time.perf_counter()
+    hits = index.search(args.query, limit=args.limit, **filters)
+    elapsed = (time.perf_counter() - start) * 1000
+
+    for hit in hits:
+        print(json.dumps(hit, ensure_ascii=False))
+    print(f"{len(hits)} of {len(index)} turns in {elapsed:.1f} ms")
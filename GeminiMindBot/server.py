@@ -0,0 +1,14 @@
+"""
+Entry point serving the chat app together with the audio upload endpoint
+
+Run with `streamlit run server.py`. In server STT mode the voice component
+streams microphone audio to the endpoint while the customer speaks and shows
+partial transcripts, without rerunning the script per chunk. Started with
+`streamlit run app.py` the endpoint is missing and the component falls back
+to sending each utterance as one component value.
+"""
+import streamlit as st
+
+import speech_to_text
+
+app = st.App("app.py", routes=speech_to_text.upload_routes(st.get_option("server.baseUrlPath") or ""))
@@ -0,0 +1,213 @@
+import re
+import json
+import hashlib
+import threading
+from typing import Any, Callable, Dict, Iterator, List
+
+
+def normalize_request_text(text: str) -> str:
+    """Normalize text so trivially different copies of a question match"""
+    text = text.replace("ـ", "")  # Tatweel
+    text = re.sub(r"[ً-ْ]", "", text)  # Diacritics
+    text = re.sub(r"[؟?!.،,]+", " ", text)
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def request_key(*parts: Any) -> str:
+    """
+    Build a key identifying an upstream request
+
+    Strings are normalized, anything else is serialized as JSON, and the
+    whole key is hashed so long contexts don't bloat the in-flight table.
+
+    Args:
+        parts: Model name, prompt, context, analysis, ...
+
+    Returns:
+        Hex digest identifying the request
+    """
+    material = []
+    for part in parts:
+        if isinstance(part, str):
+            material.append(normalize_request_text(part))
+        else:
+            material.append(json.dumps(part, sort_keys=True, ensure_ascii=False, default=str))
+    return hashlib.sha256("\x1f".join(material).encode("utf-8")).hexdigest()
+
+
+class _Call:
+    """One in-flight request shared by its leader and followers"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.done = False
+        self.result = None
+        self.error = None
+        self.chunks: List[Any] = []
+        # Shared upstream stream, read by whichever consumer needs the next chunk first
+        self.iterator = None
+        self.pumping = False
+        self.consumers = 0
+
+
+class SingleFlight:
+    """Coalesces identical concurrent requests into one upstream call"""
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """
+        Run fn once for all concurrent callers with the same key
+
+        Args:
+            key: Request key, see request_key
+            fn: Performs the upstream call
+
+        Returns:
+            The leader's result; its exception is raised for every caller
+        """
+        call, leader = self._join(key)
+
+        if not leader:
+            with call.condition:
+                call.condition.wait_for(lambda: call.done)
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            self._finish(key, call)
+
+    def stream(self, key: str, fn: Callable[[], Iterator[Any]]) -> Iterator[Any]:
+        """
+        Share one upstream stream between all concurrent callers with the same key
+
+        Followers first replay the chunks already received and then get new
+        chunks as they arrive, so joining late costs nothing. Whichever
+        caller needs the next chunk first reads it from upstream, so a
+        caller that stops early (e.g. its session reran) leaves the stream
+        to the others; it is only closed once every caller has stopped.
+
+        Args:
+            key: Request key, see request_key
+            fn: Starts the upstream stream
+
+        Yields:
+            Stream chunks
+        """
+        call, leader = self._join(key)
+
+        if leader:
+            try:
+                iterator = iter(fn())
+            except Exception as e:
+                call.error = e
+                self._finish(key, call)
+                self._leave(key, call)
+                raise
+            with call.condition:
+                call.iterator = iterator
+                call.condition.notify_all()
+
+        index = 0
+        try:
+            while True:
+                with call.condition:
+                    call.condition.wait_for(lambda: call.done or index < len(call.chunks) or
+                                            (call.iterator is not None and not call.pumping))
+                    pending = call.chunks[index:]
+                    finished = call.done
+                    pump = not pending and not finished
+                    if pump:
+                        call.pumping = True
+                if pump:
+                    self._pump(key, call)
+                    continue
+                for chunk in pending:
+                    index += 1
+                    yield chunk
+                if finished and index >= len(call.chunks):
+                    break
+        finally:
+            self._leave(key, call)
+
+        if call.error is not None:
+            raise call.error
+
+    def stats(self) -> Dict[str, int]:
+        """Get how many calls went upstream and how many were coalesced"""
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "leaders": self.leaders,
+                "followers": self.followers
+            }
+
+    def _join(self, key: str):
+        """Join the in-flight call for key or become its leader"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.followers += 1
+                call.consumers += 1
+                return call, False
+            call = _Call()
+            call.consumers = 1
+            self._calls[key] = call
+            self.leaders += 1
+            return call, True
+
+    def _pump(self, key: str, call: _Call):
+        """Read the next upstream chunk for every caller; one caller at a time"""
+        try:
+            chunk = next(call.iterator)
+        except StopIteration:
+            self._finish(key, call)
+            return
+        except Exception as e:
+            call.error = e
+            self._finish(key, call)
+            return
+        with call.condition:
+            call.chunks.append(chunk)
+            call.pumping = False
+            call.condition.notify_all()
+
+    def _leave(self, key: str, call: _Call):
+        """Drop a stream caller; the last one to stop early closes the upstream stream"""
+        with self._lock:
+            call.consumers -= 1
+            abandoned = call.consumers == 0 and not call.done
+            if abandoned and self._calls.get(key) is call:
+                # Nobody can join a stream that is about to be closed
+                del self._calls[key]
+        if not abandoned:
+            return
+        call.error = call.error or RuntimeError("Stream abandoned by every caller")
+        self._finish(key, call)
+        close = getattr(call.iterator, "close", None)
+        if close is not None:
+            close()
+
+    def _finish(self, key: str, call: _Call):
+        """Remove the call from the table and wake its followers"""
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        with call.condition:
+            call.done = True
+            call.condition.notify_all()
+
+
+# Process-wide instance shared by every Streamlit session
+shared_flight = SingleFlight()
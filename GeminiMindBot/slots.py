@@ -0,0 +1,104 @@
+import re
+from typing import Callable, Dict, List, Optional
+
+TRACKING_URL = "https://3qrab.netlify.app/track-order?phone={phone}"
+
+# Egyptian mobile numbers, in Latin or Arabic-Indic digits, with optional +20/0020
+PHONE_PATTERN = re.compile(r"(?<!\d)(?:\+?20|0020)?0?1[0125]\d{8}(?!\d)")
+ARABIC_DIGITS = str.maketrans("٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹", "01234567890123456789")
+DIGIT_SEPARATORS = re.compile(r"(?<=\d)[\s-](?=\d)")
+
+# "اسمي أحمد", "أنا اسمي أحمد", "معاك أحمد", "my name is Ahmed"; first name only
+NAME_PATTERN = re.compile(r"(?:اسمي|إسمي|معاك|معاكي|my name is)\s+([^\W\d_]{2,20})", re.IGNORECASE)
+# Words that can follow "معاك" but are not names
+NOT_NAMES = {"رقم", "مشكلة", "سؤال", "استفسار", "طلب", "عايز", "عاوز", "محتاج", "عندي", "ايه", "إيه", "مين"}
+
+# Questions about an order already placed, not about ordering or shipping in general
+TRACKING_PATTERN = re.compile(
+    r"تتبع|اتابع|أتابع|متابعة|طلبي|اوردري|أوردري|شحنتي|فين (?:الطلب|الاوردر|الأوردر|الشحنة)|track",
+    re.IGNORECASE
+)
+
+
+def normalize_digits(text: str) -> str:
+    """Convert Arabic-Indic digits and join digits split by spaces or dashes"""
+    return DIGIT_SEPARATORS.sub("", text.translate(ARABIC_DIGITS))
+
+
+def extract_phones(text: str) -> List[str]:
+    """Find Egyptian mobile numbers in text, normalized to 01XXXXXXXXX"""
+    phones = []
+    for match in PHONE_PATTERN.finditer(normalize_digits(text)):
+        phone = "0" + match.group()[-10:]
+        if phone not in phones:
+            phones.append(phone)
+    return phones
+
+
+def extract_name(text: str) -> Optional[str]:
+    """Find a customer introducing themselves by name"""
+    match = NAME_PATTERN.search(text)
+    if not match or match.group(1) in NOT_NAMES:
+        return None
+    return match.group(1)
+
+
+def extract_slots(text: str) -> Dict[str, str]:
+    """
+    Extract conversation slots from a user message
+
+    Args:
+        text: User message
+
+    Returns:
+        The slots found: name and/or phone
+    """
+    slots = {}
+    name = extract_name(text)
+    if name:
+        slots["name"] = name
+    phones = extract_phones(text)
+    if phones:
+        slots["phone"] = phones[-1]
+    return slots
+
+
+def is_tracking_request(text: str) -> bool:
+    """Check whether a message asks about an existing order"""
+    return bool(TRACKING_PATTERN.search(text))
+
+
+def tracking_link(phone: str, url: str = TRACKING_URL) -> str:
+    return url.format(phone=phone)
+
+
+def tracking_reply(text: str, slots: Dict[str, str], url: str = TRACKING_URL,
+                   lookup: Optional[Callable[[str], Optional[str]]] = None) -> Optional[str]:
+    """
+    Answer an order tracking request without calling the model
+
+    Args:
+        text: Current user message
+        slots: Conversation slots, including those from this message; the
+            "awaiting" slot is set while a phone number was asked for
+        url: Tracking page template with a {phone} field, per tenant
+        lookup: Returns a status line for the order placed with a phone, if known
+
+    Returns:
+        The reply, or None if the message is not for tracking
+    """
+    awaiting_phone = slots.get("awaiting") == "phone"
+    if not (is_tracking_request(text) or (awaiting_phone and extract_phones(text))):
+        return None
+
+    greeting = f"أهلاً {slots['name']}!" if slots.get("name") else "أهلاً بك!"
+    phone = slots.get("phone")
+    if not phone:
+        slots["awaiting"] = "phone"
+        return f"{greeting} ابعتلي رقم الموبايل اللي طلبت بيه علشان أجيبلك رابط تتبع الطلب 📦"
+
+    slots.pop("awaiting", None)
+    status = lookup(phone) if lookup else None
+    if status:
+        greeting = f"{greeting} {status}"
+    return f"{greeting} تقدر تتابع طلبك من هنا: {tracking_link(phone, url)} 🚚"
@@ -0,0 +1,325 @@
+import os
+import json
+import time
+import uuid
+import wave
+import asyncio
+import logging
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional
+
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+try:
+    import vosk
+except ImportError:  # Optional dependency, only needed for server-side STT
+    vosk = None
+
+# Recognizers are fed 16-bit mono PCM at this rate
+SAMPLE_RATE = 16000
+
+# Shared pool so transcription never runs on a Streamlit script thread.
+# Vosk releases the GIL inside the recognizer, so threads scale across cores.
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("STT_WORKERS", max(1, (os.cpu_count() or 2) // 2))),
+    thread_name_prefix="stt"
+)
+
+# Transcribers accepting audio over the upload endpoint, by stream token.
+# The session holds the transcriber, so its entry goes away with the session.
+_upload_streams: "weakref.WeakValueDictionary[str, StreamingTranscriber]" = weakref.WeakValueDictionary()
+
+# Largest audio upload accepted in one request (30 s of audio)
+MAX_UPLOAD_BYTES = SAMPLE_RATE * 2 * 30
+
+
+def is_available() -> bool:
+    """Check whether server-side speech recognition can be used"""
+    return vosk is not None and bool(os.environ.get("VOSK_MODEL_PATH"))
+
+
+@lru_cache(maxsize=2)
+def _load_model(model_path: str):
+    """Load a Vosk model once per process; they take hundreds of MB"""
+    vosk.SetLogLevel(-1)
+    return vosk.Model(model_path)
+
+
+class StreamingTranscriber:
+    """Transcribes one stream of audio chunks with a local CPU model"""
+
+    def __init__(self, model_path: Optional[str] = None, sample_rate: int = SAMPLE_RATE,
+                 stable_chunks: int = 3, on_final: Optional[Callable[[str], None]] = None):
+        """
+        Initialize the transcriber
+
+        Args:
+            model_path: Vosk model directory (defaults to VOSK_MODEL_PATH)
+            sample_rate: Sample rate of the incoming PCM audio
+            stable_chunks: Unchanged partials after which the text counts as final
+            on_final: Called with each final transcript as soon as it is known
+        """
+        if vosk is None:
+            raise RuntimeError("Server-side speech recognition requires the 'vosk' package")
+
+        model_path = model_path or os.environ.get("VOSK_MODEL_PATH", "")
+        if not model_path:
+            raise ValueError("VOSK_MODEL_PATH environment variable is required")
+
+        self.recognizer = vosk.KaldiRecognizer(_load_model(model_path), sample_rate)
+        self.sample_rate = sample_rate
+        self.stable_chunks = stable_chunks
+        self.on_final = on_final
+
+        self.partial = ""
+        self.finals = []
+        self._unchanged = 0
+        self._pending = deque()
+        self._draining = False
+        self._lock = threading.Lock()
+
+    def accept_chunk(self, pcm: bytes) -> Dict[str, Any]:
+        """
+        Feed a chunk of audio synchronously
+
+        Args:
+            pcm: 16-bit little-endian mono PCM
+
+        Returns:
+            Dictionary with the current partial text and a final text, if any
+        """
+        final = None
+
+        if self.recognizer.AcceptWaveform(pcm):
+            final = json.loads(self.recognizer.Result()).get("text", "")
+        else:
+            partial = json.loads(self.recognizer.PartialResult()).get("partial", "")
+            if partial and partial == self.partial:
+                self._unchanged += 1
+            else:
+                self._unchanged = 0
+            self.partial = partial
+
+            # Don't wait for the model's endpointer once the text stopped changing
+            if partial and self._unchanged >= self.stable_chunks:
+                final = partial
+                self.recognizer.Reset()
+
+        if final is not None:
+            self._emit_final(final)
+
+        return {"partial": self.partial, "final": final or None}
+
+    def finish(self) -> str:
+        """
+        Flush the recognizer at the end of the stream
+
+        Returns:
+            The full transcript of the stream
+        """
+        final = json.loads(self.recognizer.FinalResult()).get("text", "")
+        if final:
+            self._emit_final(final)
+        self.partial = ""
+        return " ".join(self.finals)
+
+    def submit(self, pcm: bytes) -> Future:
+        """
+        Queue a chunk for transcription on the shared pool
+
+        Chunks of one stream are processed in order, while different
+        streams run in parallel.
+
+        Args:
+            pcm: 16-bit little-endian mono PCM
+
+        Returns:
+            Future resolving to the accept_chunk result for this chunk
+        """
+        future = Future()
+        with self._lock:
+            self._pending.append((pcm, future))
+            if not self._draining:
+                self._draining = True
+                _executor.submit(self._drain)
+        return future
+
+    def submit_finish(self) -> Future:
+        """Queue the end of the stream behind any pending chunks"""
+        future = Future()
+        with self._lock:
+            self._pending.append((None, future))
+            if not self._draining:
+                self._draining = True
+                _executor.submit(self._drain)
+        return future
+
+    def _drain(self):
+        """Process queued chunks until the queue is empty"""
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._draining = False
+                    return
+                pcm, future = self._pending.popleft()
+
+            try:
+                result = self.finish() if pcm is None else self.accept_chunk(pcm)
+                future.set_result(result)
+            except Exception as e:
+                logging.error(f"Error transcribing audio: {str(e)}")
+                future.set_exception(e)
+
+    def _emit_final(self, text: str):
+        """Record a final transcript and notify the listener"""
+        text = text.strip()
+        if not text:
+            return
+        self.finals.append(text)
+        self.partial = ""
+        self._unchanged = 0
+        if self.on_final:
+            try:
+                self.on_final(text)
+            except Exception as e:
+                logging.error(f"Final transcript callback failed: {str(e)}")
+
+
+def analyze_on_final(analyzer) -> Callable[[str], Future]:
+    """
+    Build an on_final callback that starts question analysis right away
+
+    The analysis runs on the shared pool, so it overlaps with the customer
+    finishing their turn instead of starting after the message is sent.
+
+    Args:
+        analyzer: QuestionAnalyzer instance
+
+    Returns:
+        Callback returning the future of the analysis
+    """
+    def callback(text: str) -> Future:
+        return _executor.submit(analyzer.analyze_question, text)
+    return callback
+
+
+def register_upload(transcriber: StreamingTranscriber) -> str:
+    """
+    Let the browser stream audio to a transcriber over the upload endpoint
+
+    Args:
+        transcriber: The session's transcriber
+
+    Returns:
+        Unguessable token identifying the stream in upload URLs
+    """
+    token = uuid.uuid4().hex
+    _upload_streams[token] = transcriber
+    return token
+
+
+async def _upload_audio(request):
+    """
+    Feed one chunk of a stream and answer with the text recognized so far
+
+    The body is 16-bit mono PCM. With ?end=1 the stream's utterance is
+    finished after the chunk and its transcript is returned.
+    """
+    transcriber = _upload_streams.get(request.path_params["token"])
+    if transcriber is None:
+        return JSONResponse({"error": "Unknown audio stream"}, status_code=404)
+
+    if int(request.headers.get("content-length") or 0) > MAX_UPLOAD_BYTES:
+        return JSONResponse({"error": "Audio chunk too large"}, status_code=413)
+    pcm = await request.body()
+    if len(pcm) > MAX_UPLOAD_BYTES or len(pcm) % 2:
+        return JSONResponse({"error": "Invalid audio chunk"}, status_code=400)
+
+    try:
+        result = {"partial": transcriber.partial, "final": None}
+        if pcm:
+            result = await asyncio.wrap_future(transcriber.submit(pcm))
+        if request.query_params.get("end"):
+            transcript = await asyncio.wrap_future(transcriber.submit_finish())
+            transcriber.finals = []
+            return JSONResponse({"partial": "", "final": result["final"], "transcript": transcript})
+    except Exception as e:
+        logging.error(f"Error transcribing uploaded audio: {str(e)}")
+        return JSONResponse({"error": "Transcription failed"}, status_code=500)
+
+    return JSONResponse(result)
+
+
+def upload_routes(base_path: str = "") -> List[Route]:
+    """
+    Routes of the audio upload endpoint, for mounting with st.App
+
+    Args:
+        base_path: The server's base URL path, if any
+
+    Returns:
+        Routes to pass to st.App
+    """
+    base = base_path.strip("/")
+    prefix = f"/{base}" if base else ""
+    return [Route(f"{prefix}/api/voice/stt/{{token}}", _upload_audio, methods=["POST"])]
+
+
+def benchmark_real_time_factor(wav_path: str, model_path: Optional[str] = None,
+                               chunk_ms: int = 200) -> Dict[str, Any]:
+    """
+    Measure how fast the local model transcribes compared to real time
+
+    Args:
+        wav_path: 16 kHz mono 16-bit WAV file
+        model_path: Vosk model directory
+        chunk_ms: Size of the chunks fed to the recognizer
+
+    Returns:
+        Audio duration, processing time, real-time factor and transcript
+    """
+    with wave.open(wav_path, "rb") as wav:
+        if wav.getnchannels() != 1 or wav.getsampwidth() != 2:
+            raise ValueError("Benchmark audio must be 16-bit mono WAV")
+        sample_rate = wav.getframerate()
+        frames = wav.readframes(wav.getnframes())
+
+    # The model is loaded here, before timing, so the RTF reflects decoding only
+    transcriber = StreamingTranscriber(model_path=model_path, sample_rate=sample_rate)
+    chunk_bytes = int(sample_rate * chunk_ms / 1000) * 2
+
+    first_partial = None
+    start = time.perf_counter()
+    for offset in range(0, len(frames), chunk_bytes):
+        result = transcriber.accept_chunk(frames[offset:offset + chunk_bytes])
+        if first_partial is None and (result["partial"] or result["final"]):
+            first_partial = time.perf_counter() - start
+    transcript = transcriber.finish()
+    elapsed = time.perf_counter() - start
+
+    duration = len(frames) / 2 / sample_rate
+    return {
+        "audio_seconds": round(duration, 3),
+        "processing_seconds": round(elapsed, 3),
+        "real_time_factor": round(elapsed / duration, 3) if duration else 0.0,
+        "first_partial_seconds": round(first_partial, 3) if first_partial is not None else None,
+        "transcript": transcript
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the local speech-to-text model on CPU")
+    parser.add_argument("wav", help="16 kHz mono 16-bit WAV file")
+    parser.add_argument("--model", help="Vosk model directory (defaults to VOSK_MODEL_PATH)")
+    parser.add_argument("--chunk-ms", type=int, default=200)
+    args = parser.parse_args()
+
+    print(json.dumps(benchmark_real_time_factor(args.wav, args.model, args.chunk_ms),
+                     ensure_ascii=False, indent=2))
@@ -0,0 +1,54 @@
+import time
+import logging
+import threading
+from typing import Dict, List, Tuple
+
+# Reference point for the breakdown: the moment app.py first imports us
+_start = time.perf_counter()
+_marks: List[Tuple[str, float]] = []
+_reported = False
+_lock = threading.Lock()
+
+
+def mark(name: str):
+    """
+    Record that a startup phase has finished
+
+    Only the first script run of the process is recorded; later reruns are
+    ignored so the report reflects the cold start.
+
+    Args:
+        name: Phase name, e.g. "imports" or "first_render"
+    """
+    with _lock:
+        if not _reported:
+            _marks.append((name, time.perf_counter()))
+
+
+def breakdown() -> Dict[str, float]:
+    """
+    Get the duration of each startup phase
+
+    Returns:
+        Milliseconds spent in each phase, plus the total
+    """
+    with _lock:
+        result = {}
+        previous = _start
+        for name, at in _marks:
+            result[name] = round((at - previous) * 1000, 1)
+            previous = at
+        result["total"] = round((previous - _start) * 1000, 1)
+        return result
+
+
+def report():
+    """Log the cold start breakdown once per process"""
+    global _reported
+    timings = breakdown()
+    with _lock:
+        if _reported:
+            return
+        _reported = True
+    parts = ", ".join(f"{name}={ms}ms" for name, ms in timings.items())
+    logging.info(f"Cold start: {parts}")
@@ -0,0 +1,287 @@
+import os
+import json
+import logging
+import time
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+DEFAULT_TENANT = "3qrab"
+
+# Seconds between checks of the tenants file for changes
+POLL_INTERVAL = float(os.environ.get("KNOWLEDGE_POLL_SECONDS", "5"))
+
+# Profile fields answers are generated from; changing one invalidates all cached answers.
+# Any answer may quote any fact (a greeting can mention the price), so facts count too
+ANSWER_FIELDS = ("intro", "persona", "traits", "facts", "catalog", "rules", "closing",
+                 "contact_phone", "chat_model")
+
+# The original store; a tenants file may override it or add more stores
+DEFAULT_PROFILE = {
+    "id": DEFAULT_TENANT,
+    # Branding shown in the chat page
+    "store_name": "3QRab",
+    "store_url": "https://3qrab.netlify.app/",
+    "logo_url": "https://3qrab.netlify.app/logo.ico",
+    "avatar": "⌚",
+    "avatar_url": "https://img.freepik.com/free-vector/graident-ai-robot-vectorart_78370-4114.jpg"
+                  "?t=st=1756413685~exp=1756417285~hmac=afaa35dc6c3deea2251c284ed0897072d313414ce96e7d371fb8f1186030ff0c&w=1480",
+    "greeting": "أنا موسي، مساعدك الذكي • يسعدني مساعدتك في كل احتياجاتك ⌚",
+    "intro": "أنت مساعد ذكي لمتجر 3QRab، واسمك موسى تتحدث بشخصية ودودة ومتحمسة للتكنولوجيا. ",
+    "persona": "موسي",
+    "traits": [
+        "شخصيته: ودود، صبور، يحب مساعدة العملاء بوضوح وسهولة",
+        "شغفه: متخصص في خدمة العملاء ومساعدتهم في كل احتياجاتهم",
+        "مهارته: خبير في منتجات المتجر وسياسات الخدمة",
+        "رؤيته: تقديم تجربة تسوق سهلة وممتعة لكل عميل",
+        "أسلوبه: يستمع جيداً، يرد بسرعة، يقدم حلول عملية",
+    ],
+    "facts": [
+        "المنتجات: ساعة كربون أسود بـ 400 جنيه مصري",
+        "الدفع: نقداً عند الاستلام",
+        "الشحن: حسب العنوان ، التوصيل 3-4 أيام",
+        "الإرجاع: 7 أيام للاستبدال، 3 أيام لاسترداد المبلغ",
+        "التواصل: 01026897739 أو ehab.hussein.dev@gmail.com",
+        "انت مينفعش تعمل اوردر لي العميل",
+    ],
+    "rules": [
+        "اسأل عن اسم العميل بودية: 'أهلاً بك! أنا موسي مساعد المتجر، ممكن أعرف اسمك؟'",
+        "استخدم اسم العميل واجعله يشعر بالترحيب الشخصي",
+        "أضف لمسة شخصية: 'يسعدني أن أساعدك!' أو 'كوني جزء من عائلة 3QRab!'",
+        "اربط بشغف التكنولوجيا عند المناسب: 'أحب تجربة تقنيات AI جديدة لخدمتك!'",
+        "لتتبع الطلبات: 'أهلاً [الاسم]! يمكنك تتبع طلبك: https://3qrab.netlify.app/track-order?phone=[رقم العميل]'"
+        " واستخدم الاسم والرقم من بيانات العميل المعروفة، ولو الرقم مش معروف اطلبه ومتكتبش رقم من عندك",
+        "كن صبوراً ومتفهماً واستمع لاحتياجات العميل",
+        "قدم تجربة شخصية فريدة لكل عميل",
+        "حاول تبيع المنتج بطرق ذكيه كتاجر يفهم",
+        "اختصر الاجابات واذكر  المفيد للسؤال فقط",
+    ],
+    "closing": "تحدث بروح موسي المتحمسة والودودة دائماً! ⌚",
+    # Short answers per topic used when the API is saturated
+    "fallback_facts": {
+        "product": "الساعة الكربون الأسود متاحة بـ 400 جنيه مصري ⌚",
+        "payment": "الدفع نقداً عند الاستلام، وسعر الساعة 400 جنيه مصري.",
+        "shipping": "الشحن حسب العنوان والتوصيل خلال 3-4 أيام 🚚",
+        "returns": "تقدر تستبدل خلال 7 أيام، أو تسترد المبلغ خلال 3 أيام.",
+    },
+    "contact_phone": "01026897739",
+    "tracking_url": "https://3qrab.netlify.app/track-order?phone={phone}",
+    "chat_model": "gemini-2.5-flash",
+    "analysis_model": "gemini-2.5-pro",
+    "cache_quota_mb": 8,
+}
+
+
+class TenantProfile:
+    """One store served by the bot: persona, facts, catalog and models"""
+
+    def __init__(self, config: Dict[str, Any]):
+        """
+        Build a profile from its configuration
+
+        Fields missing from the configuration are taken from the default
+        store, so a tenant only needs to list what differs.
+
+        Args:
+            config: Tenant entry from the tenants file
+        """
+        merged = dict(DEFAULT_PROFILE, **config)
+        self.id: str = merged["id"]
+        self.store_name: str = merged["store_name"]
+        self.store_url: str = merged["store_url"]
+        self.logo_url: str = merged["logo_url"]
+        self.avatar: str = merged["avatar"]
+        self.avatar_url: str = merged["avatar_url"]
+        self.greeting: str = merged["greeting"]
+        self.intro: str = merged["intro"]
+        self.persona: str = merged["persona"]
+        self.traits: List[str] = list(merged["traits"])
+        self.facts: List[str] = list(merged["facts"])
+        self.catalog: List[Dict[str, Any]] = list(merged.get("catalog", []))
+        self.rules: List[str] = list(merged["rules"])
+        self.closing: str = merged["closing"]
+        self.fallback_facts: Dict[str, str] = dict(merged["fallback_facts"])
+        self.contact_phone: str = merged["contact_phone"]
+        self.tracking_url: str = merged["tracking_url"]
+        self.chat_model: str = merged["chat_model"]
+        self.analysis_model: str = merged["analysis_model"]
+        self.cache_quota_bytes = int(float(merged["cache_quota_mb"]) * 1024 * 1024)
+        # Bumped by the registry each time a reload changes this tenant
+        self.version = 1
+
+    def system_instruction(self) -> str:
+        """Compile the chat system instruction for this store"""
+        parts = [self.intro, f"عن {self.persona} (المساعد الذكي):\n"]
+        parts.extend(f"• {trait}\n" for trait in self.traits)
+        parts.append("معلومات المتجر:\n")
+        parts.extend(f"• {fact}\n" for fact in self.facts)
+        parts.extend(f"• {item['name']}: {item['price']}\n" for item in self.catalog)
+        parts.append(f"كيف ترد (بشخصية {self.persona}):\n")
+        parts.extend(f"{number}. {rule}\n" for number, rule in enumerate(self.rules, start=1))
+        parts.append(self.closing)
+        return "".join(parts)
+
+    def fallback_response(self, topic: str) -> str:
+        """Short local reply for a topic when the API is saturated"""
+        reply = f"أهلاً بك! أنا {self.persona}، عندنا ضغط كبير دلوقتي. "
+        if topic in self.fallback_facts:
+            reply += self.fallback_facts[topic] + " "
+        reply += f"ولو محتاج مساعدة أكتر تواصل معانا على {self.contact_phone}."
+        return reply
+
+
+def answers_changed(old: TenantProfile, new: TenantProfile) -> bool:
+    """
+    Check whether a profile change makes the tenant's cached answers stale
+
+    Args:
+        old: Profile before the reload
+        new: Profile after the reload
+
+    Returns:
+        True if an answer field changed; False for e.g. branding or fallback replies
+    """
+    return any(getattr(old, field) != getattr(new, field) for field in ANSWER_FIELDS)
+
+
+_tenants: Optional[Dict[str, TenantProfile]] = None
+_tenants_lock = threading.Lock()
+_listeners: List[Callable[[str], None]] = []
+_watcher: Optional[threading.Thread] = None
+
+
+def load_tenants(path: Optional[str] = None) -> Dict[str, TenantProfile]:
+    """
+    Read the tenant profiles
+
+    Args:
+        path: JSON file with a list of tenant entries; defaults to TENANTS_FILE or tenants.json
+
+    Returns:
+        Profiles by id, always including the default store
+    """
+    path = path or os.environ.get("TENANTS_FILE", "tenants.json")
+    entries = []
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except Exception as e:
+            logging.error(f"Failed to load tenants from {path}: {str(e)}")
+
+    tenants = {DEFAULT_TENANT: TenantProfile(DEFAULT_PROFILE)}
+    for entry in entries:
+        try:
+            if not entry["id"]:
+                raise ValueError("tenant id is empty")
+            profile = TenantProfile(entry)
+        except (KeyError, TypeError, ValueError) as e:
+            logging.error(f"Skipping invalid tenant entry: {str(e)}")
+            continue
+        tenants[profile.id] = profile
+    return tenants
+
+
+def get_tenant(tenant_id: Optional[str] = None) -> TenantProfile:
+    """
+    Get a tenant profile, falling back to the default store for unknown ids
+
+    Args:
+        tenant_id: Tenant id, e.g. from the ?store= query parameter
+
+    Returns:
+        The tenant's profile
+    """
+    global _tenants
+    with _tenants_lock:
+        if _tenants is None:
+            _tenants = load_tenants()
+        return _tenants.get(tenant_id or DEFAULT_TENANT, _tenants[DEFAULT_TENANT])
+
+
+def add_reload_listener(listener: Callable[[str], None]):
+    """
+    Be told about tenants whose answers a reload made stale
+
+    Args:
+        listener: Called with the tenant id
+    """
+    _listeners.append(listener)
+
+
+def reload_tenants(path: Optional[str] = None) -> List[str]:
+    """
+    Re-read the tenant profiles and swap in the changed ones
+
+    Only a change to an answer field bumps a tenant's version, which makes
+    bots re-create its cached content and drops its cached answers. Other
+    changes, such as branding, swap in the new profile under the same version.
+
+    Args:
+        path: Tenants file; defaults to TENANTS_FILE or tenants.json
+
+    Returns:
+        Ids of the tenants whose answers changed
+    """
+    global _tenants
+    fresh = load_tenants(path)
+    changed: List[str] = []
+    with _tenants_lock:
+        current = dict(_tenants or {})
+        for tenant_id, profile in fresh.items():
+            old = current.get(tenant_id)
+            if old is None:
+                current[tenant_id] = profile
+                continue
+            profile.version = old.version
+            if vars(profile) == vars(old):
+                continue
+            if answers_changed(old, profile):
+                profile.version += 1
+                changed.append(tenant_id)
+            current[tenant_id] = profile
+        # A single assignment, so readers see either the old or the new set
+        _tenants = current
+
+    for tenant_id in changed:
+        logging.info(f"Store knowledge of {tenant_id} reloaded (version {current[tenant_id].version})")
+        for listener in _listeners:
+            try:
+                listener(tenant_id)
+            except Exception as e:
+                logging.error(f"Tenant reload listener failed: {str(e)}")
+    return changed
+
+
+def watch_tenants(path: Optional[str] = None, interval: float = POLL_INTERVAL):
+    """
+    Reload the tenants file whenever it changes, from a background thread
+
+    Safe to call more than once; only one watcher runs per process.
+
+    Args:
+        path: Tenants file; defaults to TENANTS_FILE or tenants.json
+        interval: Seconds between modification time checks
+    """
+    global _watcher
+    path = path or os.environ.get("TENANTS_FILE", "tenants.json")
+
+    def stamp():
+        try:
+            stat = os.stat(path)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def run():
+        last = stamp()
+        while True:
+            time.sleep(interval)
+            current = stamp()
+            if current != last:
+                last = current
+                reload_tenants(path)
+
+    with _tenants_lock:
+        if _watcher is None:
+            _watcher = threading.Thread(target=run, name="tenants-watcher", daemon=True)
+            _watcher.start()
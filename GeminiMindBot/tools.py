@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional, Tuple
+
+from slots import extract_phones
+
+# Seconds a tool result stays valid; order status moves faster than stock
+TOOL_TTLS = {"order_status": 30.0, "check_stock": 60.0}
+
+# Seconds all lookups of one model turn may take together
+TOOL_TIMEOUT = float(os.environ.get("TOOL_TIMEOUT", "3"))
+
+# Order states as the customer should read them
+STATUS_NAMES = {
+    "processing": "جاري تجهيزه",
+    "shipped": "تم شحنه",
+    "out_for_delivery": "خرج للتوصيل",
+    "delivered": "تم توصيله",
+    "cancelled": "ملغي",
+}
+
+# Declarations the model sees: name, description and string parameters
+TOOLS = {
+    "order_status": (
+        "Look up the latest order placed with a customer's mobile number: "
+        "order id, status, and expected delivery date.",
+        {"phone": "Customer's Egyptian mobile number, e.g. 01012345678"}
+    ),
+    "check_stock": (
+        "Check whether a store product is in stock and how many are left.",
+        {"product": "Product name as the customer wrote it"}
+    ),
+}
+
+
+class LocalOrderService:
+    """
+    Offline stand-in for the store's order system
+
+    Every valid phone number has one made-up order derived from the number,
+    so answers are stable across runs. Used by tests, evaluation and load
+    tests with ORDER_SERVICE=local.
+    """
+
+    def __init__(self, latency: Optional[float] = None):
+        """
+        Initialize the stand-in
+
+        Args:
+            latency: Seconds per lookup (LOCAL_ORDERS_LATENCY)
+        """
+        if latency is None:
+            latency = float(os.environ.get("LOCAL_ORDERS_LATENCY", "0.05"))
+        self.latency = latency
+
+    def order_status(self, phone: str) -> Dict[str, Any]:
+        time.sleep(self.latency)
+        digest = int(hashlib.sha256(phone.encode("utf-8")).hexdigest(), 16)
+        if digest % 5 == 0:
+            return {"phone": phone, "found": False}
+        statuses = list(STATUS_NAMES)
+        status = statuses[digest % len(statuses)]
+        days = 0 if status in ("delivered", "cancelled") else 1 + digest % 4
+        return {
+            "phone": phone,
+            "found": True,
+            "order_id": f"3Q-{digest % 100000:05d}",
+            "status": status,
+            "expected_delivery": time.strftime("%Y-%m-%d", time.localtime(time.time() + days * 86400)),
+        }
+
+    def check_stock(self, product: str) -> Dict[str, Any]:
+        time.sleep(self.latency)
+        quantity = int(hashlib.sha256(product.strip().encode("utf-8")).hexdigest(), 16) % 12
+        return {"product": product, "in_stock": quantity > 0, "quantity": quantity}
+
+
+class HttpOrderService:
+    """Order system reached over HTTP: GET {url}/orders?phone= and {url}/stock?product=, returning JSON"""
+
+    def __init__(self, url: str, timeout: float = TOOL_TIMEOUT):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def order_status(self, phone: str) -> Dict[str, Any]:
+        return self._get("orders", phone=phone)
+
+    def check_stock(self, product: str) -> Dict[str, Any]:
+        return self._get("stock", product=product)
+
+    def _get(self, path: str, **params) -> Dict[str, Any]:
+        url = f"{self.url}/{path}?{urllib.parse.urlencode(params)}"
+        with urllib.request.urlopen(url, timeout=self.timeout) as response:
+            return json.loads(response.read().decode("utf-8"))
+
+
+class ToolExecutor:
+    """Runs the model's tool calls in parallel against the order service, with a TTL cache"""
+
+    def __init__(self, service, max_workers: int = 8, timeout: float = TOOL_TIMEOUT,
+                 ttls: Optional[Dict[str, float]] = None, max_entries: int = 4096):
+        """
+        Initialize the executor
+
+        Args:
+            service: Order service with order_status(phone) and check_stock(product)
+            max_workers: Lookups running at once, across all sessions
+            timeout: Seconds one batch of calls may take; slower ones report a timeout
+            ttls: Seconds results stay cached per tool (defaults to TOOL_TTLS)
+            max_entries: Cached results kept before the oldest are dropped
+        """
+        self.service = service
+        self.timeout = timeout
+        self.ttls = dict(TOOL_TTLS, **(ttls or {}))
+        self.max_entries = max_entries
+        self._declarations = None
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+        self._cache: "OrderedDict[Tuple[str, str], Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {name: {"calls": 0, "hits": 0, "errors": 0, "timeouts": 0,
+                              "total_ms": 0.0, "max_ms": 0.0} for name in TOOLS}
+
+    def declarations(self):
+        """Tool declarations for a GenerateContentConfig"""
+        if self._declarations is None:
+            self._declarations = self._declare()
+        return self._declarations
+
+    def _declare(self):
+        from google.genai import types
+
+        return [types.Tool(function_declarations=[
+            types.FunctionDeclaration(
+                name=name,
+                description=description,
+                parameters=types.Schema(
+                    type="OBJECT",
+                    properties={param: types.Schema(type="STRING", description=text)
+                                for param, text in params.items()},
+                    required=list(params)
+                )
+            ) for name, (description, params) in TOOLS.items()
+        ])]
+
+    def run(self, name: str, args: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Run one tool call, or answer it from the cache
+
+        Args:
+            name: Tool name from TOOLS
+            args: Arguments the model passed
+
+        Returns:
+            The tool result, or {"error": ...}
+        """
+        return self.execute([(name, args)])[0]
+
+    def execute(self, calls: List[Tuple[str, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """
+        Run tool calls in parallel
+
+        Args:
+            calls: Tool names with their arguments
+
+        Returns:
+            One result per call, in order; failed or late calls give {"error": ...}
+        """
+        results: List[Optional[Dict[str, Any]]] = [None] * len(calls)
+        futures = {}
+        for index, (name, args) in enumerate(calls):
+            if name not in TOOLS:
+                results[index] = {"error": f"unknown tool {name}"}
+                continue
+            cached = self._cached(name, args)
+            if cached is not None:
+                results[index] = cached
+            else:
+                futures[self._pool.submit(self._call, name, args)] = (index, name)
+
+        done, _ = wait(futures, timeout=self.timeout)
+        for future, (index, name) in futures.items():
+            if future in done:
+                results[index] = future.result()
+            else:
+                # The lookup keeps running and fills the cache for the next turn
+                with self._lock:
+                    self._stats[name]["timeouts"] += 1
+                results[index] = {"error": "timeout"}
+        return results
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Calls, cache hit rate, errors and latency per tool"""
+        with self._lock:
+            report = {}
+            for name, stats in self._stats.items():
+                lookups = stats["calls"] - stats["hits"]
+                report[name] = dict(
+                    stats,
+                    total_ms=round(stats["total_ms"], 1),
+                    max_ms=round(stats["max_ms"], 1),
+                    hit_rate=round(stats["hits"] / stats["calls"], 3) if stats["calls"] else 0.0,
+                    avg_ms=round(stats["total_ms"] / lookups, 1) if lookups else 0.0
+                )
+            return report
+
+    def _key(self, name: str, args: Dict[str, Any]) -> Tuple[str, str]:
+        return name, json.dumps(args, sort_keys=True, ensure_ascii=False)
+
+    def _cached(self, name: str, args: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        key = self._key(name, args)
+        with self._lock:
+            self._stats[name]["calls"] += 1
+            entry = self._cache.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                return None
+            self._stats[name]["hits"] += 1
+            return entry[0]
+
+    def _call(self, name: str, args: Dict[str, Any]) -> Dict[str, Any]:
+        """Perform one lookup on a pool thread and cache a successful result"""
+        started = time.perf_counter()
+        try:
+            if name == "order_status":
+                phones = extract_phones(str(args.get("phone", "")))
+                if not phones:
+                    return {"error": "no valid mobile number given"}
+                result = self.service.order_status(phones[0])
+            else:
+                result = self.service.check_stock(str(args.get("product", "")))
+        except Exception as e:
+            logging.error(f"Tool {name} failed: {str(e)}")
+            with self._lock:
+                self._stats[name]["errors"] += 1
+            return {"error": "lookup failed"}
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self._stats[name]["total_ms"] += elapsed
+                self._stats[name]["max_ms"] = max(self._stats[name]["max_ms"], elapsed)
+
+        with self._lock:
+            self._cache[self._key(name, args)] = (result, time.monotonic() + self.ttls[name])
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return result
+
+
+def describe_order(result: Dict[str, Any]) -> Optional[str]:
+    """Customer-facing line for an order_status result, None if there is nothing to say"""
+    if result.get("error") or not result.get("found"):
+        return None
+    status = STATUS_NAMES.get(result.get("status"), result.get("status", ""))
+    line = f"طلبك رقم {result.get('order_id')} حالته: {status}"
+    if result.get("status") not in ("delivered", "cancelled") and result.get("expected_delivery"):
+        line += f"، ومتوقع يوصل يوم {result['expected_delivery']}"
+    return line + "."
+
+
+def order_lookup(executor: ToolExecutor):
+    """Status line lookup by phone for slots.tracking_reply, through the executor's cache"""
+    return lambda phone: describe_order(executor.run("order_status", {"phone": phone}))
+
+
+_executor: Optional[ToolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_tool_executor() -> Optional[ToolExecutor]:
+    """
+    Get the process-wide tool executor configured from the environment
+
+    ORDER_SERVICE selects the order system: "local" for the stand-in or
+    the base URL of the real one. Without it the bot has no tools.
+
+    Returns:
+        The executor, or None if no order service is configured
+    """
+    global _executor
+    service = os.environ.get("ORDER_SERVICE", "")
+    if not service:
+        return None
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ToolExecutor(LocalOrderService() if service == "local" else HttpOrderService(service))
+        return _executor
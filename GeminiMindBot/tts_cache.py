@@ -0,0 +1,295 @@
+import os
+import re
+import shutil
+import hashlib
+import logging
+import subprocess
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+
+class TTSEngine:
+    """Base class for local speech synthesis engines"""
+
+    name = "base"
+
+    def synthesize(self, text: str, voice: str) -> bytes:
+        """
+        Synthesize speech for a piece of text
+
+        Args:
+            text: Text to speak
+            voice: Engine-specific voice name
+
+        Returns:
+            WAV audio bytes
+        """
+        raise NotImplementedError
+
+
+class EspeakEngine(TTSEngine):
+    """Synthesizes speech with the espeak-ng command line tool"""
+
+    name = "espeak"
+
+    def __init__(self, binary: Optional[str] = None):
+        self.binary = binary or shutil.which("espeak-ng") or shutil.which("espeak")
+        if not self.binary:
+            raise RuntimeError("espeak-ng is not installed")
+
+    def synthesize(self, text: str, voice: str) -> bytes:
+        result = subprocess.run(
+            [self.binary, "-v", voice, "--stdout", text],
+            capture_output=True, check=True, timeout=30
+        )
+        return result.stdout
+
+
+class PiperEngine(TTSEngine):
+    """Synthesizes speech with a Piper voice model; voice is the model path"""
+
+    name = "piper"
+
+    def __init__(self, binary: Optional[str] = None):
+        self.binary = binary or shutil.which("piper")
+        if not self.binary:
+            raise RuntimeError("piper is not installed")
+
+    def synthesize(self, text: str, voice: str) -> bytes:
+        result = subprocess.run(
+            [self.binary, "--model", voice, "--output_file", "-"],
+            input=text.encode("utf-8"), capture_output=True, check=True, timeout=30
+        )
+        return result.stdout
+
+
+ENGINES = {
+    "espeak": EspeakEngine,
+    "piper": PiperEngine,
+}
+
+
+def _compress(wav: bytes) -> Tuple[bytes, str]:
+    """Encode WAV to Ogg/Opus when ffmpeg is available, otherwise keep WAV"""
+    ffmpeg = shutil.which("ffmpeg")
+    if not ffmpeg:
+        return wav, "audio/wav"
+    try:
+        result = subprocess.run(
+            [ffmpeg, "-loglevel", "error", "-i", "pipe:0",
+             "-c:a", "libopus", "-b:a", "24k", "-f", "ogg", "pipe:1"],
+            input=wav, capture_output=True, check=True, timeout=30
+        )
+        return result.stdout, "audio/ogg"
+    except Exception as e:
+        logging.error(f"Failed to compress audio clip: {str(e)}")
+        return wav, "audio/wav"
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text so trivially different copies share one clip"""
+    text = text.replace("ـ", "")  # Tatweel doesn't change pronunciation
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class AudioCache:
+    """Content-addressed cache of synthesized clips on disk with LRU eviction"""
+
+    EXTENSIONS = {"audio/ogg": ".ogg", "audio/wav": ".wav"}
+
+    def __init__(self, engine: TTSEngine, voice: str, directory: str = "tts_cache",
+                 max_bytes: int = 200 * 1024 * 1024):
+        """
+        Initialize the audio cache
+
+        Args:
+            engine: Engine used to synthesize clips on a miss
+            voice: Voice passed to the engine
+            directory: Directory holding the cached clips
+            max_bytes: Total size above which least recently used clips are evicted
+        """
+        self.engine = engine
+        self.voice = voice
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def key(self, text: str) -> str:
+        """Address of a clip: hash of engine, voice and normalized text"""
+        material = f"{self.engine.name}|{self.voice}|{normalize_text(text)}"
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get_or_synthesize(self, text: str) -> Tuple[bytes, str]:
+        """
+        Return the clip for text, synthesizing and caching it on a miss
+
+        Args:
+            text: Text to speak
+
+        Returns:
+            Tuple of audio bytes and their MIME type
+        """
+        key = self.key(text)
+        cached = self._read(key)
+        if cached:
+            return cached
+
+        with self._lock:
+            self.misses += 1
+        audio, mime = _compress(self.engine.synthesize(text, self.voice))
+        self._write(key, audio, mime)
+        return audio, mime
+
+    def clip(self, text: str) -> Tuple[str, str]:
+        """
+        Make sure the clip for text is on disk, synthesizing it on a miss
+
+        Args:
+            text: Text to speak
+
+        Returns:
+            Tuple of the clip's file name in the cache directory and its MIME type
+        """
+        key = self.key(text)
+        for mime, extension in self.EXTENSIONS.items():
+            name = key + extension
+            with self._lock:
+                if name not in self._entries:
+                    continue
+                self._entries.move_to_end(name)
+                self.hits += 1
+            try:
+                os.utime(self._path(name))
+                return name, mime
+            except OSError as e:
+                logging.error(f"Cached audio disappeared: {str(e)}")
+                with self._lock:
+                    self._total_bytes -= self._entries.pop(name, 0)
+
+        with self._lock:
+            self.misses += 1
+        audio, mime = _compress(self.engine.synthesize(text, self.voice))
+        self._write(key, audio, mime)
+        return key + self.EXTENSIONS[mime], mime
+
+    def stats(self) -> Dict[str, float]:
+        """Get cache size and hit rate"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "clips": len(self._entries),
+                "bytes": self._total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _load_index(self):
+        """Rebuild the LRU order from file modification times"""
+        files = []
+        for name in os.listdir(self.directory):
+            if os.path.splitext(name)[1] in self.EXTENSIONS.values():
+                stat = os.stat(self._path(name))
+                files.append((stat.st_mtime, name, stat.st_size))
+
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._total_bytes += size
+
+    def _read(self, key: str) -> Optional[Tuple[bytes, str]]:
+        for mime, extension in self.EXTENSIONS.items():
+            name = key + extension
+            with self._lock:
+                if name not in self._entries:
+                    continue
+                self._entries.move_to_end(name)
+                self.hits += 1
+            try:
+                path = self._path(name)
+                os.utime(path)
+                with open(path, "rb") as f:
+                    return f.read(), mime
+            except OSError as e:
+                logging.error(f"Failed to read cached audio: {str(e)}")
+                with self._lock:
+                    self._total_bytes -= self._entries.pop(name, 0)
+        return None
+
+    def _write(self, key: str, audio: bytes, mime: str):
+        name = key + self.EXTENSIONS[mime]
+        path = self._path(name)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(audio)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.error(f"Failed to cache audio: {str(e)}")
+            return
+
+        with self._lock:
+            self._total_bytes += len(audio) - self._entries.get(name, 0)
+            self._entries[name] = len(audio)
+            self._entries.move_to_end(name)
+            self._evict()
+
+    def _evict(self):
+        """Drop least recently used clips until the cache fits; lock held"""
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+
+
+# Under the app's static folder, so the browser fetches clips by URL
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "tts")
+
+_cache: Optional[AudioCache] = None
+_cache_failed = False
+_cache_lock = threading.Lock()
+
+
+def get_audio_cache() -> Optional[AudioCache]:
+    """
+    Get the process-wide audio cache configured from the environment
+
+    TTS_ENGINE selects the engine (espeak or piper), TTS_VOICE the voice,
+    TTS_CACHE_DIR and TTS_CACHE_MB the cache location and size. Clips are
+    only served by URL while the cache is under the app's static folder.
+
+    Returns:
+        The audio cache, or None if server-side synthesis is not configured
+    """
+    global _cache, _cache_failed
+    engine_name = os.environ.get("TTS_ENGINE", "")
+    if engine_name not in ENGINES or _cache_failed:
+        return None
+
+    with _cache_lock:
+        if _cache is None:
+            try:
+                _cache = AudioCache(
+                    ENGINES[engine_name](),
+                    voice=os.environ.get("TTS_VOICE", "ar"),
+                    directory=os.environ.get("TTS_CACHE_DIR", DEFAULT_CACHE_DIR),
+                    max_bytes=int(os.environ.get("TTS_CACHE_MB", "200")) * 1024 * 1024
+                )
+            except Exception as e:
+                logging.error(f"Server-side speech synthesis unavailable: {str(e)}")
+                _cache_failed = True
+                return None
+        return _cache
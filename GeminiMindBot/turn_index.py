@@ -0,0 +1,127 @@
+import math
+from collections import Counter
+from typing import Any, Dict, List
+
+from search_index import analyze_text
+from slots import extract_slots
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count: about four characters per token"""
+    return max(1, len(text) // 4)
+
+
+def format_turn(interaction: Dict[str, Any]) -> str:
+    """A turn as it appears in the prompt context"""
+    return f"User: {interaction['user_input']}\nAssistant: {interaction['assistant_response']}\n---"
+
+
+class TurnIndex:
+    """BM25 index over the turns of one conversation, to pick the context relevant to a new message"""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75, max_turns: int = 200):
+        """
+        Initialize an empty index
+
+        Args:
+            k1: BM25 term frequency saturation
+            b: BM25 length normalization
+            max_turns: Turns kept; older ones stop being candidates
+        """
+        self.k1 = k1
+        self.b = b
+        self.max_turns = max_turns
+        self.turns: List[Dict[str, Any]] = []
+        self._terms: List[Counter] = []
+        self._document_frequency: Counter = Counter()
+        self._total_length = 0
+
+    def add(self, interaction: Dict[str, Any]):
+        """
+        Index a new turn from its user input and the slots it gave
+
+        Args:
+            interaction: Turn with user_input and assistant_response
+        """
+        text = interaction["user_input"]
+        slots = extract_slots(text)
+        if slots:
+            text += " " + " ".join(slots.values())
+        terms = Counter(analyze_text(text))
+
+        self.turns.append(interaction)
+        self._terms.append(terms)
+        self._document_frequency.update(terms.keys())
+        self._total_length += sum(terms.values())
+
+        if len(self.turns) > self.max_turns:
+            self.turns.pop(0)
+            dropped = self._terms.pop(0)
+            self._document_frequency.subtract(dropped.keys())
+            self._total_length -= sum(dropped.values())
+
+    def select(self, query: str, limit: int = 5, recent: int = 2, max_tokens: int = 800) -> List[Dict[str, Any]]:
+        """
+        Pick the turns to send as context for a new message
+
+        The last turns are always candidates, since follow-ups refer to
+        them; earlier turns are added by relevance to the query. Turns are
+        taken in that order until the token budget is spent, except that
+        the last turn is always included.
+
+        Args:
+            query: The new user message
+            limit: Maximum number of turns
+            recent: Latest turns included regardless of relevance
+            max_tokens: Budget for the formatted turns
+
+        Returns:
+            The selected turns in conversation order
+        """
+        if not self.turns:
+            return []
+
+        last = len(self.turns) - 1
+        candidates = list(range(last, max(-1, last - recent), -1))
+        earlier = len(self.turns) - len(candidates)
+        scores = self._scores(query, earlier)
+        candidates += sorted((i for i in scores if scores[i] > 0), key=lambda i: scores[i], reverse=True)
+
+        chosen = []
+        spent = 0
+        for i in candidates[:limit]:
+            cost = estimate_tokens(format_turn(self.turns[i]))
+            if chosen and spent + cost > max_tokens:
+                continue
+            chosen.append(i)
+            spent += cost
+        return [self.turns[i] for i in sorted(chosen)]
+
+    def clear(self):
+        """Forget all turns, for a new conversation"""
+        self.turns = []
+        self._terms = []
+        self._document_frequency = Counter()
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    def _scores(self, query: str, count: int) -> Dict[int, float]:
+        """BM25 scores of the first count turns"""
+        terms = set(analyze_text(query))
+        total = len(self.turns)
+        average_length = (self._total_length / total) or 1.0
+        scores = {}
+        for i in range(count):
+            document = self._terms[i]
+            length = sum(document.values())
+            score = 0.0
+            for term in terms & document.keys():
+                frequency = document[term]
+                df = self._document_frequency[term]
+                idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+                score += idf * frequency * (self.k1 + 1) / (
+                    frequency + self.k1 * (1 - self.b + self.b * length / average_length))
+            scores[i] = score
+        return scores
@@ -1,185 +1,452 @@
+import base64
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
 import streamlit as st
 import streamlit.components.v1 as components
 
+import speech_to_text
+from tts_cache import get_audio_cache
+
+
+# Sentence terminators, including the Arabic question mark and full stop
+SENTENCE_END = re.compile(r'(?<!\d)[.!?؟۔…]+(?!\d)|\n+')
+
+# Softer breaks (Arabic/Latin comma and semicolon) used to split long sentences
+CLAUSE_BREAK = re.compile(r'[،؛,;:]')
+
+# Persistent voice component: loaded once per session and kept alive across
+# reruns, it owns the speech recognition and synthesis engines
+_voice_bridge = components.declare_component(
+    "voice_bridge",
+    path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "voice_component")
+)
+
+# Number of sentences kept in a session's speech feed for the component to pick up
+SPEAK_QUEUE_SIZE = 20
+
+# The app's static folder, served at app/static/ with server.enableStaticServing
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+# Speech feeds are small JSON files there, polled by the voice component
+# while a reply streams
+FEED_DIR = os.path.join(STATIC_DIR, "voice")
+
+# Server-side clips are synthesized here, so the reply text keeps streaming
+_synthesis_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("TTS_WORKERS", "2")),
+                                     thread_name_prefix="tts")
+
+# Seconds after which feeds of finished sessions are deleted
+FEED_MAX_AGE = 24 * 3600
+
+# "server" streams microphone audio to the local STT model instead of using
+# the browser's speech recognition; run server.py to mount the upload endpoint
+STT_MODE = os.environ.get("STT_MODE", "browser")
+
+# Seconds to wait for an utterance to be transcribed, on top of its duration
+FINAL_TRANSCRIPT_TIMEOUT = 10
+
+# Audio sent as a component value is fed to the recognizer in pieces of this
+# many seconds, so finished segments are analysed while the rest is decoded
+RECOGNIZER_CHUNK_SECONDS = 0.2
+
+
+class SentenceChunker:
+    """Splits streamed text into sentence-sized chunks ready for speech"""
+
+    def __init__(self, min_chars: int = 12, max_chars: int = 160):
+        """
+        Initialize the chunker
+
+        Args:
+            min_chars: Shorter sentences are merged with the next one
+            max_chars: Longer sentences are split at the last clause break
+        """
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self._buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        """
+        Add streamed text and return any sentences it completed
+
+        Args:
+            text: Next chunk of the streamed response
+
+        Returns:
+            Sentences that are complete and can be spoken now
+        """
+        self._buffer += text
+        sentences = []
+
+        while True:
+            end = self._next_boundary()
+            if end is None:
+                break
+            sentence = self._buffer[:end].strip()
+            self._buffer = self._buffer[end:]
+            if sentence:
+                sentences.append(sentence)
+
+        return sentences
+
+    def flush(self) -> List[str]:
+        """Return whatever is left in the buffer once the stream has ended"""
+        rest = self._buffer.strip()
+        self._buffer = ""
+        return [rest] if rest else []
+
+    def _next_boundary(self):
+        """Find where the next speakable chunk ends in the buffer"""
+        for match in SENTENCE_END.finditer(self._buffer):
+            # A terminator at the very end might still be followed by a digit
+            if match.end() == len(self._buffer) and match.group()[-1] == '.':
+                break
+            if len(self._buffer[:match.end()].strip()) >= self.min_chars:
+                return match.end()
+
+        if len(self._buffer) > self.max_chars:
+            breaks = [m.end() for m in CLAUSE_BREAK.finditer(self._buffer, 0, self.max_chars)]
+            if breaks:
+                return breaks[-1]
+            space = self._buffer.rfind(' ', 0, self.max_chars)
+            return space if space > 0 else self.max_chars
+
+        return None
+
+
+def split_sentences(text: str) -> List[str]:
+    """Split a complete text into sentence chunks for speech synthesis"""
+    chunker = SentenceChunker()
+    return chunker.feed(text) + chunker.flush()
+
+
+def _clean_for_speech(text: str) -> str:
+    """Remove markdown markers and links that should not be read aloud"""
+    text = re.sub(r'https?://\S+', '', text)
+    text = re.sub(r'[*_`#>]+', '', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def voice_bridge(key: str = "voice_bridge", lang: str = "ar-EG", analyzer=None,
+                 reply: bool = False) -> Optional[str]:
+    """
+    Render the persistent voice component
+
+    Call this once per rerun, before any streamed reply is rendered, so the
+    component is already on the page when sentences start arriving.
+
+    Args:
+        key: Widget key; must stay stable so the iframe is reused
+        lang: BCP-47 language for recognition and synthesis
+        analyzer: QuestionAnalyzer to start on server transcripts as soon as they are final
+        reply: Whether this run answers a typed message, so the component
+            waits for the reply's sentences
+
+    Returns:
+        A new voice transcript, or None if nothing new was spoken
+    """
+    stt_mode = "server" if STT_MODE == "server" and speech_to_text.is_available() else "browser"
+    transcriber = _get_transcriber(analyzer) if stt_mode == "server" else None
+    if transcriber is None:
+        stt_mode = "browser"
+    feed = get_speech_feed()
+    if st.get_option("server.enableStaticServing"):
+        speech = {"feed": feed.url, "speak": None}
+    else:
+        # Without static serving sentences only arrive with the next rerun
+        speech = {"feed": None, "speak": feed.snapshot()["items"]}
+    stt_url = _app_url(f"api/voice/stt/{st.session_state.voice_upload_token}") if transcriber else None
+    value = _voice_bridge(lang=lang, stt_mode=stt_mode, stt_url=stt_url, turn=feed.turn,
+                          reply=reply, key=key, default=None, height=70, **speech)
+
+    if not value:
+        return None
+
+    # The component keeps returning its last value on every rerun
+    if value.get("id") == st.session_state.get("voice_last_value_id"):
+        return None
+    st.session_state.voice_last_value_id = value.get("id")
+
+    if value.get("type") == "audio":
+        return _transcribe_audio(value)
+
+    if value.get("type") != "transcript":
+        return None
+
+    text = (value.get("text") or "").strip()
+    return text or None
+
+
+def _get_transcriber(analyzer) -> Optional[speech_to_text.StreamingTranscriber]:
+    """
+    Get the session's server-side transcriber, creating it on first use
+
+    The transcriber is also registered with the upload endpoint, so the
+    component can stream audio to it while the customer speaks.
+    """
+    state = st.session_state
+    if "voice_transcriber" not in state:
+        analyses = {}
+        start_analysis = speech_to_text.analyze_on_final(analyzer) if analyzer else None
+
+        def on_final(text):
+            if start_analysis:
+                analyses[text] = start_analysis(text)
+
+        try:
+            state.voice_transcriber = speech_to_text.StreamingTranscriber(on_final=on_final)
+        except Exception as e:
+            logging.error(f"Server-side speech recognition unavailable: {str(e)}")
+            return None
+        state.voice_analyses = analyses
+        state.voice_upload_token = speech_to_text.register_upload(state.voice_transcriber)
+    return state.voice_transcriber
+
 
-def add_voice_functionality():
-    """Add text-to-speech and speech-to-text functionality using Web APIs"""
-    
-    # Text-to-speech JavaScript function
-    tts_js = """
-    <script>
-    function speak(text) {
-        if ('speechSynthesis' in window) {
-            // Cancel any ongoing speech
-            window.speechSynthesis.cancel();
-            
-            const utterance = new SpeechSynthesisUtterance(text);
-            utterance.rate = 0.8;
-            utterance.pitch = 1;
-            utterance.volume = 1;
-            
-            // Try to use a more natural voice if available
-            const voices = window.speechSynthesis.getVoices();
-            const preferredVoice = voices.find(voice => 
-                voice.name.includes('Google') || 
-                voice.name.includes('Microsoft') ||
-                voice.lang.startsWith('en-')
-            );
-            
-            if (preferredVoice) {
-                utterance.voice = preferredVoice;
-            }
-            
-            window.speechSynthesis.speak(utterance);
-        } else {
-            alert('Text-to-speech not supported in this browser');
-        }
-    }
-    
-    function stopSpeaking() {
-        if ('speechSynthesis' in window) {
-            window.speechSynthesis.cancel();
-        }
-    }
-    </script>
+def _transcribe_audio(value: Dict[str, Any]) -> Optional[str]:
     """
-    
-    # Speech-to-text JavaScript function
-    stt_js = """
-    <script>
-    let recognition;
-    let isListening = false;
-    
-    function startListening() {
-        if ('webkitSpeechRecognition' in window || 'SpeechRecognition' in window) {
-            const SpeechRecognition = window.SpeechRecognition || window.webkitSpeechRecognition;
-            recognition = new SpeechRecognition();
-            
-            recognition.continuous = false;
-            recognition.interimResults = false;
-            recognition.lang = 'en-US';
-            
-            recognition.onstart = function() {
-                isListening = true;
-                document.getElementById('listening-status').innerHTML = '🎤 Listening...';
-                document.getElementById('voice-btn').innerHTML = '⏹️ Stop';
-            };
-            
-            recognition.onresult = function(event) {
-                const transcript = event.results[0][0].transcript;
-                document.getElementById('voice-input').value = transcript;
-                
-                // Trigger Streamlit to update
-                const inputEvent = new Event('input', { bubbles: true });
-                document.getElementById('voice-input').dispatchEvent(inputEvent);
-            };
-            
-            recognition.onerror = function(event) {
-                console.error('Speech recognition error:', event.error);
-                document.getElementById('listening-status').innerHTML = '❌ Error: ' + event.error;
-            };
-            
-            recognition.onend = function() {
-                isListening = false;
-                document.getElementById('listening-status').innerHTML = '';
-                document.getElementById('voice-btn').innerHTML = '🎤 Voice Input';
-            };
-            
-            recognition.start();
-        } else {
-            alert('Speech recognition not supported in this browser');
-        }
-    }
-    
-    function toggleListening() {
-        if (isListening) {
-            recognition.stop();
-        } else {
-            startListening();
-        }
-    }
-    </script>
+    Transcribe audio the component sent as a value instead of uploading it
+
+    That happens when the upload endpoint is not mounted (the app was started
+    with app.py rather than server.py) or an upload failed; the audio is the
+    rest of the utterance not yet streamed to the transcriber.
+    """
+    transcriber = st.session_state.get("voice_transcriber")
+    if transcriber is None:
+        return None
+
+    pcm = base64.b64decode(value.get("data") or "")
+    chunk_bytes = int(transcriber.sample_rate * RECOGNIZER_CHUNK_SECONDS) * 2
+    for offset in range(0, len(pcm), chunk_bytes):
+        transcriber.submit(pcm[offset:offset + chunk_bytes])
+
+    duration = len(pcm) / 2 / transcriber.sample_rate
+    try:
+        transcript = transcriber.submit_finish().result(timeout=FINAL_TRANSCRIPT_TIMEOUT + duration)
+    except Exception as e:
+        logging.error(f"Error finishing transcription: {str(e)}")
+        transcript = " ".join(transcriber.finals)
+    transcriber.finals = []
+    return transcript.strip() or None
+
+
+def pop_voice_analysis(text: str) -> Optional[Dict[str, Any]]:
+    """
+    Collect the analysis started while a server transcript was finalized
+
+    Args:
+        text: Transcript returned by voice_bridge
+
+    Returns:
+        The analysis if one was started for a part of this transcript
     """
-    
-    # Render the JavaScript
-    components.html(tts_js + stt_js, height=0)
-
-
-def create_voice_input():
-    """Create a voice input interface"""
-    
-    col1, col2, col3 = st.columns([1, 6, 1])
-    
-    with col1:
-        # Voice input button
-        voice_button_html = """
-        <button id="voice-btn" onclick="toggleListening()" 
-                style="
-                    background: linear-gradient(45deg, #FF6B6B, #4ECDC4);
-                    border: none;
-                    color: white;
-                    padding: 10px 15px;
-                    border-radius: 20px;
-                    cursor: pointer;
-                    font-size: 14px;
-                    transition: all 0.3s ease;
-                    box-shadow: 0 4px 15px rgba(255, 107, 107, 0.3);
-                    margin-bottom: 10px;
-                " 
-                onmouseover="this.style.transform='scale(1.05)'"
-                onmouseout="this.style.transform='scale(1)'"
-        >🎤 Voice Input</button>
-        <div id="listening-status" style="font-size: 12px; color: #FF6B6B; margin-top: 5px;"></div>
+    analyses = st.session_state.get("voice_analyses")
+    if not analyses:
+        return None
+
+    # Multi-segment utterances are analysed per segment; use the last one
+    future = None
+    for segment in list(analyses):
+        if segment in text:
+            future = analyses.pop(segment)
+    analyses.clear()
+
+    if future is None:
+        return None
+    try:
+        return future.result(timeout=FINAL_TRANSCRIPT_TIMEOUT)
+    except Exception as e:
+        logging.error(f"Error collecting voice analysis: {str(e)}")
+        return None
+
+
+def _speech_items(sentences: List[str]) -> List[Dict[str, Any]]:
+    """Prepare sentences for the voice component, dropping what is not spoken"""
+    items = []
+    for sentence in sentences:
+        sentence = _clean_for_speech(sentence)
+        if sentence:
+            items.append({"text": sentence})
+    return items
+
+
+def _app_url(relative: str) -> str:
+    """Browser path of a route served by the app, below the base URL path"""
+    base = (st.get_option("server.baseUrlPath") or "").strip("/")
+    prefix = f"/{base}" if base else ""
+    return f"{prefix}/{relative}"
+
+
+def _static_url(relative: str) -> str:
+    """Browser path of a file under the app's static folder"""
+    return _app_url(f"app/static/{relative}")
+
+
+def _clip_source(cache, name: str, mime: str) -> str:
+    """URL of a cached clip, or the clip inline if the cache is not served"""
+    path = os.path.realpath(os.path.join(cache.directory, name))
+    static = os.path.realpath(STATIC_DIR)
+    if st.get_option("server.enableStaticServing") and os.path.commonpath([path, static]) == static:
+        return _static_url(os.path.relpath(path, static).replace(os.sep, "/"))
+    with open(path, "rb") as f:
+        return f"data:{mime};base64,{base64.b64encode(f.read()).decode('ascii')}"
+
+
+class SpeechFeed:
+    """Sentences to speak for one session, published as a file its voice component polls"""
+
+    def __init__(self, directory: str = FEED_DIR):
+        """
+        Initialize an empty feed
+
+        Args:
+            directory: Folder under the app's static folder holding the feeds
         """
-        components.html(voice_button_html, height=80)
-    
-    with col2:
-        # Hidden input for voice text
-        voice_text = st.text_input("Voice Input", key="voice_input", placeholder="اضغط زر الصوت للتحدث أو اكتب هنا...", label_visibility="collapsed")
-    
-    with col3:
-        st.write("")  # Empty space for alignment
-    
-    return voice_text
+        self.token = uuid.uuid4().hex
+        self.path = os.path.join(directory, f"{self.token}.json")
+        self.turn = 0
+        self.open = False
+        self.items: List[Dict[str, Any]] = []
+        self._next_id = 1
+        self._lock = threading.Lock()
 
+    @property
+    def url(self) -> str:
+        """Path the browser fetches the feed from"""
+        return _static_url(f"voice/{self.token}.json")
 
-def speak_text(text):
-    """Function to trigger text-to-speech"""
-    if text:
-        # Clean the text for JavaScript
-        clean_text = text.replace('`', '').replace('"', "'").replace('\n', ' ').replace('\r', ' ')
-        # Create a button to trigger speech
-        speak_js = f"""
-        <script>
-        speak(`{clean_text}`);
-        </script>
+    def start(self):
+        """Begin a reply; the component keeps polling until finish()"""
+        with self._lock:
+            self.turn += 1
+            self.open = True
+            self._publish()
+
+    def add(self, sentences: List[str]):
         """
-        components.html(speak_js, height=0)
-
-
-def create_voice_controls():
-    """Create voice control buttons"""
-    col1, col2, col3 = st.columns([1, 1, 1])
-    
-    with col2:
-        voice_controls_html = """
-        <div style="text-align: center; margin: 10px 0;">
-            <button onclick="stopSpeaking()" 
-                    style="
-                        background: linear-gradient(45deg, #FF4757, #FF3742);
-                        border: none;
-                        color: white;
-                        padding: 8px 16px;
-                        border-radius: 15px;
-                        cursor: pointer;
-                        font-size: 12px;
-                        margin: 0 5px;
-                        transition: all 0.3s ease;
-                        box-shadow: 0 2px 10px rgba(255, 71, 87, 0.3);
-                    "
-                    onmouseover="this.style.transform='scale(1.05)'"
-                    onmouseout="this.style.transform='scale(1)'"
-            >🔇 Stop Speaking</button>
-        </div>
+        Publish sentences of the current reply
+
+        With a server-side engine each sentence is marked pending until its
+        clip is synthesized on the pool; the component plays them in order.
         """
-        components.html(voice_controls_html, height=50)
\ No newline at end of file
+        items = _speech_items(sentences)
+        if not items:
+            return
+        cache = get_audio_cache()
+        with self._lock:
+            for item in items:
+                item["id"] = self._next_id
+                item["turn"] = self.turn
+                if cache:
+                    item["pending"] = True
+                self._next_id += 1
+                self.items.append(item)
+            del self.items[:-SPEAK_QUEUE_SIZE]
+            self._publish()
+        if cache:
+            for item in items:
+                _synthesis_pool.submit(self._synthesize, cache, item)
+
+    def finish(self):
+        """End the reply, so the component stops polling"""
+        with self._lock:
+            self.open = False
+            self._publish()
+
+    def _synthesize(self, cache, item: Dict[str, Any]):
+        """Attach the cached clip of a sentence; on failure the browser voice speaks it"""
+        try:
+            name, mime = cache.clip(item["text"])
+            audio = _clip_source(cache, name, mime)
+        except Exception as e:
+            logging.error(f"Server-side synthesis failed, using browser voice: {str(e)}")
+            audio = None
+        with self._lock:
+            if audio:
+                item["audio"] = audio
+            item.pop("pending", None)
+            self._publish()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"turn": self.turn, "open": self.open, "items": list(self.items)}
+
+    def _publish(self):
+        """Write the feed atomically; lock held"""
+        data = {"turn": self.turn, "open": self.open, "items": self.items}
+        temporary = f"{self.path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(temporary, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            logging.error(f"Failed to publish speech feed: {str(e)}")
+
+
+def _prune_feeds(directory: str = FEED_DIR):
+    """Delete the feeds of sessions idle for longer than FEED_MAX_AGE"""
+    cutoff = time.time() - FEED_MAX_AGE
+    try:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+    except OSError:
+        pass
+
+
+def get_speech_feed() -> SpeechFeed:
+    """Get the speech feed of the current session"""
+    if "voice_feed" not in st.session_state:
+        _prune_feeds()
+        st.session_state.voice_feed = SpeechFeed()
+    return st.session_state.voice_feed
+
+
+def speak_text(text):
+    """Speak a complete text through the voice component"""
+    if not text:
+        return
+
+    feed = get_speech_feed()
+    feed.start()
+    try:
+        feed.add(split_sentences(text))
+    finally:
+        feed.finish()
+
+
+def speak_stream(chunks: Iterable[str]) -> Iterator[str]:
+    """
+    Speak a streamed response sentence by sentence as it arrives
+
+    Sentences go to the session's speech feed, which the voice component
+    rendered earlier in the run polls, so no extra iframe is created.
+
+    Args:
+        chunks: Text chunks, e.g. from ChatBot.generate_response_stream
+
+    Yields:
+        The same chunks unchanged, so the stream can also be rendered
+    """
+    feed = get_speech_feed()
+    chunker = SentenceChunker()
+    feed.start()
+    try:
+        for chunk in chunks:
+            sentences = chunker.feed(chunk)
+            if sentences:
+                feed.add(sentences)
+            yield chunk
+        feed.add(chunker.flush())
+    finally:
+        feed.finish()
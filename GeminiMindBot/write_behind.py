@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+
+class WriteBehindWriter:
+    """Writes JSON files from a background thread, coalescing updates per file"""
+
+    def __init__(self, flush_interval: float = 1.0, flush_count: int = 50, max_pending: int = 1000):
+        """
+        Initialize the writer
+
+        Args:
+            flush_interval: Longest time in seconds an update waits on disk, the durability window
+            flush_count: Updates since the last flush that trigger an early one
+            max_pending: Distinct files waiting before callers write synchronously
+        """
+        self.flush_interval = flush_interval
+        self.flush_count = flush_count
+        self.max_pending = max_pending
+        self._pending: Dict[str, Any] = {}
+        # Appends per file: whether to truncate first, and the texts in order
+        self._appends: Dict[str, list] = {}
+        self._updates = 0
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"submitted": 0, "coalesced": 0, "flushes": 0, "files_written": 0,
+                       "synchronous": 0, "errors": 0, "last_flush_ms": 0.0, "max_flush_ms": 0.0}
+        atexit.register(self.flush)
+
+    def submit(self, path: str, data: Any):
+        """
+        Queue a JSON document to be written to a file
+
+        A later submit for the same file replaces the earlier one, so only
+        the newest state is written. The caller must not mutate data
+        afterwards; pass a copy.
+
+        Args:
+            path: Target file
+            data: JSON-serializable document
+        """
+        with self._condition:
+            self._stats["submitted"] += 1
+            if path in self._pending or len(self._pending) < self.max_pending:
+                if path in self._pending:
+                    self._stats["coalesced"] += 1
+                self._pending[path] = data
+                self._updates += 1
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                    self._thread.start()
+                if self._updates >= self.flush_count:
+                    self._condition.notify()
+                return
+            # Backpressure: the queue is full, so this caller pays for its own write
+            self._stats["synchronous"] += 1
+        self._write(path, data)
+
+    def append(self, path: str, text: str, truncate: bool = False):
+        """
+        Queue text to be appended to a file
+
+        Appends queued for the same file are written together in order.
+
+        Args:
+            path: Target file
+            text: Text to append, usually one JSON line
+            truncate: Empty the file first; drops appends still queued for it
+        """
+        with self._condition:
+            self._stats["submitted"] += 1
+            if path in self._appends or len(self._pending) + len(self._appends) < self.max_pending:
+                if path in self._appends and not truncate:
+                    self._stats["coalesced"] += 1
+                    self._appends[path][1].append(text)
+                else:
+                    self._appends[path] = [truncate, [text]]
+                self._updates += 1
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                    self._thread.start()
+                if self._updates >= self.flush_count:
+                    self._condition.notify()
+                return
+            self._stats["synchronous"] += 1
+        self._append(path, truncate, [text])
+
+    def flush(self):
+        """Write everything pending now; called on shutdown"""
+        with self._flush_lock:
+            with self._condition:
+                pending, self._pending = self._pending, {}
+                appends, self._appends = self._appends, {}
+                self._updates = 0
+            if not pending and not appends:
+                return
+            start = time.perf_counter()
+            for path, data in pending.items():
+                self._write(path, data)
+            for path, (truncate, texts) in appends.items():
+                self._append(path, truncate, texts)
+            elapsed = (time.perf_counter() - start) * 1000
+            with self._condition:
+                self._stats["flushes"] += 1
+                self._stats["last_flush_ms"] = round(elapsed, 2)
+                self._stats["max_flush_ms"] = round(max(self._stats["max_flush_ms"], elapsed), 2)
+
+    def stats(self) -> Dict[str, Any]:
+        """Get queue depth, counters and flush latency"""
+        with self._condition:
+            return dict(self._stats, pending=len(self._pending) + len(self._appends))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._updates >= self.flush_count, self.flush_interval)
+            self.flush()
+
+    def _write(self, path: str, data: Any):
+        """Write one file atomically"""
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary, "w") as f:
+                json.dump(data, f, indent=2)
+            os.replace(temporary, path)
+            with self._condition:
+                self._stats["files_written"] += 1
+        except Exception as e:
+            logging.error(f"Failed to write {path}: {str(e)}")
+            with self._condition:
+                self._stats["errors"] += 1
+
+    def _append(self, path: str, truncate: bool, texts: list):
+        """Append texts to a file in one write"""
+        try:
+            with open(path, "w" if truncate else "a", encoding="utf-8") as f:
+                f.write("".join(texts))
+            with self._condition:
+                self._stats["files_written"] += 1
+        except Exception as e:
+            logging.error(f"Failed to append to {path}: {str(e)}")
+            with self._condition:
+                self._stats["errors"] += 1
+
+
+# Process-wide writer used by ConversationMemory in write-behind mode. It is
+# flushed by its atexit hook: Streamlit turns SIGTERM into a normal server
+# stop, and handlers installed from a script thread would never run
+shared_writer = WriteBehindWriter(
+    flush_interval=float(os.environ.get("MEMORY_FLUSH_INTERVAL", "1.0")),
+    flush_count=int(os.environ.get("MEMORY_FLUSH_COUNT", "50"))
+)
+